@@ -1,47 +1,146 @@
-from dash import Dash, dcc, html, Input, Output
+import os
+from datetime import date
+from dash import Dash, dash_table, dcc, html, Input, Output, State, ctx, no_update
 import dash_bootstrap_components as dbc
+import background
 import components as cmp
+import compression
+import metrics
+import probes
 import polars as pl
-from operations import calculate_difference, count_by_category
+from crossfilter import POPULARITY, describe_filter, normalize_filters, toggle_filter
+from datastore import CURRENT, DataStore
+from operations import (
+    ALL, CATEGORY_COLUMNS, CUBE_METRICS, POPULARITY_BINS, POPULARITY_RANGE, aggregate_popularity_bins,
+    build_genre_filter, calculate_difference, diff_category_shares, diff_popularity_bins, get_bin_bounds, get_popularity_bins, parse_bin,
+    query_page
+)
+from rollups import LEADERBOARD_CATEGORIES, RANKINGS
+from search import intersect_sorted, tokenize
+from sketches import SKETCH_CATEGORIES
+from similarity import DISPLAY_COLUMNS
 from utils import format_label, get_avg_metrics
 
-app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-
-all_data_path = 'data/spotify_data_prepared.csv'
-all_data_df = pl.read_csv(all_data_path)
-all_data_df = all_data_df.sort('popularity', descending=True)
-
-histogram_data_path = 'data/histogram_data.csv'
-histogram_df = pl.read_csv(histogram_data_path)
+# Every frame and aggregate of the current data version. Nothing is loaded at import, the
+# warm-up at the end of this module loads it in the background. A new version written by
+# prepare.py is loaded in the background and swapped in without restarting the workers
+data_store = DataStore()
 
-excluded_columns = ['popularity_bin', 'popularity']
-metric_columns = [col for col in histogram_df.columns if col not in excluded_columns]
-avg_metrics = get_avg_metrics(metric_columns, all_data_df, histogram_df)
-
-category_columns = ['general_genre', 'explicit', 'time_signature']
-popularity_bins = ['0-25', '25-50', '50-75', '75-100']
+# Job results are keyed on the data version, so a background result is never served for older data
+app = Dash(
+    __name__,
+    external_stylesheets=[dbc.themes.BOOTSTRAP],
+    background_callback_manager=background.create_manager([lambda: data_store.version])
+)
+# Installed first so its hook runs last, and the payload metrics count the JSON before compression
+compression.install(app.server)
+metrics.install(app.server)
+# /health and /ready answer while the data loads, load balancers route to warm workers only
+probes.install(app.server, data_store)
+# WSGI entry point for production servers: gunicorn app:server
+server = app.server
 
-top_bin = popularity_bins[-1]
-bottom_bin = popularity_bins[0]
-top_tracks_df = histogram_df.filter(pl.col('popularity_bin') == top_bin)
-bottom_tracks_df = histogram_df.filter(pl.col('popularity_bin') == bottom_bin)
+category_columns = CATEGORY_COLUMNS
+popularity_bins = POPULARITY_BINS
+metric_columns = ['count'] + [metric for metric in CUBE_METRICS if metric != 'popularity']
+bin_widths = ['25', '10', '5', '1']
+similar_columns = DISPLAY_COLUMNS
+similar_tracks_count = 10
+# Categories such as genres have over a hundred values, the chart keeps the largest ones
+category_value_limit = 20
+# Snapshot partitions also record how much each track's popularity moved since the
+# previous one, columns missing from the data are left out of the table
+table_columns = ['track_name', 'artists', 'album_name', 'genres', 'general_genre', 'explicit', 'popularity', 'popularity_change']
 
 logo_img = html.Img(src='assets/logo.png', height='50px')
 title = html.H1('Spotify Tracks Dashboard', style={'color': cmp.PRIMARY_COLOR}, className='text-center')
-subtitle = html.P('Snapshot from October 2022', style={'color': cmp.PRIMARY_COLOR}, className='lead')
 
 label_style = {'color': cmp.PRIMARY_COLOR, 'font-weight': '500', 'font-size': '20px'}
 category_label = dbc.Label('Category', style=label_style)
 popularity_label = dbc.Label('Popularity Bin', style=label_style)
+bin_width_label = dbc.Label('Bin Width', style=label_style)
+popularity_range_label = dbc.Label('Popularity Range', style=label_style)
+snapshot_label = dbc.Label('Snapshot', style=label_style)
 
 metric_tabs = cmp.create_tabs('metric-tabs', metric_columns)
 category_tabs = cmp.create_tabs('category-tabs', category_columns)
 popularity_tabs = cmp.create_tabs('popularity-tabs', popularity_bins)
+bin_width_tabs = cmp.create_tabs('bin-width-tabs', bin_widths)
+popularity_range_slider = dcc.RangeSlider(
+    id='popularity-range',
+    min=POPULARITY_RANGE[0],
+    max=POPULARITY_RANGE[1],
+    step=1,
+    value=list(POPULARITY_RANGE),
+    marks={value: str(value) for value in range(POPULARITY_RANGE[0], POPULARITY_RANGE[1] + 1, 10)},
+    allowCross=False
+)
+chart_view_items = dbc.RadioItems(
+    id='chart-view',
+    options=[{'label': 'Averages', 'value': 'mean'}, {'label': 'Distribution', 'value': 'distribution'}],
+    value='mean',
+    inline=True,
+    style={'color': cmp.PRIMARY_COLOR}
+)
+delta_switch = dbc.Switch(
+    id='delta-switch',
+    label='Change vs previous snapshot',
+    value=False,
+    style={'color': cmp.PRIMARY_COLOR}
+)
 
 chart_style = {'height': '40vw'}
+# The bars clicked on the charts, as [dimension, value] pairs in click order, filter the other views
+cross_filter_store = dcc.Store(id='cross-filter', data=[])
+cross_filter_status = html.Small(id='cross-filter-status', style={'color': cmp.PRIMARY_COLOR})
+clear_cross_filter_button = dbc.Button('Clear filters', id='clear-cross-filter', color='success', outline=True, size='sm')
 histogram_chart = dcc.Graph(id='histogram-chart', style=chart_style)
 butterfly_chart = dcc.Graph(id='butterfly-chart', style=chart_style)
-table_container = html.Div(id='table')
+status_style = {'color': cmp.PRIMARY_COLOR, 'visibility': 'hidden'}
+table_status = html.Small(id='table-status', style=status_style)
+table_page_store = dcc.Store(id='table-page')
+search_input = dcc.Input(
+    id='track-search',
+    type='search',
+    placeholder='Search tracks, artists and albums',
+    debounce=0.2,
+    className='form-control mb-2'
+)
+genre_match_items = dbc.RadioItems(
+    id='genre-match',
+    options=[{'label': 'Any', 'value': 'any'}, {'label': 'All', 'value': 'all'}],
+    value='any',
+    inline=True,
+    style={'color': cmp.PRIMARY_COLOR}
+)
+similar_status = html.Small(id='similar-status', style=status_style)
+similar_filters = dbc.Checklist(
+    id='similar-filters',
+    options=[
+        {'label': 'Same genre', 'value': 'general_genre'},
+        {'label': 'Same explicit rating', 'value': 'explicit'}
+    ],
+    value=[],
+    inline=True,
+    style={'color': cmp.PRIMARY_COLOR}
+)
+similar_title = html.P('Select a track in the table to find similar tracks', id='similar-tracks-title', style=label_style)
+leaderboard_title = html.P('Top artists and albums', style=label_style)
+leaderboard_entity_items = dbc.RadioItems(
+    id='leaderboard-entity',
+    options=[{'label': 'Artists', 'value': 'artist'}, {'label': 'Albums', 'value': 'album'}],
+    value='artist',
+    inline=True,
+    style={'color': cmp.PRIMARY_COLOR}
+)
+leaderboard_ranking_items = dbc.RadioItems(
+    id='leaderboard-ranking',
+    options=[{'label': format_label(ranking), 'value': ranking} for ranking in RANKINGS],
+    value=RANKINGS[0],
+    inline=True,
+    style={'color': cmp.PRIMARY_COLOR}
+)
+leaderboard_bin_tabs = cmp.create_tabs('leaderboard-bin-tabs', [ALL] + popularity_bins)
 
 avg_metric_card = cmp.create_card(text_id='avg-card-text', title_id='avg-card-title')
 most_popular_tracks_card = cmp.create_card(text_id='popular-tracks-text')
@@ -49,72 +148,397 @@ least_popular_tracks_card = cmp.create_card(text_id='unpopular-tracks-text')
 
 footer = cmp.create_footer()
 
-app.layout = html.Div([
-    dbc.Container([
-        dbc.Row([
-            dbc.Col([
-                logo_img
-            ], md=2, sm=3, xs=12, className='mb-2 mt-2'),
-            dbc.Col([
-                title
-            ], md=6, sm=9, xs=12, className='mb-2 mt-2'),
-            dbc.Col([
-                subtitle
-            ], md=4, sm=12, className='mb-2 mt-2'),
-        ], className='mb-2 mt-2 text-center'),
-        dbc.Row([
-            dbc.Col([
-                metric_tabs
-            ], width=12, className='mb-4')
-        ], className='mb-4'),
-        dbc.Row([
-            dbc.Col([
-                histogram_chart
-            ], width=12, className='mb-4'),
-            dbc.Col([
-                avg_metric_card
-            ], md=4, sm=12, className='mb-4'),
-            dbc.Col([
-                most_popular_tracks_card
-            ], md=4, sm=12, className='mb-4'),
-            dbc.Col([
-                least_popular_tracks_card
-            ], md=4, sm=12, className='mb-4')
-        ], className='mb-4'),
-        dbc.Row([
-            dbc.Col([
-                dbc.Row([
-                    dbc.Col(category_label, md=3, sm=12, className='mb-2 text-center'),
-                    dbc.Col(category_tabs, md=9, sm=12, className='mb-2')
-                ], 
-                align='center'
-                )
-            ], lg=6, md=12, className='mb-2'),
+def get_table_columns(snapshot):
+    return [col for col in table_columns if col in snapshot.data_schema]
+
+# The table columns follow the schema of the data, so the tables are built with the layout
+def create_track_table(snapshot, query_action='custom'):
+    return cmp.create_table(
+        pl.DataFrame(schema={col: snapshot.data_schema[col] for col in get_table_columns(snapshot)}),
+        table_id='track-table',
+        page_action='custom',
+        sort_action=query_action,
+        filter_action=query_action
+    )
+
+def create_similar_table(snapshot):
+    return cmp.create_table(
+        pl.DataFrame(schema={
+            **{col: snapshot.data_schema[col] for col in similar_columns}, 'distance': pl.Float32
+        }),
+        table_id='similar-table',
+        page_action='none'
+    )
+
+# Leaderboards are served from the tables prepare.py writes, one page of 10 at a time in the browser
+def create_leaderboard_table(snapshot):
+    return cmp.create_table(
+        snapshot.leaderboards['artist'].get().clear(), table_id='leaderboard-table', page_action='native'
+    )
+
+# The genre picker of the leaderboards holds '<category>:<value>' scopes
+def get_leaderboard_options(snapshot):
+    leaderboards = snapshot.leaderboards['artist']
+    return [{'label': 'All genres', 'value': f'{ALL}:{ALL}'}] + [
+        {'label': f'{format_label(category[:-1])}: {value}', 'value': f'{category}:{value}'}
+        for category in LEADERBOARD_CATEGORIES
+        for value in leaderboards.get_values(category)
+    ]
+
+def get_view_filters(snapshot, partition, delta, cross_filter, exclude=None):
+    # Only the latest snapshot keeps its tracks, so older snapshots and the changes between
+    # snapshots are shown unfiltered. A view is not filtered by the bars clicked on itself
+    if delta or partition.name != snapshot.latest:
+        return ()
+    return normalize_filters(cross_filter, exclude)
+
+def get_selected_value(cross_filter, dimension):
+    return dict(normalize_filters(cross_filter)).get(dimension)
+
+def get_popularity_sums(snapshot, partition, filters=()):
+    if filters:
+        return snapshot.cross_filter_index.get_popularity_sums(filters)
+    return partition.popularity_sums_df
+
+def get_histogram_data(popularity_sums_df, bin_width, popularity_range):
+    return aggregate_popularity_bins(popularity_sums_df, get_popularity_bins(popularity_range, bin_width))
+
+def build_histogram_chart(snapshot, metric, bin_width=25, popularity_range=POPULARITY_RANGE, snapshot_name=None, delta=False,
+                          filters=(), selected_range=None):
+    partition = snapshot.get_partition(snapshot_name)
+    histogram_df = get_histogram_data(get_popularity_sums(snapshot, partition, filters), bin_width, popularity_range)
+    previous_partition = snapshot.get_previous_partition(partition.name) if delta else None
+    if previous_partition is None:
+        fig = cmp.create_custom_histogram(histogram_df, 'popularity_bin', metric)
+    else:
+        previous_histogram_df = get_histogram_data(previous_partition.popularity_sums_df, bin_width, popularity_range)
+        change_df = diff_popularity_bins(histogram_df, previous_histogram_df)
+        fig = cmp.create_custom_histogram(change_df, 'popularity_bin', metric, change=True)
+    positions = [
+        position for position, (_, start, end) in enumerate(get_popularity_bins(popularity_range, bin_width))
+        if (start, end) == selected_range
+    ]
+    return cmp.highlight_points(fig, positions) if positions else fig
+
+def build_distribution_chart(snapshot, metric, bin_width=25, popularity_range=POPULARITY_RANGE, snapshot_name=None, filters=()):
+    bins = get_popularity_bins(popularity_range, bin_width)
+    # Sketches hold every track, the quantiles of a selection are computed from its tracks
+    if filters:
+        quantiles_df = snapshot.cross_filter_index.get_popularity_quantiles(filters, metric, bins)
+    else:
+        quantiles_df = snapshot.get_partition(snapshot_name).metric_sketches.get_popularity_quantiles(metric, bins)
+    return cmp.create_box_chart(quantiles_df, 'popularity_bin', metric)
+
+def build_category_distribution_chart(snapshot, category, popularity_bin, metric, snapshot_name=None, filters=()):
+    if filters:
+        quantiles_df = snapshot.cross_filter_index.get_category_quantiles(filters, category, popularity_bin, metric)
+    else:
+        metric_sketches = snapshot.get_partition(snapshot_name).metric_sketches
+        quantiles_df = metric_sketches.get_category_quantiles(category, popularity_bin, metric)
+    quantiles_df = quantiles_df.sort('count').tail(category_value_limit).sort('p50')
+    return cmp.create_box_chart(quantiles_df, category, metric, horizontal=True)
+
+def shows_distribution(chart_view, metric, category=None):
+    # Track counts have no spread, and only some categories are sketched
+    return chart_view == 'distribution' and metric != 'count' and (category is None or category in SKETCH_CATEGORIES)
+
+def search_tracks(snapshot, popularity_bin, search_query, filters=()):
+    """Return the tracks of the bin whose names, artists or albums match ``search_query``,
+    among those passing the cross ``filters``."""
+    bin_df = snapshot.bin_dfs[popularity_bin]
+    search_index = snapshot.search_index
+    cross_filter_index = snapshot.cross_filter_index
+    searched = bool(tokenize(search_query or ''))
+    if not searched and not filters:
+        return bin_df
+    if isinstance(snapshot.all_data_df, pl.LazyFrame):
+        if searched:
+            keys = search_index.keys[search_index.search(search_query)]
+            bin_df = bin_df.filter(pl.col('index').is_in(pl.Series(keys)))
+        return bin_df.filter(*cross_filter_index.get_predicates(filters)) if filters else bin_df
+    # A bin is a contiguous range of rows, so only its matches and selected tracks are gathered
+    offset, length = get_bin_bounds(snapshot.all_data_df, *parse_bin(popularity_bin))
+    positions = cross_filter_index.get_positions(filters, offset, offset + length) if filters else None
+    if searched:
+        matches = search_index.search(search_query, offset, offset + length)
+        positions = matches if positions is None else intersect_sorted(matches, positions)
+    return snapshot.all_data_df[positions]
+
+def query_table(set_progress, snapshot, popularity_bin, page_current, page_size, sort_by=None, filter_query=None,
+                search_query=None, genres=None, genre_match='any', cross_filter=None):
+    # Sort and filter values are free text, only whether they are used goes in the label
+    filters = normalize_filters(cross_filter)
+    inputs = (
+        f'{popularity_bin}/sorted={bool(sort_by)}/filtered={bool(filter_query)}/searched={bool(search_query)}'
+        f'/genres={genre_match if genres else "none"}/cross_filtered={bool(filters)}'
+    )
+    with metrics.track('update_table', inputs) as timer:
+        with timer.stage('query'):
+            set_progress('Querying tracks...')
+            # The prepared row index becomes the row id, which selected cells report back
+            columns = get_table_columns(snapshot)
+            filtered_df = search_tracks(snapshot, popularity_bin, search_query, filters)
+            if genres:
+                filtered_df = filtered_df.filter(build_genre_filter(genres, snapshot.genre_names, genre_match))
+            filtered_df = filtered_df.select(columns + ['index'])
+            page_df, page_count = query_page(filtered_df, page_current, page_size, sort_by, filter_query)
+        with timer.stage('serialize'):
+            set_progress('Loading rows...')
+            # The table shows lists, such as the genres, as text. The page goes out as
+            # columns, which do not repeat the column names on every row
+            table_data = page_df.rename({'index': 'id'}).with_columns(
+                pl.col(pl.List(pl.Utf8)).list.join(', ')
+            ).to_dict(as_series=False)
+    return table_data, page_count
+
+def get_category_shares(snapshot, partition, category, popularity_bin):
+    if partition.name == snapshot.latest:
+        return snapshot.category_shares[(category, popularity_bin)]
+    return partition.get_category_shares(category, popularity_bin)
+
+def build_category_chart(snapshot, category, popularity_bin, snapshot_name=None, delta=False, filters=(), selected_value=None):
+    partition = snapshot.get_partition(snapshot_name)
+    # Shares among the tracks selected on the other charts when there is a selection
+    if filters:
+        total_count_by_category_df = snapshot.cross_filter_index.get_category_shares(filters, category, ALL, 'total_count')
+        bin_count_by_category_df = snapshot.cross_filter_index.get_category_shares(filters, category, popularity_bin, 'bin_count')
+    else:
+        total_count_by_category_df = get_category_shares(snapshot, partition, category, ALL)
+        bin_count_by_category_df = get_category_shares(snapshot, partition, category, popularity_bin)
+    previous_partition = snapshot.get_previous_partition(partition.name) if delta else None
+    if previous_partition is None:
+        merged_df = total_count_by_category_df.join(bin_count_by_category_df, on=category).tail(category_value_limit)
+        fig = cmp.create_butterfly_chart(merged_df, 'total_count', 'bin_count', category)
+    else:
+        # Shares move in percentage points, a value missing from one snapshot had a share of zero there
+        total_change_df = diff_category_shares(
+            total_count_by_category_df, previous_partition.get_category_shares(category, ALL), category, 'total_count'
+        )
+        bin_change_df = diff_category_shares(
+            bin_count_by_category_df, previous_partition.get_category_shares(category, popularity_bin), category, 'bin_count'
+        )
+        merged_df = (
+            total_change_df.join(bin_change_df, on=category, how='left').fill_null(0)
+            .sort(pl.col('total_count').abs()).tail(category_value_limit)
+            .sort('total_count')
+        )
+        fig = cmp.create_share_change_chart(merged_df, 'total_count', 'bin_count', category)
+    positions = [position for position, value in enumerate(merged_df[category].cast(pl.Utf8)) if value == selected_value]
+    return cmp.highlight_points(fig, positions) if positions else fig
+
+def warm_figure_cache(snapshot):
+    # Only the latest snapshot is warmed, older ones are built on first request
+    for metric in metric_columns:
+        cmp.figure_cache.get_figure(
+            'histogram', (metric, 25, POPULARITY_RANGE, snapshot.latest, False, (), None), snapshot.version,
+            build_histogram_chart, snapshot, metric
+        )
+    for category in category_columns:
+        for popularity_bin in popularity_bins:
+            cmp.figure_cache.get_figure(
+                'butterfly', (category, popularity_bin, snapshot.latest, False, (), None), snapshot.version,
+                build_category_chart, snapshot, category, popularity_bin
+            )
+
+@data_store.on_swap
+def invalidate_figure_cache(snapshot, previous_snapshot):
+    # Figures of the old version can no longer be hit, drop them instead of letting them age out
+    cmp.figure_cache.clear()
+    if os.environ.get('WARM_FIGURE_CACHE') == '1':
+        warm_figure_cache(snapshot)
+
+def serve_layout(static=False):
+    # Built on every page load, so the snapshot choices follow the reloaded data. The static
+    # layout of export.py leaves out the controls that need a query: the popularity range,
+    # the selection of bars, the search, genre filter, sorting and filtering of the track
+    # table, similar tracks and the leaderboards
+    snapshot = data_store.snapshot
+    if snapshot.latest == CURRENT:
+        subtitle_text = 'Snapshot from October 2022'
+    else:
+        subtitle_text = f'Snapshot from {date.fromisoformat(snapshot.latest):%B %Y}'
+    subtitle = html.P(subtitle_text, style={'color': cmp.PRIMARY_COLOR}, className='lead')
+    snapshot_dropdown = dcc.Dropdown(
+        id='snapshot-dropdown',
+        options=[{'label': name, 'value': name} for name in reversed(snapshot.partitions)],
+        value=snapshot.latest,
+        clearable=False
+    )
+    # The selector is only shown once there is a snapshot to compare with
+    snapshot_row_style = {} if len(snapshot.partitions) > 1 else {'display': 'none'}
+    genre_dropdown = dcc.Dropdown(
+        id='genre-filter',
+        options=snapshot.genre_names,
+        value=[],
+        multi=True,
+        placeholder='Filter by genres'
+    )
+    if static:
+        # Exported pages hold the tracks of each bin in popularity order only
+        table_children = [html.Div(create_track_table(snapshot, query_action='none'), id='table')]
+        popularity_range_columns = []
+        cross_filter_rows = []
+        similar_rows = []
+        leaderboard_rows = []
+    else:
+        table_children = [
+            dbc.Row([
+                dbc.Col(search_input, md=6, sm=12),
+                dbc.Col(genre_dropdown, md=4, sm=12, className='mb-2'),
+                dbc.Col(genre_match_items, md=2, sm=12, className='mb-2')
+            ], align='center'),
+            table_status,
+            table_page_store,
+            html.Div(create_track_table(snapshot), id='table')
+        ]
+        popularity_range_columns = [
             dbc.Col([
                 dbc.Row([
-                    dbc.Col(popularity_label, md=3, sm=12, className='mb-2 text-center'),
-                    dbc.Col(popularity_tabs, md=9, sm=12, className='mb-2')
+                    dbc.Col(popularity_range_label, md=3, sm=12, className='mb-2 text-center'),
+                    dbc.Col(popularity_range_slider, md=9, sm=12, className='mb-2')
                 ], 
                 align='center'
                 )
             ], lg=6, md=12, className='mb-2')
-        ], className='mb-2'),
-        dbc.Row([
-            dbc.Col([
-                butterfly_chart
-            ], width=12, className='mb-4')
-        ], className='mb-4'),
-        dbc.Row([
-            dbc.Col([
-                table_container
-            ], width=12, className='mb-4')
-        ], className='mb-4')
-    ],  
-    fluid=True,
-    className='mx-auto'
-    ),
-    footer
-], style={'background-color': cmp.BACKGROUND_COLOR})
+        ]
+        cross_filter_rows = [
+            dbc.Row([
+                dbc.Col([cross_filter_store, cross_filter_status], md=9, sm=12, className='mb-2'),
+                dbc.Col(clear_cross_filter_button, md=3, sm=12, className='mb-2 text-end')
+            ], align='center', className='mb-2')
+        ]
+        similar_rows = [
+            dbc.Row([
+                dbc.Col(similar_title, md=8, sm=12, className='mb-2'),
+                dbc.Col(similar_filters, md=4, sm=12, className='mb-2')
+            ], align='center'),
+            dbc.Row([
+                dbc.Col([
+                    similar_status,
+                    create_similar_table(snapshot)
+                ], width=12, className='mb-4')
+            ], className='mb-4')
+        ]
+        leaderboard_dropdown = dcc.Dropdown(
+            id='leaderboard-genre',
+            options=get_leaderboard_options(snapshot),
+            value=f'{ALL}:{ALL}',
+            clearable=False
+        )
+        leaderboard_rows = [
+            dbc.Row([
+                dbc.Col(leaderboard_title, md=3, sm=12, className='mb-2'),
+                dbc.Col(leaderboard_entity_items, md=2, sm=12, className='mb-2'),
+                dbc.Col(leaderboard_dropdown, md=3, sm=12, className='mb-2'),
+                dbc.Col(leaderboard_ranking_items, md=4, sm=12, className='mb-2')
+            ], align='center'),
+            dbc.Row([
+                dbc.Col(leaderboard_bin_tabs, width=12, className='mb-2'),
+                dbc.Col(create_leaderboard_table(snapshot), width=12, className='mb-4')
+            ], className='mb-4')
+        ]
+
+    return html.Div([
+        dbc.Container([
+            dbc.Row([
+                dbc.Col([
+                    logo_img
+                ], md=2, sm=3, xs=12, className='mb-2 mt-2'),
+                dbc.Col([
+                    title
+                ], md=6, sm=9, xs=12, className='mb-2 mt-2'),
+                dbc.Col([
+                    subtitle
+                ], md=4, sm=12, className='mb-2 mt-2'),
+            ], className='mb-2 mt-2 text-center'),
+            dbc.Row([
+                dbc.Col(snapshot_label, md=2, sm=12, className='mb-2 text-center'),
+                dbc.Col(snapshot_dropdown, md=4, sm=12, className='mb-2'),
+                dbc.Col(delta_switch, md=6, sm=12, className='mb-2')
+            ], align='center', className='mb-2', style=snapshot_row_style),
+            dbc.Row([
+                dbc.Col([
+                    metric_tabs
+                ], width=12, className='mb-2'),
+                dbc.Col([
+                    chart_view_items
+                ], width='auto', className='mb-4')
+            ], justify='center', className='mb-4'),
+            dbc.Row([
+                dbc.Col([
+                    dbc.Row([
+                        dbc.Col(bin_width_label, md=3, sm=12, className='mb-2 text-center'),
+                        dbc.Col(bin_width_tabs, md=9, sm=12, className='mb-2')
+                    ], 
+                    align='center'
+                    )
+                ], lg=6, md=12, className='mb-2'),
+                *popularity_range_columns
+            ], className='mb-2'),
+            *cross_filter_rows,
+            dbc.Row([
+                dbc.Col([
+                    histogram_chart
+                ], width=12, className='mb-4'),
+                dbc.Col([
+                    avg_metric_card
+                ], md=4, sm=12, className='mb-4'),
+                dbc.Col([
+                    most_popular_tracks_card
+                ], md=4, sm=12, className='mb-4'),
+                dbc.Col([
+                    least_popular_tracks_card
+                ], md=4, sm=12, className='mb-4')
+            ], className='mb-4'),
+            dbc.Row([
+                dbc.Col([
+                    dbc.Row([
+                        dbc.Col(category_label, md=3, sm=12, className='mb-2 text-center'),
+                        dbc.Col(category_tabs, md=9, sm=12, className='mb-2')
+                    ], 
+                    align='center'
+                    )
+                ], lg=6, md=12, className='mb-2'),
+                dbc.Col([
+                    dbc.Row([
+                        dbc.Col(popularity_label, md=3, sm=12, className='mb-2 text-center'),
+                        dbc.Col(popularity_tabs, md=9, sm=12, className='mb-2')
+                    ], 
+                    align='center'
+                    )
+                ], lg=6, md=12, className='mb-2')
+            ], className='mb-2'),
+            dbc.Row([
+                dbc.Col([
+                    butterfly_chart
+                ], width=12, className='mb-4')
+            ], className='mb-4'),
+            dbc.Row([
+                dbc.Col(table_children, width=12, className='mb-4')
+            ], className='mb-4'),
+            *similar_rows,
+            *leaderboard_rows
+        ],  
+        fluid=True,
+        className='mx-auto'
+        ),
+        footer
+    ], style={'background-color': cmp.BACKGROUND_COLOR})
+
+# Dash calls a layout function once to list the component ids callbacks may use, which
+# would load the data at import. The ids are listed here instead, with the components
+# serve_layout fills from the data left empty
+app.validation_layout = html.Div([
+    dcc.Dropdown(id='snapshot-dropdown'), delta_switch, metric_tabs, chart_view_items, bin_width_tabs,
+    popularity_range_slider, cross_filter_store, cross_filter_status, clear_cross_filter_button,
+    histogram_chart, avg_metric_card, most_popular_tracks_card, least_popular_tracks_card,
+    category_tabs, popularity_tabs, butterfly_chart, search_input, dcc.Dropdown(id='genre-filter'), genre_match_items,
+    table_status, table_page_store, html.Div(dash_table.DataTable(id='track-table'), id='table'),
+    similar_title, similar_filters, similar_status, dash_table.DataTable(id='similar-table'),
+    leaderboard_entity_items, dcc.Dropdown(id='leaderboard-genre'), leaderboard_ranking_items, leaderboard_bin_tabs,
+    dash_table.DataTable(id='leaderboard-table')
+])
+app.layout = serve_layout
 
 @app.callback(
     Output('histogram-chart', 'figure'),
@@ -122,44 +546,257 @@ app.layout = html.Div([
     Output('avg-card-text', 'children'),
     Output('popular-tracks-text', 'children'),
     Output('unpopular-tracks-text', 'children'),
-    [Input('metric-tabs', 'active_tab')]
-)
-def update_distribution_charts(metric):
-    x = 'popularity_bin'
-    y = metric
-    
-    fig = cmp.create_custom_histogram(histogram_df, x, y)
-    
-    title = f'AVG {format_label(metric)}'
-    avg_value = avg_metrics.get(metric, 'N/A')
-    avg_value_text = str(avg_value)
-    top_tracks_diff = calculate_difference(top_tracks_df, metric, avg_metrics[metric])
-    bottom_tracks_diff = calculate_difference(bottom_tracks_df, metric, avg_metrics[metric])
-
-    top_tracks_text = cmp.create_difference_text(top_bin, top_tracks_diff, metric)
-    bottom_tracks_text = cmp.create_difference_text(bottom_bin, bottom_tracks_diff, metric)
+    [Input('metric-tabs', 'active_tab'),
+    Input('bin-width-tabs', 'active_tab'),
+    Input('popularity-range', 'value'),
+    Input('snapshot-dropdown', 'value'),
+    Input('delta-switch', 'value'),
+    Input('chart-view', 'value'),
+    Input('cross-filter', 'data')]
+)
+def update_distribution_charts(metric, bin_width, popularity_range, snapshot_name, delta, chart_view, cross_filter=None):
+    bin_width = int(bin_width)
+    popularity_range = tuple(popularity_range)
+    snapshot = data_store.snapshot
+    partition = snapshot.get_partition(snapshot_name)
+    delta = bool(delta) and snapshot.get_previous_partition(partition.name) is not None
+    distribution = shows_distribution(chart_view, metric)
+    filters = get_view_filters(snapshot, partition, delta, cross_filter, exclude=POPULARITY)
+    selected_range = get_selected_value(cross_filter, POPULARITY)
+    inputs = (
+        f'{metric}/width={bin_width}/delta={delta}/view={"distribution" if distribution else "mean"}'
+        f'/cross_filtered={bool(filters)}'
+    )
+    with metrics.track('update_distribution_charts', inputs) as timer:
+        with timer.stage('figure'):
+            # The distribution view shows the selected snapshot, with or without the delta switch
+            if distribution:
+                fig = cmp.figure_cache.get_figure(
+                    'distribution', (metric, bin_width, popularity_range, partition.name, filters), snapshot.version,
+                    build_distribution_chart, snapshot, metric, bin_width, popularity_range, partition.name, filters
+                )
+            else:
+                fig = cmp.figure_cache.get_figure(
+                    'histogram', (metric, bin_width, popularity_range, partition.name, delta, filters, selected_range),
+                    snapshot.version, build_histogram_chart, snapshot, metric, bin_width, popularity_range, partition.name,
+                    delta, filters, selected_range
+                )
+        
+        with timer.stage('cards'):
+            title = f'AVG {format_label(metric)}'
+            # Averages over the whole selected range, compared with its first and last non-empty bins
+            popularity_sums_df = get_popularity_sums(snapshot, partition, filters)
+            histogram_df = get_histogram_data(popularity_sums_df, bin_width, popularity_range)
+            filled_bins_df = histogram_df.filter(pl.col('count') > 0)
+            if filled_bins_df.is_empty():
+                return fig, title, 'N/A', '', ''
+            min_popularity, max_popularity = popularity_range
+            range_metrics = aggregate_popularity_bins(
+                popularity_sums_df, [(ALL, min_popularity, max_popularity + 1)]
+            ).row(0, named=True)
+            avg_metrics = get_avg_metrics(metric_columns, range_metrics, histogram_df)
+            avg_value = avg_metrics.get(metric, 'N/A')
+            avg_value_text = str(avg_value)
+            top_tracks_df = filled_bins_df.tail(1)
+            bottom_tracks_df = filled_bins_df.head(1)
+            top_tracks_diff = calculate_difference(top_tracks_df, metric, avg_metrics[metric])
+            bottom_tracks_diff = calculate_difference(bottom_tracks_df, metric, avg_metrics[metric])
+
+            top_tracks_text = cmp.create_difference_text(top_tracks_df[0, 'popularity_bin'], top_tracks_diff, metric, most_popular=True)
+            bottom_tracks_text = cmp.create_difference_text(bottom_tracks_df[0, 'popularity_bin'], bottom_tracks_diff, metric, most_popular=False)
 
     return fig, title, avg_value_text, top_tracks_text, bottom_tracks_text
 
 @app.callback(
     Output('butterfly-chart', 'figure'),
-    Output('table', 'children'),
     [Input('category-tabs', 'active_tab'),
-    Input('popularity-tabs', 'active_tab')]
-)
-def update_category_chart(category, popularity_bin):
-    min_popularity, max_popularity = map(int, popularity_bin.split('-'))
-    filtered_df = all_data_df.filter((pl.col('popularity') >= min_popularity) & (pl.col('popularity') <= max_popularity))
-    
-    total_count_by_category_df = count_by_category(all_data_df, category, alias='total_count')
-    bin_count_by_category_df = count_by_category(filtered_df, category, alias='bin_count')
-    merged_df = total_count_by_category_df.join(bin_count_by_category_df, on=category)
-    fig = cmp.create_butterfly_chart(merged_df, 'total_count', 'bin_count', category)
-    
-    selected_columns = ['track_name', 'artists', 'album_name', 'genres', 'general_genre', 'explicit', 'popularity']
-    table_data = filtered_df.select(selected_columns).to_pandas()
-    table = cmp.create_table(table_data)
-    return fig, table
+    Input('popularity-tabs', 'active_tab'),
+    Input('snapshot-dropdown', 'value'),
+    Input('delta-switch', 'value'),
+    Input('metric-tabs', 'active_tab'),
+    Input('chart-view', 'value'),
+    Input('cross-filter', 'data')]
+)
+def update_category_chart(category, popularity_bin, snapshot_name, delta, metric, chart_view, cross_filter=None):
+    snapshot = data_store.snapshot
+    partition = snapshot.get_partition(snapshot_name)
+    delta = bool(delta) and snapshot.get_previous_partition(partition.name) is not None
+    distribution = shows_distribution(chart_view, metric, category)
+    filters = get_view_filters(snapshot, partition, delta, cross_filter, exclude=category)
+    selected_value = get_selected_value(cross_filter, category)
+    inputs = (
+        f'{category}/{popularity_bin}/delta={delta}/view={f"distribution/{metric}" if distribution else "mean"}'
+        f'/cross_filtered={bool(filters)}'
+    )
+    with metrics.track('update_category_chart', inputs) as timer:
+        with timer.stage('figure'):
+            if distribution:
+                fig = cmp.figure_cache.get_figure(
+                    'category-distribution', (category, popularity_bin, metric, partition.name, filters), snapshot.version,
+                    build_category_distribution_chart, snapshot, category, popularity_bin, metric, partition.name, filters
+                )
+            else:
+                fig = cmp.figure_cache.get_figure(
+                    'butterfly', (category, popularity_bin, partition.name, delta, filters, selected_value), snapshot.version,
+                    build_category_chart, snapshot, category, popularity_bin, partition.name, delta, filters, selected_value
+                )
+    return fig
+
+@app.callback(
+    Output('delta-switch', 'disabled'),
+    Input('snapshot-dropdown', 'value')
+)
+def update_delta_switch(snapshot_name):
+    # The oldest snapshot has nothing to compare with
+    snapshot = data_store.snapshot
+    return snapshot.get_previous_partition(snapshot.get_partition(snapshot_name).name) is None
+
+# A click on a bar selects it, a second click unselects it. The click is cleared once
+# handled, so the next click on the same bar reaches the callback again
+@app.callback(
+    Output('cross-filter', 'data'),
+    Output('histogram-chart', 'clickData'),
+    Output('butterfly-chart', 'clickData'),
+    Input('histogram-chart', 'clickData'),
+    Input('butterfly-chart', 'clickData'),
+    Input('clear-cross-filter', 'n_clicks'),
+    State('cross-filter', 'data'),
+    State('bin-width-tabs', 'active_tab'),
+    State('popularity-range', 'value'),
+    State('category-tabs', 'active_tab'),
+    prevent_initial_call=True
+)
+def update_cross_filter(histogram_click, category_click, clear_clicks, cross_filter, bin_width, popularity_range, category):
+    if ctx.triggered_id == 'clear-cross-filter':
+        return [], None, None
+    if ctx.triggered_id == 'histogram-chart' and histogram_click:
+        # Bars are labelled by their bin, which the bin width and range map back to popularity values
+        bins = {label: [start, end] for label, start, end in get_popularity_bins(tuple(popularity_range), int(bin_width))}
+        popularity_bin = histogram_click['points'][0].get('x')
+        if popularity_bin not in bins:
+            return no_update, None, no_update
+        return toggle_filter(cross_filter, POPULARITY, bins[popularity_bin]), None, no_update
+    if ctx.triggered_id == 'butterfly-chart' and category_click:
+        value = str(category_click['points'][0].get('y'))
+        return toggle_filter(cross_filter, category, value), no_update, None
+    return no_update, no_update, no_update
+
+@app.callback(
+    Output('cross-filter-status', 'children'),
+    Output('clear-cross-filter', 'disabled'),
+    Input('cross-filter', 'data'),
+    Input('snapshot-dropdown', 'value'),
+    Input('delta-switch', 'value')
+)
+def update_cross_filter_status(cross_filter, snapshot_name, delta):
+    if not cross_filter:
+        return 'Click a bar of a chart to filter the other views by it', True
+    status = 'Filtered by ' + ', '.join(describe_filter(*pair) for pair in normalize_filters(cross_filter))
+    snapshot = data_store.snapshot
+    partition = snapshot.get_partition(snapshot_name)
+    delta = bool(delta) and snapshot.get_previous_partition(partition.name) is not None
+    if not get_view_filters(snapshot, partition, delta, cross_filter):
+        status += '. The charts of older snapshots and of changes are not filtered'
+    return status, False
+
+# The table and similar-tracks queries scan the tracks, so they may run in the background
+# and are cancelled when the popularity bin changes under them
+@background.heavy_callback(
+    app,
+    Output('table-page', 'data'),
+    Output('track-table', 'page_count'),
+    Output('track-table', 'page_current'),
+    [Input('popularity-tabs', 'active_tab'),
+    Input('track-table', 'page_current'),
+    Input('track-table', 'page_size'),
+    Input('track-table', 'sort_by'),
+    Input('track-table', 'filter_query'),
+    Input('track-search', 'value'),
+    Input('genre-filter', 'value'),
+    Input('genre-match', 'value'),
+    Input('cross-filter', 'data')],
+    progress=[Output('table-status', 'children')],
+    running=[(Output('table-status', 'style'), {**status_style, 'visibility': 'visible'}, status_style)],
+    cancel=[Input('popularity-tabs', 'active_tab')]
+)
+def update_table(set_progress, popularity_bin, page_current, page_size, sort_by, filter_query, search_query,
+                 genres, genre_match, cross_filter):
+    if ctx.triggered_id != 'track-table' or 'track-table.page_current' not in ctx.triggered_prop_ids:
+        page_current = 0
+    table_data, page_count = query_table(
+        set_progress, data_store.snapshot, popularity_bin, page_current, page_size, sort_by, filter_query,
+        search_query, genres, genre_match, cross_filter
+    )
+    return table_data, page_count, page_current
+
+# Turns the columns of a page into the rows DataTable displays, in the browser
+app.clientside_callback(
+    """
+    function(page) {
+        if (!page) {
+            return window.dash_clientside.no_update;
+        }
+        const columns = Object.keys(page);
+        const rowCount = columns.length ? page[columns[0]].length : 0;
+        return Array.from({length: rowCount}, (_, row) => Object.fromEntries(columns.map(col => [col, page[col][row]])));
+    }
+    """,
+    Output('track-table', 'data'),
+    Input('table-page', 'data')
+)
+
+@background.heavy_callback(
+    app,
+    Output('similar-table', 'data'),
+    Output('similar-tracks-title', 'children'),
+    [Input('track-table', 'active_cell'),
+    Input('similar-filters', 'value')],
+    progress=[Output('similar-status', 'children')],
+    running=[(Output('similar-status', 'style'), {**status_style, 'visibility': 'visible'}, status_style)],
+    cancel=[Input('popularity-tabs', 'active_tab')]
+)
+def update_similar_tracks(set_progress, active_cell, filter_columns):
+    similarity_index = data_store.snapshot.similarity_index
+    if similarity_index is None:
+        return [], 'Similar tracks are not available with DATA_BACKEND=lazy'
+    position = similarity_index.get_position(active_cell.get('row_id') if active_cell else None)
+    if position is None:
+        return [], 'Select a track in the table to find similar tracks'
+
+    with metrics.track('update_similar_tracks', f'filters={",".join(sorted(filter_columns))}') as timer:
+        with timer.stage('query'):
+            set_progress('Searching similar tracks...')
+            track = similarity_index.rows.row(position, named=True)
+            filters = {col: track[col] for col in filter_columns}
+            similar_df = similarity_index.query(track['index'], similar_tracks_count, filters)
+        with timer.stage('serialize'):
+            table_data = similar_df.select(similar_columns + [pl.col('distance').cast(pl.Float64).round(3)]).to_dicts()
+    return table_data, f"Tracks similar to {track['track_name']} by {track['artists']}"
+
+@app.callback(
+    Output('leaderboard-table', 'data'),
+    Output('leaderboard-table', 'columns'),
+    Output('leaderboard-table', 'page_current'),
+    Input('leaderboard-entity', 'value'),
+    Input('leaderboard-genre', 'value'),
+    Input('leaderboard-bin-tabs', 'active_tab'),
+    Input('leaderboard-ranking', 'value')
+)
+def update_leaderboard(entity, scope, popularity_bin, ranking):
+    category, value = (scope or f'{ALL}:{ALL}').split(':', 1)
+    with metrics.track('update_leaderboard', f'{entity}/{category}/{popularity_bin}/{ranking}') as timer:
+        with timer.stage('query'):
+            leaderboard_df = data_store.snapshot.leaderboards[entity].get(category, value, popularity_bin, ranking)
+        with timer.stage('serialize'):
+            leaderboard_df = leaderboard_df.with_columns(pl.col(pl.Float32).cast(pl.Float64).round(3))
+            table_data = leaderboard_df.to_dicts()
+    return table_data, cmp.create_table_columns(leaderboard_df.schema), 0
+
+# DATA_WARM_UP=0 leaves the loading to the first request that needs the data
+if os.environ.get('DATA_WARM_UP', '1') == '1':
+    warm_up_steps = [warm_figure_cache] if os.environ.get('WARM_FIGURE_CACHE') == '1' else []
+    data_store.warm_up(*warm_up_steps)
+data_store.watch()
 
 if __name__ == '__main__':
     app.run_server(debug=False)
@@ -0,0 +1,184 @@
+"""Opt-in background execution of the heavy callbacks, without an external broker.
+
+With ``BACKGROUND_CALLBACKS=1`` the callbacks registered through ``heavy_callback`` become
+Dash background callbacks: the request returns at once and the browser polls for the
+result, so a slow query no longer holds a server thread. They report progress, are
+cancelled when their cancel inputs change, and identical requests in flight share one
+job. Otherwise they run synchronously like every other callback. Results go through
+diskcache. The manager implements the interface of the Dash version pinned in
+requirements.txt, next to diskcache.
+"""
+import contextvars
+import functools
+import itertools
+import os
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dash import no_update
+from dash.exceptions import PreventUpdate
+from dash.long_callback.managers import BaseLongCallbackManager
+
+BACKGROUND_CALLBACKS = os.environ.get('BACKGROUND_CALLBACKS') == '1'
+CACHE_DIR = os.environ.get('BACKGROUND_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'spotify-dashboard-jobs'))
+JOB_WORKERS = int(os.environ.get('BACKGROUND_JOB_WORKERS', '4'))
+RESULT_EXPIRE = 600
+
+class ThreadJobManager(BaseLongCallbackManager):
+    """Background callback manager that runs jobs on a thread pool and shares identical jobs.
+
+    Dash's diskcache manager forks a process per job, but polars is not fork-safe and a
+    forked job can hang in its thread pool. Jobs run on threads of the server process
+    instead, which is enough because polars releases the GIL while it computes. Results
+    and progress go through a diskcache, so every server worker can answer the polls.
+    Only the manager interface Dash calls is implemented, on our own cache keys. A job
+    runs in a copy of the context of the request that started it, which holds the
+    callback context, so ``ctx.triggered_id`` works in a job. ``set_props`` does not.
+
+    A request whose key already has a running job subscribes to it. A job is only
+    cancelled once every subscriber has cancelled it. Cancellation takes effect at the
+    next ``set_progress`` call, because a running polars query cannot be interrupted.
+    Results are kept for ``expire`` seconds, which lets late subscribers read them.
+    """
+    def __init__(self, cache, cache_by, expire=RESULT_EXPIRE, max_workers=JOB_WORKERS):
+        self.handle = cache
+        self.expire = expire
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='callback-job')
+        self._job_ids = itertools.count()
+        super().__init__(cache_by)
+
+    @staticmethod
+    def _make_progress_key(key):
+        return f'{key}-progress'
+
+    @staticmethod
+    def _make_job_key(key):
+        return f'{key}-job'
+
+    @staticmethod
+    def _make_running_key(job):
+        return f'job-{job}-running'
+
+    @staticmethod
+    def _make_subscribers_key(job):
+        return f'job-{job}-subscribers'
+
+    @staticmethod
+    def _make_cancel_key(job):
+        return f'job-{job}-cancelled'
+
+    def make_job_fn(self, fn, progress, key=None):
+        return functools.partial(self._run_job, fn, progress)
+
+    def _run_job(self, fn, progress, job, key, args):
+        cancelled = False
+
+        def set_progress(value):
+            nonlocal cancelled
+            if self.handle.get(self._make_cancel_key(job)):
+                cancelled = True
+                raise PreventUpdate
+            self.handle.set(self._make_progress_key(key), list(value) if isinstance(value, (list, tuple)) else [value])
+
+        try:
+            if self.handle.get(self._make_cancel_key(job)):
+                return
+            progress_args = [set_progress] if progress else []
+            try:
+                result = fn(*progress_args, **args) if isinstance(args, dict) else fn(*progress_args, *args)
+            except PreventUpdate:
+                result = no_update
+            except Exception as error:
+                # Dash raises this in the request polling for the result
+                result = {'long_callback_error': {'msg': str(error), 'tb': traceback.format_exc()}}
+            # Do not let the empty result of a cancelled job answer later requests
+            if not cancelled:
+                self.handle.set(key, result, expire=self.expire)
+        finally:
+            self.handle.delete(self._make_running_key(job))
+
+    def call_job_fn(self, key, job_fn, args, context):
+        with self.handle.transact():
+            job = None if self.result_ready(key) else self.handle.get(self._make_job_key(key))
+            if job is not None and self.job_running(job):
+                self.handle.incr(self._make_subscribers_key(job))
+                return job
+            job = f'{os.getpid()}-{next(self._job_ids)}'
+            self.handle.set(self._make_running_key(job), True, expire=self.expire)
+            self.handle.set(self._make_subscribers_key(job), 1, expire=self.expire)
+            self.handle.set(self._make_job_key(key), job, expire=self.expire)
+        self.executor.submit(contextvars.copy_context().run, job_fn, job, key, args)
+        return job
+
+    def get_progress(self, key):
+        progress_key = self._make_progress_key(key)
+        progress = self.handle.get(progress_key)
+        if progress:
+            self.handle.delete(progress_key)
+        return progress
+
+    def result_ready(self, key):
+        return self.handle.get(key) is not None
+
+    def get_result(self, key, job):
+        result = self.handle.get(key, self.UNDEFINED)
+        if result is self.UNDEFINED:
+            return self.UNDEFINED
+        if self.cache_by is None:
+            self.handle.delete(key)
+        else:
+            self.handle.touch(key, expire=self.expire)
+        self.handle.delete(self._make_progress_key(key))
+        # The subscriber has its result
+        self.terminate_job(job)
+        return result
+
+    def get_updated_props(self, key):
+        return {}
+
+    def job_running(self, job):
+        return bool(job) and self.handle.get(self._make_running_key(job)) is not None
+
+    def terminate_unhealthy_job(self, job):
+        return False
+
+    def terminate_job(self, job):
+        if not job:
+            return
+        with self.handle.transact():
+            remaining = self.handle.decr(self._make_subscribers_key(job), default=1)
+            if remaining > 0:
+                return
+            self.handle.delete(self._make_subscribers_key(job))
+            if self.job_running(job):
+                self.handle.set(self._make_cancel_key(job), True, expire=self.expire)
+
+def create_manager(cache_by, cache_dir=CACHE_DIR, expire=RESULT_EXPIRE):
+    """Return the background callback manager, or None when background callbacks are off.
+
+    ``cache_by`` lists zero-argument functions whose values are part of every job key,
+    such as the data version, so results computed on older data are never served.
+    """
+    if not BACKGROUND_CALLBACKS:
+        return None
+    import diskcache
+    return ThreadJobManager(diskcache.Cache(cache_dir), cache_by=cache_by, expire=expire)
+
+def heavy_callback(app, *dependencies, progress=None, running=None, cancel=None):
+    """Register a callback that may run in the background.
+
+    The decorated function takes a ``set_progress`` function before its inputs. When
+    background callbacks are off it is registered as a plain callback and progress
+    updates are dropped.
+    """
+    def decorator(function):
+        if BACKGROUND_CALLBACKS:
+            return app.callback(
+                *dependencies, background=True, progress=progress, running=running, cancel=cancel
+            )(function)
+
+        @functools.wraps(function)
+        def run_synchronously(*args):
+            return function(lambda *_: None, *args)
+        return app.callback(*dependencies)(run_synchronously)
+    return decorator
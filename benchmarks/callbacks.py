@@ -0,0 +1,122 @@
+"""Time the dashboard callbacks through Dash's request handler, in a fresh process.
+
+The app keeps the data it loads at startup, so every dataset size needs its own process. Point
+DATA_DIR at the directory prepare.py wrote and pass the size as the only argument:
+
+    DATA_DIR=/tmp/bench/data python -m benchmarks.callbacks 100000
+"""
+import json
+import sys
+import time
+from benchmarks.dash_client import CALLBACK_PATH, build_payload, get_callbacks
+from benchmarks.harness import measure
+
+INITIAL_VALUES = {
+    'metric-tabs.active_tab': 'energy',
+    'bin-width-tabs.active_tab': '25',
+    'popularity-range.value': [0, 100],
+    'snapshot-dropdown.value': None,
+    'delta-switch.value': False,
+    'chart-view.value': 'mean',
+    'category-tabs.active_tab': 'general_genres',
+    'popularity-tabs.active_tab': '25-50',
+    'track-table.page_current': 5,
+    'track-table.page_size': 10,
+    'track-table.sort_by': [],
+    'track-table.filter_query': '',
+    'track-search.value': '',
+    'genre-filter.value': [],
+    'genre-match.value': 'any',
+    'cross-filter.data': [],
+    'leaderboard-entity.value': 'artist',
+    'leaderboard-genre.value': 'all:all',
+    'leaderboard-bin-tabs.active_tab': 'all',
+    'leaderboard-ranking.value': 'mean_popularity',
+}
+# Bars clicked on the category chart, then on the histogram
+CROSS_FILTER = [['general_genres', 'Rock'], ['explicit', 'No'], ['popularity', [50, 75]]]
+# Name, first input of the callback, changed inputs, input values and whether the figure and
+# cross filter caches start empty
+CASES = [
+    ('callback.distribution.cold', 'metric-tabs', ['metric-tabs.active_tab'], {}, True),
+    ('callback.distribution.warm', 'metric-tabs', ['metric-tabs.active_tab'], {}, False),
+    ('callback.distribution.width_1', 'metric-tabs', ['bin-width-tabs.active_tab'], {
+        'bin-width-tabs.active_tab': '1', 'popularity-range.value': [20, 80],
+    }, True),
+    ('callback.distribution.sketch', 'metric-tabs', ['chart-view.value'], {
+        'chart-view.value': 'distribution', 'bin-width-tabs.active_tab': '1',
+    }, True),
+    ('callback.category.cold', 'category-tabs', ['category-tabs.active_tab'], {}, True),
+    ('callback.category.warm', 'category-tabs', ['category-tabs.active_tab'], {}, False),
+    ('callback.category.sketch', 'category-tabs', ['chart-view.value'], {
+        'chart-view.value': 'distribution',
+    }, True),
+    ('callback.table.page', 'popularity-tabs', ['track-table.page_current'], {}, False),
+    ('callback.table.sort_filter', 'popularity-tabs', ['track-table.page_current'], {
+        'track-table.sort_by': [{'column_id': 'track_name', 'direction': 'asc'}],
+        'track-table.filter_query': '{general_genre} contains Rock && {popularity} >= 30',
+    }, False),
+    ('callback.table.search', 'popularity-tabs', ['track-search.value'], {
+        'track-search.value': 'love ni',
+    }, False),
+    ('callback.table.genres', 'popularity-tabs', ['genre-filter.value'], {
+        'genre-filter.value': ['rock', 'pop', 'jazz'],
+    }, False),
+    ('callback.distribution.cross_filter.cold', 'metric-tabs', ['cross-filter.data'], {
+        'cross-filter.data': CROSS_FILTER,
+    }, True),
+    ('callback.distribution.cross_filter.warm', 'metric-tabs', ['cross-filter.data'], {
+        'cross-filter.data': CROSS_FILTER,
+    }, False),
+    ('callback.category.cross_filter.cold', 'category-tabs', ['cross-filter.data'], {
+        'cross-filter.data': CROSS_FILTER,
+    }, True),
+    ('callback.table.cross_filter', 'popularity-tabs', ['cross-filter.data'], {
+        'cross-filter.data': CROSS_FILTER, 'popularity-tabs.active_tab': '50-75',
+    }, False),
+    ('callback.leaderboard', 'leaderboard-entity', ['leaderboard-genre.value'], {
+        'leaderboard-entity.value': 'album', 'leaderboard-genre.value': 'general_genres:Rock',
+        'leaderboard-bin-tabs.active_tab': '50-75',
+    }, False),
+]
+
+def run(size, repeat=5):
+    start = time.perf_counter()
+    import app as dashboard
+    imported = time.perf_counter() - start
+    # The data loads in the background after the import, the app is started once it is ready
+    dashboard.data_store.wait_ready()
+    startup = time.perf_counter() - start
+    results = [
+        {'name': name, 'size': size, 'repeat': 1, 'wall_s_min': round(seconds, 6),
+         'wall_s_median': round(seconds, 6), 'peak_mem_mb': None}
+        for name, seconds in [('app.import', imported), ('app.startup', startup)]
+    ]
+
+    client = dashboard.app.server.test_client()
+    callbacks = get_callbacks(client.get('/_dash-dependencies').get_json())
+
+    def post(input_id, changed_prop_ids, **overrides):
+        values = {**INITIAL_VALUES, **overrides}
+        payload = build_payload(callbacks[input_id], values, changed_prop_ids)
+        response = client.post(CALLBACK_PATH, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f'{input_id} callback failed with {response.status_code}')
+        return response
+
+    def response_size(response):
+        return len(response.get_data())
+
+    def clear_caches():
+        dashboard.cmp.figure_cache.clear()
+        dashboard.data_store.snapshot.cross_filter_index.clear()
+
+    for name, input_id, changed_prop_ids, overrides, cold in CASES:
+        results.append(measure(
+            name, size, lambda: post(input_id, changed_prop_ids, **overrides),
+            repeat=repeat, setup=clear_caches if cold else None, payload=response_size
+        ))
+    return results
+
+if __name__ == '__main__':
+    print(json.dumps(run(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 5)))
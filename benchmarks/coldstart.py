@@ -0,0 +1,119 @@
+"""Profile the cold start of the dashboard: the import time of each package and the data load.
+
+Starts ``--repeat`` fresh interpreters under ``python -X importtime``. Each imports app,
+waits until its data store is ready, then requests the page layout once. The report gives
+the median of every phase:
+
+- ``startup.import``: importing app, after which the server answers /health
+- ``startup.ready``: from the import to /ready answering 200, loading the data and warming up
+- ``startup.first_layout``: the first /_dash-layout request, on which Dash prepares itself
+
+and, as ``import.<package>`` records, the import time of the ``--top`` heaviest top-level
+packages, summed over their modules. The records are those of benchmarks.harness, so a
+run compared with ``--baseline`` flags regressions like benchmarks.run does:
+
+    DATA_DIR=/tmp/bench/data python -m benchmarks.coldstart --output coldstart.json
+    DATA_DIR=/tmp/bench/data python -m benchmarks.coldstart --baseline coldstart.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from benchmarks.harness import compare, environment
+from benchmarks.run import print_comparison
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ['startup.import', 'startup.ready', 'startup.first_layout']
+# Reports its phases as JSON on the last line of stdout
+CHILD_SCRIPT = '''
+import json
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.data_store.wait_ready()
+ready = time.perf_counter()
+app.server.test_client().get('/_dash-layout')
+laid_out = time.perf_counter()
+import polars as pl
+print(json.dumps({
+    'rows': app.data_store.snapshot.all_data_df.lazy().select(pl.len()).collect().item(),
+    'startup.import': imported - start,
+    'startup.ready': ready - imported,
+    'startup.first_layout': laid_out - ready,
+}))
+'''
+
+def parse_import_times(stderr):
+    """Return the seconds spent importing each top-level package, from ``-X importtime`` output."""
+    seconds = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            # The header line
+            continue
+        seconds[name.strip().split('.')[0]] += int(self_us) / 1e6
+    return seconds
+
+def run_cold_start():
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_SCRIPT],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True
+    )
+    return json.loads(completed.stdout.splitlines()[-1]), parse_import_times(completed.stderr)
+
+def to_record(name, size, samples):
+    return {
+        'name': name,
+        'size': size,
+        'repeat': len(samples),
+        'wall_s_min': round(min(samples), 6),
+        'wall_s_median': round(statistics.median(samples), 6),
+        'peak_mem_mb': None,
+    }
+
+def run(repeat=3, top=15):
+    runs = [run_cold_start() for _ in range(repeat)]
+    size = runs[0][0]['rows']
+    results = [to_record(phase, size, [phases[phase] for phases, _ in runs]) for phase in PHASES]
+    # Packages a run did not import, such as an optional one, count as zero there
+    packages = {package for _, import_times in runs for package in import_times}
+    import_records = [
+        to_record(f'import.{package}', size, [import_times.get(package, 0.0) for _, import_times in runs])
+        for package in packages
+    ]
+    import_records.sort(key=lambda record: record['wall_s_median'], reverse=True)
+    return results + import_records[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='number of packages whose import time is reported')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against the JSON results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown accepted before a phase counts as a regression')
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'results': run(args.repeat, args.top)}
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            rows = compare(results, json.load(baseline_file), args.tolerance)
+        print_comparison(rows)
+        if any(row['regression'] for row in rows):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Build the ``/_dash-update-component`` requests the browser sends for each callback."""
+
+CALLBACK_PATH = '/_dash-update-component'
+
+def split_output(output):
+    component_id, prop = output.rsplit('.', 1)
+    return {'id': component_id, 'property': prop}
+
+def get_callbacks(dependencies):
+    """Index the app's ``/_dash-dependencies`` by the id of the first input of each callback."""
+    callbacks = {}
+    for dependency in dependencies:
+        callbacks.setdefault(dependency['inputs'][0]['id'], dependency)
+    return callbacks
+
+def build_payload(dependency, values, changed_prop_ids):
+    """Return the JSON body for one callback.
+
+    ``values`` maps ``'component-id.property'`` to the current value of every input and
+    ``changed_prop_ids`` lists the ones that triggered the call.
+    """
+    output = dependency['output']
+    if output.startswith('..'):
+        outputs = [split_output(part) for part in output.strip('.').split('...')]
+    else:
+        outputs = split_output(output)
+    inputs = [
+        {**item, 'value': values.get(f"{item['id']}.{item['property']}")}
+        for item in dependency['inputs']
+    ]
+    state = [
+        {**item, 'value': values.get(f"{item['id']}.{item['property']}")}
+        for item in dependency.get('state', [])
+    ]
+    return {
+        'output': output,
+        'outputs': outputs,
+        'inputs': inputs,
+        'changedPropIds': list(changed_prop_ids),
+        'state': state,
+    }
@@ -0,0 +1,106 @@
+import gc
+import os
+import platform
+import statistics
+import threading
+import time
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def read_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+class PeakMemorySampler:
+    """Samples the process RSS in a background thread to find the peak during a block.
+
+    tracemalloc would miss polars and pyarrow, which allocate outside the Python heap.
+    """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        gc.collect()
+        self.baseline = self.peak = read_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, read_rss())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, read_rss())
+
+    @property
+    def peak_delta_mb(self):
+        return round((self.peak - self.baseline) / 2 ** 20, 2)
+
+def measure(name, size, function, repeat=5, setup=None, payload=None):
+    """Time ``function`` ``repeat`` times and return a result record.
+
+    ``setup`` runs untimed before each repetition, and ``payload(result)`` returns the
+    size in bytes of what the function produced, for callbacks that answer the browser.
+    """
+    timings = []
+    result = None
+    with PeakMemorySampler() as sampler:
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - start)
+    record = {
+        'name': name,
+        'size': size,
+        'repeat': repeat,
+        'wall_s_min': round(min(timings), 6),
+        'wall_s_median': round(statistics.median(timings), 6),
+        'peak_mem_mb': sampler.peak_delta_mb,
+    }
+    if payload is not None:
+        record['payload_bytes'] = payload(result)
+    return record
+
+def environment():
+    import pandas as pd
+    import polars as pl
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'polars': pl.__version__,
+        'pandas': pd.__version__,
+    }
+
+def compare(results, baseline, tolerance=0.25):
+    """Compare median wall time and payload size with a baseline run.
+
+    Returns one row per benchmark present in both runs. Rows whose time grew by more
+    than ``tolerance`` or whose payload grew at all are flagged as regressions.
+    """
+    baseline_records = {(record['name'], record['size']): record for record in baseline['results']}
+    rows = []
+    for record in results['results']:
+        previous = baseline_records.get((record['name'], record['size']))
+        if previous is None:
+            continue
+        time_ratio = record['wall_s_median'] / max(previous['wall_s_median'], 1e-9)
+        payload_grew = record.get('payload_bytes', 0) > previous.get('payload_bytes', 0)
+        rows.append({
+            'name': record['name'],
+            'size': record['size'],
+            'baseline_s': previous['wall_s_median'],
+            'current_s': record['wall_s_median'],
+            'time_ratio': round(time_ratio, 3),
+            'payload_bytes': record.get('payload_bytes'),
+            'regression': time_ratio > 1 + tolerance or payload_grew,
+        })
+    return rows
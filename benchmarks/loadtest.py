@@ -0,0 +1,235 @@
+"""Replay concurrent dashboard sessions against the app server and report callback latency.
+
+For every combination of ``--workers`` and ``--threads`` the app is started under
+benchmarks.server, or gunicorn with ``--server gunicorn``. Each ``--users`` count of
+simulated users then runs for ``--duration`` seconds, after ``--warmup`` seconds of the
+same traffic that fill the figure caches of every worker. A user loads the page, posts
+the initial callbacks, then keeps clicking a random tab of the metric, category and
+popularity tabs, posting the ``/_dash-update-component`` requests the browser sends
+for the click, with ``--think-time`` seconds between clicks on average. The report
+gives the throughput, latency percentiles and error rate of each callback per
+configuration. The throughput stops growing with the users at the saturation point.
+
+    DATA_DIR=/tmp/bench/data python -m benchmarks.loadtest --workers 1 2 4 --threads 1 4 --users 1 8 32
+
+The users run in threads of this process, so on a single machine they compete with the
+workers for the CPU. The callbacks must run inline, without BACKGROUND_CALLBACKS.
+"""
+import argparse
+import itertools
+import json
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import requests
+from benchmarks.callbacks import INITIAL_VALUES
+from benchmarks.dash_client import CALLBACK_PATH, build_payload, split_output
+from benchmarks.harness import environment
+
+CLICKED_TABS = ['metric-tabs', 'category-tabs', 'popularity-tabs']
+PAGE_REQUEST = 'page'
+
+def get_free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def start_server(server, workers, threads, port, timeout=300):
+    if server == 'gunicorn':
+        command = [
+            'gunicorn', '--workers', str(workers), '--threads', str(threads),
+            '--bind', f'127.0.0.1:{port}', 'app:server'
+        ]
+    else:
+        command = [
+            sys.executable, '-m', 'benchmarks.server', '--workers', str(workers), '--threads', str(threads),
+            '--port', str(port)
+        ]
+    process = subprocess.Popen(command)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{" ".join(command)} exited with status {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/ready', timeout=5).status_code == 200:
+                return process, base_url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f'{" ".join(command)} did not answer within {timeout} s')
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def find_tab_ids(component, tabs_id):
+    """Return the tab ids of the ``tabs_id`` Tabs in a ``/_dash-layout`` tree."""
+    if isinstance(component, list):
+        children = component
+    elif isinstance(component, dict) and 'props' in component:
+        props = component['props']
+        if props.get('id') == tabs_id:
+            return [tab['props']['tab_id'] for tab in props['children']]
+        children = props.get('children')
+    else:
+        return None
+    for child in children if isinstance(children, list) else [children]:
+        tab_ids = find_tab_ids(child, tabs_id)
+        if tab_ids is not None:
+            return tab_ids
+    return None
+
+def get_callback_name(dependency):
+    return split_output(dependency['output'].strip('.').split('...')[0])['id']
+
+class Session:
+    """One simulated user, holding the input values of its page."""
+    def __init__(self, base_url, dependencies, tab_ids, seed, think_time=0.0, timeout=30):
+        self.base_url = base_url
+        # Clientside callbacks run in the browser and never reach the server
+        self.dependencies = [dependency for dependency in dependencies if not dependency.get('clientside_function')]
+        self.tab_ids = tab_ids
+        self.random = random.Random(seed)
+        self.think_time = think_time
+        self.timeout = timeout
+        self.values = dict(INITIAL_VALUES)
+        self.http = requests.Session()
+
+    def request(self, records, name, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, f'{self.base_url}{path}', timeout=self.timeout, **kwargs)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        records.append((name, time.perf_counter() - start, ok))
+
+    def post_callbacks(self, records, changed_prop_id=None):
+        # The browser posts every callback an input feeds, and on page load all of them but
+        # those preventing their initial call
+        for dependency in self.dependencies:
+            input_ids = [f"{item['id']}.{item['property']}" for item in dependency['inputs']]
+            if changed_prop_id is None and dependency.get('prevent_initial_call'):
+                continue
+            if changed_prop_id is None or changed_prop_id in input_ids:
+                payload = build_payload(dependency, self.values, [] if changed_prop_id is None else [changed_prop_id])
+                self.request(records, get_callback_name(dependency), 'POST', CALLBACK_PATH, json=payload)
+
+    def load_page(self, records):
+        self.request(records, PAGE_REQUEST, 'GET', '/_dash-layout')
+        self.post_callbacks(records)
+
+    def click(self, records):
+        tabs_id = self.random.choice(CLICKED_TABS)
+        prop_id = f'{tabs_id}.active_tab'
+        self.values[prop_id] = self.random.choice([
+            tab_id for tab_id in self.tab_ids[tabs_id] if tab_id != self.values.get(prop_id)
+        ])
+        if tabs_id == 'popularity-tabs':
+            self.values['track-table.page_current'] = 0
+        self.post_callbacks(records, prop_id)
+
+    def run(self, records, deadline):
+        self.load_page(records)
+        while time.monotonic() < deadline:
+            if self.think_time > 0:
+                time.sleep(self.random.expovariate(1 / self.think_time))
+            self.click(records)
+
+def run_sessions(base_url, users, duration, think_time=0.0, seed=0):
+    """Run ``users`` concurrent sessions for ``duration`` seconds and return their requests."""
+    dependencies = requests.get(f'{base_url}/_dash-dependencies', timeout=30).json()
+    layout = requests.get(f'{base_url}/_dash-layout', timeout=30).json()
+    tab_ids = {tabs_id: find_tab_ids(layout, tabs_id) for tabs_id in CLICKED_TABS}
+    records = []
+    deadline = time.monotonic() + duration
+    sessions = [Session(base_url, dependencies, tab_ids, seed + user, think_time) for user in range(users)]
+    threads = [threading.Thread(target=session.run, args=(records, deadline)) for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+def get_percentile(sorted_values, q):
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+def summarize(records, duration):
+    latencies = sorted(latency for _, latency, _ in records)
+    errors = sum(not ok for _, _, ok in records)
+    summary = {
+        'requests': len(records),
+        'errors': errors,
+        'error_rate': round(errors / max(len(records), 1), 4),
+        'throughput_rps': round(len(records) / duration, 2),
+    }
+    if latencies:
+        summary.update({
+            'latency_ms_p50': round(get_percentile(latencies, 0.5) * 1000, 2),
+            'latency_ms_p90': round(get_percentile(latencies, 0.9) * 1000, 2),
+            'latency_ms_p99': round(get_percentile(latencies, 0.99) * 1000, 2),
+            'latency_ms_max': round(latencies[-1] * 1000, 2),
+        })
+    return summary
+
+def run_configuration(server, workers, threads, user_counts, duration, warmup, think_time):
+    process, base_url = start_server(server, workers, threads, get_free_port())
+    results = []
+    try:
+        for users in user_counts:
+            if warmup > 0:
+                run_sessions(base_url, users, warmup, think_time)
+            start = time.monotonic()
+            records = run_sessions(base_url, users, duration, think_time)
+            # Sessions finish the click they are in, so the run is a little longer than asked
+            elapsed = time.monotonic() - start
+            names = sorted({name for name, _, _ in records})
+            results.append({
+                'server': server,
+                'workers': workers,
+                'threads': threads,
+                'users': users,
+                'duration_s': round(elapsed, 2),
+                **summarize(records, elapsed),
+                'callbacks': {
+                    name: summarize([record for record in records if record[0] == name], elapsed)
+                    for name in names
+                },
+            })
+    finally:
+        stop_server(process)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds measured per user count')
+    parser.add_argument('--warmup', type=float, default=5.0, help='seconds of unmeasured traffic before each run')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds between the clicks of a user')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args()
+    results = []
+    for workers, threads in itertools.product(args.workers, args.threads):
+        results.extend(run_configuration(
+            args.server, workers, threads, args.users, args.duration, args.warmup, args.think_time
+        ))
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Measure the cost the callback instrumentation adds per tracked callback and stage.
+
+    python -m benchmarks.metrics_overhead
+"""
+import json
+import time
+import metrics
+
+def time_loop(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+def bare_callback():
+    pass
+
+def tracked_callback(metrics_registry):
+    with metrics.track('benchmark', 'inputs', metrics_registry) as timer:
+        with timer.stage('first'):
+            pass
+        with timer.stage('second'):
+            pass
+
+def main(iterations=100_000):
+    metrics_registry = metrics.MetricsRegistry()
+    bare = time_loop(bare_callback, iterations)
+    tracked = time_loop(lambda: tracked_callback(metrics_registry), iterations)
+    start = time.perf_counter()
+    exposition = metrics_registry.to_prometheus()
+    render = time.perf_counter() - start
+    print(json.dumps({
+        'iterations': iterations,
+        'overhead_per_callback_us': round((tracked - bare) * 1e6, 2),
+        'overhead_per_stage_us': round((tracked - bare) * 1e6 / 3, 2),
+        'metrics_render_ms': round(render * 1000, 3),
+        'metrics_bytes': len(exposition),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Report the bytes and serialization time of each callback response, per encoding.
+
+Posts the cases of benchmarks.callbacks once without compression and once per encoding
+the server offers, and reports the size of each response body. Then times serializing
+the response with plotly's json engine, which Dash falls back to, and with orjson. Table
+pages are also measured as row records, the layout DataTable displays. Run it before and
+after a change to compare:
+
+    DATA_DIR=/tmp/bench/data python -m benchmarks.payloads
+"""
+import json
+import sys
+from plotly.io.json import to_json_plotly
+from benchmarks.callbacks import CASES, INITIAL_VALUES
+from benchmarks.dash_client import CALLBACK_PATH, build_payload, get_callbacks
+from benchmarks.harness import measure
+
+ENCODINGS = ['identity', 'gzip', 'br']
+
+def to_rows(page):
+    columns = list(page)
+    return [dict(zip(columns, values)) for values in zip(*page.values())]
+
+def run(repeat=20):
+    import app as dashboard
+    client = dashboard.app.server.test_client()
+    callbacks = get_callbacks(client.get('/_dash-dependencies').get_json())
+    results = []
+    for name, input_id, changed_prop_ids, overrides, _ in CASES:
+        payload = build_payload(callbacks[input_id], {**INITIAL_VALUES, **overrides}, changed_prop_ids)
+        record = {'name': name}
+        for encoding in ENCODINGS:
+            response = client.post(CALLBACK_PATH, json=payload, headers={'Accept-Encoding': encoding})
+            if response.status_code != 200:
+                raise RuntimeError(f'{name} failed with {response.status_code}')
+            # Encodings the server does not offer come back uncompressed and are left out
+            if response.headers.get('Content-Encoding', 'identity') == encoding:
+                record[f'{encoding}_bytes'] = len(response.get_data())
+            if encoding == 'identity':
+                body = json.loads(response.get_data())
+        for engine in ['json', 'orjson']:
+            timing = measure(name, None, lambda: to_json_plotly(body, engine=engine), repeat=repeat)
+            record[f'serialize_{engine}_ms'] = round(timing['wall_s_median'] * 1000, 3)
+        page = body['response'].get('table-page', {}).get('data')
+        if page is not None:
+            rows_body = {**body, 'response': {**body['response'], 'table-page': {'data': to_rows(page)}}}
+            record['identity_bytes_as_rows'] = len(to_json_plotly(rows_body))
+        results.append(record)
+    return results
+
+if __name__ == '__main__':
+    print(json.dumps(run(int(sys.argv[1]) if len(sys.argv) > 1 else 20), indent=2))
@@ -0,0 +1,185 @@
+"""Benchmark the data operations, prepare.py and the dashboard callbacks on synthetic data.
+
+Generates raw exports of each requested size, runs the pandas preparation steps one by
+one, the polars engine as a whole and the sharded engine on the export split in files,
+times the operations the callbacks rely on, then starts the app on the prepared data and
+times its callbacks. Runs fully offline.
+
+    python -m benchmarks.run --sizes 100000 1000000 --output bench.json
+    python -m benchmarks.run --sizes 100000 --baseline bench.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import polars as pl
+import prepare
+from benchmarks.harness import compare, environment, measure
+from benchmarks.synthetic import generate_raw_tracks
+from operations import (
+    CATEGORY_COLUMNS, aggregate_popularity_bins, build_category_cube, build_popularity_sums, calculate_difference,
+    count_by_category, get_popularity_bins
+)
+from rollups import ENTITIES, build_leaderboards, build_rollup
+from storage import DATA_DIR, GENRE_MAP, get_table_path
+from utils import get_avg_metrics
+
+# Files the sharded engine reads each synthetic export from
+SHARDS = 4
+
+def bench_pandas_steps(raw_path, map_path, size, repeat):
+    import pandas as pd
+    genre_map_df = pd.read_csv(map_path)
+    df = pd.read_csv(raw_path, float_precision='round_trip').rename(columns={'track_genre': 'genre'})
+    steps = [
+        ('drop_duplicates', prepare.drop_duplicates),
+        ('combine_duplicates', prepare.combine_duplicates),
+        ('convert_duration_column_to_min', prepare.convert_duration_column_to_min),
+        ('convert_bool_to_string', lambda df: prepare.convert_bool_to_string(df, 'explicit')),
+        ('map_genre', lambda df: prepare.map_genre(df, genre_map_df)),
+        ('format_artist_name', lambda df: prepare.format_artist_name(df, 'artists')),
+        ('create_histogram_data', lambda df: prepare.create_histogram_data(df, 'popularity')),
+    ]
+    results = []
+    for name, step in steps:
+        # Steps mutate their input in place, so each repetition gets a fresh copy
+        copies = []
+        record = measure(
+            f'prepare.pandas.{name}', size, lambda: step(copies.pop()),
+            repeat=repeat, setup=lambda: copies.append(df.copy())
+        )
+        results.append(record)
+        if name != 'create_histogram_data':
+            df = step(df.copy())
+    return results
+
+def bench_operations(prepared_df, size, repeat):
+    popularity_sums_df = build_popularity_sums(prepared_df)
+    histogram_df = aggregate_popularity_bins(popularity_sums_df, get_popularity_bins(bin_width=25))
+    overall_metrics = aggregate_popularity_bins(popularity_sums_df, get_popularity_bins(bin_width=101)).row(0, named=True)
+    metric_columns = ['count'] + prepare.HISTOGRAM_METRICS[1:]
+    results = [
+        measure(f'operations.count_by_category.{category}', size,
+                lambda category=category: count_by_category(prepared_df, category), repeat=repeat)
+        for category in CATEGORY_COLUMNS
+    ]
+    results.append(measure('operations.build_category_cube', size, lambda: build_category_cube(prepared_df), repeat=repeat))
+    results.append(measure('operations.build_popularity_sums', size, lambda: build_popularity_sums(prepared_df), repeat=repeat))
+    for entity in ENTITIES:
+        results.append(measure(
+            f'rollups.build_rollup.{entity}', size, lambda entity=entity: build_rollup(prepared_df, entity), repeat=repeat
+        ))
+        results.append(measure(
+            f'rollups.build_leaderboards.{entity}', size, lambda entity=entity: build_leaderboards(prepared_df, entity),
+            repeat=1
+        ))
+    for bin_width in (25, 1):
+        results.append(measure(
+            f'operations.aggregate_popularity_bins.width_{bin_width}', size,
+            lambda bin_width=bin_width: aggregate_popularity_bins(popularity_sums_df, get_popularity_bins(bin_width=bin_width)),
+            repeat=repeat
+        ))
+    results.append(measure(
+        'operations.calculate_difference', size,
+        lambda: calculate_difference(histogram_df, 'energy', overall_metrics['energy']), repeat=repeat
+    ))
+    results.append(measure(
+        'utils.get_avg_metrics', size,
+        lambda: get_avg_metrics(metric_columns, overall_metrics, histogram_df), repeat=repeat
+    ))
+    return results
+
+def bench_callbacks(data_dir, size, repeat):
+    env = {**os.environ, 'DATA_DIR': data_dir}
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.callbacks', str(size), str(repeat)],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def bench_size(size, engines, repeat, work_dir):
+    data_dir = os.path.join(work_dir, f'data_{size}')
+    os.makedirs(data_dir, exist_ok=True)
+    map_path = get_table_path(GENRE_MAP, 'csv', data_dir)
+    shutil.copy(get_table_path(GENRE_MAP, 'csv', DATA_DIR), map_path)
+    raw_path = os.path.join(work_dir, f'raw_{size}.csv')
+    raw_df = generate_raw_tracks(size, pl.read_csv(map_path)['genre'])
+    raw_df.write_csv(raw_path)
+
+    results = []
+    if 'pandas' in engines:
+        results.extend(bench_pandas_steps(raw_path, map_path, size, repeat))
+        results.append(measure(
+            'prepare.pandas.total', size, lambda: prepare.prepare_with_pandas(raw_path, map_path), repeat=1
+        ))
+    results.append(measure(
+        'prepare.polars.total', size, lambda: prepare.prepare_with_polars(raw_path, map_path), repeat=1
+    ))
+    if 'sharded' in engines:
+        shard_paths = []
+        for shard, shard_df in enumerate(raw_df.iter_slices(-(-size // SHARDS))):
+            shard_paths.append(os.path.join(work_dir, f'raw_{size}_{shard}.csv'))
+            shard_df.write_csv(shard_paths[-1])
+        stages_dir = os.path.join(work_dir, f'stages_{size}')
+        results.append(measure(
+            'prepare.sharded.total', size, lambda: prepare.prepare_with_shards(shard_paths, map_path, stages_dir),
+            repeat=1, setup=lambda: shutil.rmtree(stages_dir, ignore_errors=True)
+        ))
+        # A rerun on unchanged shards reads the checkpoint of the merge
+        results.append(measure(
+            'prepare.sharded.resume', size, lambda: prepare.prepare_with_shards(shard_paths, map_path, stages_dir),
+            repeat=1
+        ))
+    prepare.prepare(engine='polars', input_file_path=raw_path, data_dir=data_dir)
+    prepared_df = pl.read_ipc(get_table_path(prepare.PREPARED_DATA, 'arrow', data_dir))
+    results.extend(bench_operations(prepared_df, size, repeat))
+    results.extend(bench_callbacks(data_dir, size, repeat))
+    return results
+
+def print_comparison(rows):
+    for row in rows:
+        flag = 'REGRESSION' if row['regression'] else ''
+        print(f"{row['name']:<48} {row['size']:>10} {row['baseline_s']:>11.6f}s {row['current_s']:>11.6f}s "
+              f"x{row['time_ratio']:<7} {flag}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000])
+    parser.add_argument('--engines', nargs='+', default=['pandas', 'polars', 'sharded'], choices=['pandas', 'polars', 'sharded'],
+                        help='prepare.py engines to time; pandas is slow beyond a few million rows')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against the JSON results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown accepted before a benchmark counts as a regression')
+    parser.add_argument('--work-dir', help='keep the generated data in this directory instead of a temporary one')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='spotify-bench-')
+    try:
+        results = {'environment': environment(), 'results': []}
+        for size in args.sizes:
+            results['results'].extend(bench_size(size, args.engines, args.repeat, work_dir))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            rows = compare(results, json.load(baseline_file), args.tolerance)
+        print_comparison(rows)
+        if any(row['regression'] for row in rows):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Serve the dashboard with a fixed number of worker processes and threads per worker.
+
+Binds the port once, then forks the workers, which all accept connections on the same
+socket like gunicorn's workers. Each worker loads the app after the fork and answers
+requests on a pool of ``--threads`` threads. Stands in for gunicorn in the load test
+where it is not installed.
+
+    DATA_DIR=/tmp/bench/data python -m benchmarks.server --workers 4 --threads 2 --port 8050
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+
+class ThreadPoolServer(BaseWSGIServer):
+    """Werkzeug server answering requests on a fixed pool of threads.
+
+    Connections are closed after each response, HTTP/1.0 style, so an idle client never
+    holds a thread of the pool.
+    """
+    def __init__(self, *args, threads=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+def run_worker(listener, threads):
+    # Request lines would cost the workers more than some callbacks
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    import app as dashboard
+    host, port = listener.getsockname()[:2]
+    server = ThreadPoolServer(host, port, dashboard.server, fd=listener.fileno(), threads=threads)
+    server.serve_forever()
+
+def serve(workers, threads, host='127.0.0.1', port=8050):
+    listener = socket.create_server((host, port), backlog=1024)
+    # Forked before the app is imported, so no worker inherits the data loading threads
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(listener, threads)
+            finally:
+                os._exit(1)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    args = parser.parse_args()
+    serve(args.workers, args.threads, args.host, args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Compare dashboard data loading from CSV and from memory-mapped Arrow IPC.
+
+Starts N concurrent worker processes per format, like N gunicorn workers, and reports
+for each worker the load time, the resident set size and the proportional set size.
+PSS splits shared pages between the processes mapping them, so its total is the real
+memory cost of running N workers.
+
+    python -m benchmarks.startup --workers 4
+"""
+import argparse
+import json
+import multiprocessing as mp
+import statistics
+import time
+
+MEMORY_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Private_Clean', 'Private_Dirty')
+
+def read_memory_usage():
+    usage = {}
+    with open('/proc/self/smaps_rollup') as smaps:
+        for line in smaps:
+            field, _, value = line.partition(':')
+            if field in MEMORY_FIELDS:
+                usage[f'{field.lower()}_mb'] = round(int(value.split()[0]) / 1024, 1)
+    return usage
+
+def run_worker(file_format, data_dir, barrier, results):
+    start = time.perf_counter()
+    import polars as pl
+    from storage import load_prepared_data
+    imported = time.perf_counter()
+    df = load_prepared_data(data_dir, file_format)
+    # Touch every column like the callbacks eventually do, so lazily mapped pages count
+    df.select(pl.all().null_count()).sum_horizontal()
+    loaded = time.perf_counter()
+    barrier.wait()
+    results.put({
+        'import_s': round(imported - start, 3),
+        'load_s': round(loaded - imported, 3),
+        **read_memory_usage(),
+    })
+    barrier.wait()
+
+def run_format(file_format, workers, data_dir):
+    context = mp.get_context('spawn')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=run_worker, args=(file_format, data_dir, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    samples = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return {
+        'format': file_format,
+        'workers': workers,
+        'load_s_median': statistics.median(sample['load_s'] for sample in samples),
+        'rss_mb_total': round(sum(sample['rss_mb'] for sample in samples), 1),
+        'pss_mb_total': round(sum(sample['pss_mb'] for sample in samples), 1),
+        'private_mb_total': round(sum(sample['private_clean_mb'] + sample['private_dirty_mb'] for sample in samples), 1),
+        'samples': samples,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--formats', nargs='+', default=['csv', 'ipc'], choices=['csv', 'ipc'])
+    args = parser.parse_args()
+    report = [run_format(file_format, args.workers, args.data_dir) for file_format in args.formats]
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
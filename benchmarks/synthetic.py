@@ -0,0 +1,73 @@
+"""Synthetic Spotify track exports shaped like the raw dataset that prepare.py reads.
+
+About a fifth of the rows repeat an earlier track under another genre, the way the
+Kaggle export lists one row per (track, genre), so the dedupe and genre combination
+steps have real work to do. Everything is generated offline from a seed.
+"""
+import numpy as np
+import polars as pl
+
+WORDS = [
+    'love', 'night', 'rock', 'blue', 'dream', 'fire', 'heart', 'city', 'sun', 'rain', 'baby', 'dance',
+    'road', 'star', 'time', 'gold', 'wild', 'home', 'light', 'river', 'ghost', 'summer', 'money', 'angel',
+]
+TIME_SIGNATURES = [0, 1, 3, 4, 5]
+TIME_SIGNATURE_WEIGHTS = [0.002, 0.01, 0.08, 0.89, 0.018]
+
+def pick_words(rng, size, count):
+    words = pl.Series(WORDS)
+    parts = [words.gather(rng.integers(0, len(WORDS), size)) for _ in range(count)]
+    return pl.concat_str(parts, separator=' ', ignore_nulls=False)
+
+def generate_raw_tracks(rows, genres, seed=0, repeat_share=0.2):
+    """Return a polars frame with ``rows`` rows in the raw dataset's columns and dtypes."""
+    rng = np.random.default_rng(seed)
+    track_count = max(1, int(rows * (1 - repeat_share)))
+    track_index = np.concatenate([
+        np.arange(track_count),
+        rng.integers(0, track_count, rows - track_count),
+    ])
+    rng.shuffle(track_index)
+    artist_count = max(10, track_count // 20)
+    first_artist = rng.integers(0, artist_count, track_count)
+    featured_artist = np.where(rng.random(track_count) < 0.12, rng.integers(0, artist_count, track_count), -1)
+    genres = pl.Series(genres)
+
+    tracks = pl.DataFrame({
+        'track_number': np.arange(track_count),
+        'first_artist': first_artist,
+        'featured_artist': featured_artist,
+        'popularity': np.clip(rng.gamma(2.2, 15, track_count), 0, 100).astype(np.int64),
+        'duration_ms': rng.integers(30_000, 600_000, track_count),
+        'explicit': rng.random(track_count) < 0.09,
+        'danceability': rng.beta(5, 4, track_count),
+        'energy': rng.beta(3, 2, track_count),
+        'key': rng.integers(0, 12, track_count),
+        'loudness': -rng.gamma(2.5, 3.3, track_count),
+        'mode': rng.integers(0, 2, track_count),
+        'speechiness': rng.beta(1, 10, track_count),
+        'acousticness': rng.beta(1, 2, track_count),
+        'instrumentalness': rng.beta(0.3, 1.5, track_count),
+        'liveness': rng.beta(2, 8, track_count),
+        'valence': rng.beta(2.5, 2.5, track_count),
+        'tempo': rng.normal(122, 30, track_count).clip(40, 240),
+        'time_signature': rng.choice(TIME_SIGNATURES, track_count, p=TIME_SIGNATURE_WEIGHTS),
+    }).with_columns(
+        track_id=pl.format('trk{}', pl.col('track_number').cast(pl.Utf8).str.zfill(19)),
+        track_name=pick_words(rng, track_count, 2),
+        album_name=pick_words(rng, track_count, 2).str.to_titlecase(),
+        artists=pl.when(pl.col('featured_artist') >= 0)
+        .then(pl.format('Artist {};Artist {}', 'first_artist', 'featured_artist'))
+        .otherwise(pl.format('Artist {}', 'first_artist')),
+    )
+    raw_df = (
+        tracks[track_index]
+        .with_columns(track_genre=genres.gather(rng.integers(0, len(genres), rows)))
+        .with_row_index('Unnamed: 0')
+        .with_columns(pl.col('Unnamed: 0').cast(pl.Int64))
+    )
+    return raw_df.select([
+        'Unnamed: 0', 'track_id', 'artists', 'album_name', 'track_name', 'popularity', 'duration_ms',
+        'explicit', 'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+        'instrumentalness', 'liveness', 'valence', 'tempo', 'time_signature', 'track_genre',
+    ])
@@ -1,7 +1,11 @@
+import threading
+from collections import OrderedDict
 from dash import html, dash_table
 import dash_bootstrap_components as dbc
-import plotly.express as px
+import numpy as np
+import orjson
 import plotly.graph_objects as go
+from plotly.io.json import to_json_plotly
 from utils import format_label, convert_hex_to_rgba
 import polars as pl
 
@@ -52,19 +56,25 @@ def create_card(text_id, title_id=None):
     )
     return card
 
-def create_difference_text(popularity_bin, difference, metric):
+def create_difference_text(popularity_bin, difference, metric, most_popular):
     difference_style = {
         'color': PRIMARY_COLOR,
         'font-weight': 'bold',
         'font-size': '18px'
     }
 
-    first_sentence = ''
-    if popularity_bin == '0-25':
-        first_sentence = f"Least popular tracks ({popularity_bin}) have"
-    elif popularity_bin == '75-100':
+    if most_popular:
         first_sentence = f"Most popular tracks ({popularity_bin}) have"
+    else:
+        first_sentence = f"Least popular tracks ({popularity_bin}) have"
     
+    if difference is None:
+        return html.Div([
+            html.H6(first_sentence),
+            html.Span(' N/A', style=difference_style),
+            html.H6(f" difference in {format_label(metric).lower()} from an overall average of 0.")
+        ])
+
     comparison_text = ''
     if difference > 0:
         comparison_text = f" {difference}% higher"
@@ -79,19 +89,25 @@ def create_difference_text(popularity_bin, difference, metric):
         html.H6(f" {format_label(metric).lower()} than the overall average.")
     ])
 
+def get_axis_range(values):
+    # Empty bins have a null mean, which must not turn the range into NaN
+    values = np.concatenate([np.asarray(trace_values, dtype=float).ravel() for trace_values in values if trace_values is not None])
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return None
+    return [min(0, values.min() * 1.20), max(0, values.max() * 1.20)]
+
 def style_fig(fig, axis='y'):
     if axis == 'y':
-        y_min = min([trace.y.min() for trace in fig.data])
-        y_max = max([trace.y.max() for trace in fig.data])
-        fig.update_yaxes(range=[min(0, y_min * 1.20), y_max * 1.20])
+        y_range = get_axis_range([trace.y for trace in fig.data])
+        if y_range is not None:
+            fig.update_yaxes(range=y_range)
 
     elif axis == 'x':
-        x_min = min([trace.x.min() for trace in fig.data])
-        x_max = max([trace.x.max() for trace in fig.data])
-        fig.update_xaxes(
-            range=[min(0, x_min * 1.20), x_max * 1.20],
-            showticklabels=False
-        )
+        x_range = get_axis_range([trace.x for trace in fig.data])
+        fig.update_xaxes(showticklabels=False)
+        if x_range is not None:
+            fig.update_xaxes(range=x_range)
         
     fig.update_layout(
         title={
@@ -138,22 +154,31 @@ def style_fig(fig, axis='y'):
         )
     )
 
-def create_custom_histogram(df, x, y):
+def create_custom_histogram(df, x, y, change=False):
     title = f'Average {format_label(y)} by Popularity' if y != 'count' else 'Track Count by Popularity'
     x_label = format_label(x)
     y_label = f'Average {format_label(y)}' if y != 'count' else 'Count'
     if y == 'duration_min':
         y_label += ' (min)'
+    if change:
+        title = f'Change in {title} vs Previous Snapshot'
+        y_label = f'Change in {y_label}'
 
-    fig = px.bar(
-        df, 
-        x=x, 
-        y=y, 
-        color_discrete_sequence=[PRIMARY_COLOR], 
-        title=title, 
-        labels={x: x_label, y: y_label},
+    # graph_objects rather than plotly.express, which imports pandas and converts the frame to it
+    fig = go.Figure(go.Bar(
+        x=df[x].to_numpy(),
+        y=df[y].to_numpy(),
+        marker_color=PRIMARY_COLOR,
+        name='',
+        showlegend=False
+    ))
+    fig.update_layout(
+        title=title,
+        xaxis_title=x_label,
+        yaxis_title=y_label,
+        barmode='relative',
         template='plotly_dark'
-        )
+    )
     
     style_fig(fig)
     
@@ -194,8 +219,13 @@ def create_butterfly_chart(df, x1, x2, y):
         )
     )
     for trace in fig.data:
+        # Left bars are drawn negative but labelled with their share, as a number per bar
+        # and one template rather than a label string per bar
+        if trace.x.min() < 0:
+            trace.update(text=np.round(np.abs(trace.x), 2), texttemplate='<b>%{text}%</b>')
+        else:
+            trace.update(texttemplate='%{x:.1f}%')
         trace.update(
-            texttemplate=['<b>{}%</b>'.format(abs(round(x, 2))) if x < 0 else '{:.1f}%'.format(x) for x in trace.x],
             textposition='outside',
             textfont=dict(
                 size=16,
@@ -230,10 +260,198 @@ def create_butterfly_chart(df, x1, x2, y):
 
     return fig
 
-def create_table(df):
+def create_share_change_chart(df, x1, x2, y):
+    title = f'Change in Track Share by {format_label(y)} vs Previous Snapshot'
+    fig = go.Figure()
+    for x, color in [(x1, PRIMARY_COLOR), (x2, SECONDARY_COLOR)]:
+        fig.add_trace(go.Bar(
+            x=df[x],
+            y=df[y],
+            orientation='h',
+            name=format_label(x),
+            marker=dict(color=color),
+            texttemplate='%{x:+.2f} pp',
+            textposition='outside',
+            textfont=dict(
+                size=16,
+                color=color,
+                family='Arial, sans-serif',
+                weight='bold'
+            ),
+            hovertemplate='%{y}'
+            )
+        )
+
+    fig.update_layout(
+        title=title,
+        barmode='group',
+        xaxis=dict(showgrid=False, zeroline=True),
+        yaxis=dict(showgrid=False),
+        bargap=0.1,
+        template='plotly_dark',
+        legend=dict(
+            orientation='h',
+            yanchor='bottom',
+            y=1.02,
+            xanchor='right',
+            x=1,
+            font=dict(
+                size=14,
+            )
+        )
+    )
+
+    style_fig(fig, axis='x')
+
+    return fig
+
+def highlight_points(fig, positions):
+    """Dim every bar of ``fig`` but those at ``positions``, the ones selected by a click."""
+    fig.update_traces(selectedpoints=positions, unselected={'marker': {'opacity': 0.35}})
+    return fig
+
+def create_box_chart(df, x, y, horizontal=False):
+    """Draw the quantiles in ``df`` as boxes from p25 to p75 around the median, with whiskers from p5 to p95."""
+    title = f'{format_label(y)} Distribution by {format_label(x)}'
+    y_label = format_label(y)
+    if y == 'duration_min':
+        y_label += ' (min)'
+    df = df.filter(pl.col('count') > 0)
+    # Quantiles estimated from sketches come with their error bound, exact ones without
+    error_columns = [col for col in df.columns if col.endswith('_error')]
+    error = df.select(pl.max_horizontal(error_columns).max()).item() if df.height and error_columns else None
+    if error is not None:
+        title += f'<br><sup>Quantiles within ±{error:.3g} of the exact values</sup>'
+
+    positions = {'y': df[x], 'orientation': 'h'} if horizontal else {'x': df[x]}
+    fig = go.Figure(go.Box(
+        **positions,
+        q1=df['p25'],
+        median=df['p50'],
+        q3=df['p75'],
+        lowerfence=df['p5'],
+        upperfence=df['p95'],
+        name=y_label,
+        marker=dict(color=PRIMARY_COLOR),
+        fillcolor=PRIMARY_COLOR_RGBA,
+        line=dict(color=PRIMARY_COLOR)
+    ))
+    value_axis = dict(title=y_label)
+    category_axis = dict(title=format_label(x), type='category')
+    fig.update_layout(
+        title=title,
+        template='plotly_dark',
+        showlegend=False,
+        xaxis=value_axis if horizontal else category_axis,
+        yaxis=category_axis if horizontal else value_axis
+    )
+
+    style_fig(fig, axis=None)
+
+    return fig
+
+def to_compact_json(fig):
+    """Serialize ``fig`` in fewer bytes than ``fig.to_json()``, with orjson.
+
+    The template keeps the defaults of the trace types the figure draws only, which
+    drops most of its size, and float arrays are written at float32 precision, far
+    beyond what a chart or its labels show.
+    """
+    fig_dict = fig.to_dict()
+    template = fig_dict['layout'].get('template')
+    if template is not None:
+        trace_types = {trace.get('type', 'scatter') for trace in fig_dict['data']}
+        template['data'] = {
+            trace_type: defaults for trace_type, defaults in template.get('data', {}).items()
+            if trace_type in trace_types
+        }
+    for trace in fig_dict['data']:
+        for key, value in trace.items():
+            if isinstance(value, np.ndarray) and value.dtype == np.float64:
+                trace[key] = value.astype(np.float32)
+    return to_json_plotly(fig_dict, engine='orjson')
+
+class FigureCache:
+    """Bounded LRU cache of serialized figures keyed by (kind, params, data version).
+
+    Entries are stored as compact figure JSON and their size is accounted in characters,
+    so the cache holds at most ``max_size`` characters of figures. A hit costs a dict
+    lookup and an ``orjson.loads``, instead of building and validating the plotly figure
+    again.
+    """
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_figure(self, kind, params, data_version, builder, *args, **kwargs):
+        key = (kind, params, data_version)
+        with self._lock:
+            fig_json = self._entries.get(key)
+            if fig_json is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if fig_json is None:
+            fig_json = to_compact_json(builder(*args, **kwargs))
+            self._store(key, fig_json)
+        return orjson.loads(fig_json)
+
+    def _store(self, key, fig_json):
+        with self._lock:
+            self.misses += 1
+            if key in self._entries or len(fig_json) > self.max_size:
+                return
+            self._entries[key] = fig_json
+            self.size += len(fig_json)
+            while self.size > self.max_size:
+                _, evicted_json = self._entries.popitem(last=False)
+                self.size -= len(evicted_json)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+figure_cache = FigureCache()
+
+def create_table_columns(schema):
+    return [
+        {'name': format_label(col), 'id': col, 'type': 'numeric' if dtype.is_numeric() else 'text'}
+        for col, dtype in schema.items()
+    ]
+
+def create_table(df, table_id='track-table', page_action='native', page_size=10, sort_action=None, filter_action=None):
+    # Rows are served by a callback, page by page when custom, only the schema is needed
+    # then. Native tables page through the rows they are given in the browser
+    data = df.to_dicts() if page_action == 'native' else []
+    columns = create_table_columns(df.schema)
+    table_options = {}
+    if page_action == 'custom':
+        table_options = {
+            'page_current': 0,
+            'page_count': 0,
+            'sort_action': 'custom',
+            'sort_mode': 'multi',
+            'sort_by': [],
+            'filter_action': 'custom',
+            'filter_query': '',
+        }
+    # Overrides the sorting and filtering of the page action, such as for pages that are
+    # exported and cannot be queried
+    if sort_action is not None:
+        table_options['sort_action'] = sort_action
+    if filter_action is not None:
+        table_options['filter_action'] = filter_action
     table = dash_table.DataTable(
-                data=df.to_dict('records'),
-                columns=[{'name': format_label(col), 'id': col} for col in df.columns],
+                id=table_id,
+                data=data,
+                columns=columns,
                 style_header={
                     'backgroundColor': PRIMARY_COLOR,
                     'color': '#FFF',
@@ -266,8 +484,14 @@ def create_table(df):
                     'border': '1px solid #ccc',
                 },
 
-                page_size=10,
+                style_filter={
+                    'backgroundColor': BACKGROUND_COLOR,
+                    'color': '#FFF',
+                },
+                page_action=page_action,
+                page_size=page_size,
                 style_as_list_view=True,
+                **table_options
             )
     return table
     
@@ -0,0 +1,73 @@
+"""Compression of the server's responses, negotiated per request.
+
+Responses are compressed with brotli when the browser accepts it and the ``brotli``
+package is installed, and with gzip otherwise. Callback responses are JSON with the same
+keys and template over and over, so they shrink to a fifth or less. The component
+scripts Dash serves do not change while the server runs, so each is compressed once per
+encoding and kept.
+"""
+import gzip
+import os
+import threading
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'text/')
+# Below this, compressing takes longer than sending the few bytes it saves
+MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Quality 5 compresses about as fast as gzip level 6, and smaller
+BROTLI_QUALITY = 5
+STATIC_PREFIX = '/_dash-component-suites/'
+
+def get_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+class ResponseCompressor:
+    def __init__(self, min_size=MIN_SIZE):
+        self.min_size = min_size
+        self.static_cache = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, response):
+        if (
+            response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)
+        ):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(get_encodings())
+        data = response.get_data()
+        if encoding is None or len(data) < self.min_size:
+            return response
+        if request.path.startswith(STATIC_PREFIX):
+            key = (request.path, encoding)
+            with self._lock:
+                compressed = self.static_cache.get(key)
+            if compressed is None:
+                compressed = compress(data, encoding)
+                with self._lock:
+                    self.static_cache[key] = compressed
+        else:
+            compressed = compress(data, encoding)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+def install(server, min_size=MIN_SIZE):
+    """Compress the responses of the Flask server, unless RESPONSE_COMPRESSION is set to 0.
+
+    Turn it off when a proxy in front of the app compresses already.
+    """
+    if os.environ.get('RESPONSE_COMPRESSION', '1') == '0':
+        return
+    server.after_request(ResponseCompressor(min_size))
@@ -0,0 +1,206 @@
+"""Cross-filtering of the dashboard views by the bars clicked on their charts.
+
+A cross filter is a list of ``(dimension, value)`` pairs in the order they were clicked.
+The popularity dimension holds a ``(start, end)`` range of the histogram, ``end``
+excluded, and a category column holds one of its values as text. Each view applies every
+pair but those on its own dimension, so the chart a bar was clicked on keeps showing the
+bars around it.
+
+The tracks passing a filter are kept as their sorted row positions in the tracks frame.
+They are derived from the positions of the same filter without its last pair, testing
+the last predicate on those rows only, so clicking one more bar narrows down the tracks
+already selected instead of filtering every track again. The aggregates the views read
+off a selection are cached next to it.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+import polars as pl
+from operations import (
+    ALL, CUBE_METRICS, build_genre_filter, build_popularity_sums, count_by_category, filter_by_bin, get_bin_bounds,
+    get_genre_mask_columns, is_multi_valued
+)
+from sketches import QUANTILES, get_quantile_name
+
+POPULARITY = 'popularity'
+# Selections hold up to 4 bytes per track, aggregates a few hundred rows at most
+MAX_SELECTIONS = 16
+MAX_AGGREGATES = 256
+
+def normalize_filters(cross_filter, exclude=None):
+    """Return the pairs of a cross filter from the browser as a hashable tuple, without those on ``exclude``."""
+    return tuple(
+        (dimension, tuple(value) if dimension == POPULARITY else str(value))
+        for dimension, value in cross_filter or []
+        if dimension != exclude
+    )
+
+def toggle_filter(cross_filter, dimension, value):
+    """Return the cross filter with ``value`` selected on ``dimension``, or unselected when it was.
+
+    A dimension holds one value, a new one replaces it and moves to the end, so it is
+    applied to the tracks selected by the others.
+    """
+    kept = [[kept_dimension, kept_value] for kept_dimension, kept_value in cross_filter or [] if kept_dimension != dimension]
+    if [dimension, value] in (cross_filter or []):
+        return kept
+    return kept + [[dimension, value]]
+
+def describe_filter(dimension, value):
+    if dimension == POPULARITY:
+        start, end = value
+        return f'Popularity {start}-{end - 1}'
+    return f"{dimension.replace('_', ' ').title()}: {value}"
+
+def slice_rows(df, positions):
+    # Popularity ranges select a contiguous run of rows, which is sliced without copying
+    if len(positions) and positions[-1] - positions[0] + 1 == len(positions):
+        return df.slice(int(positions[0]), len(positions))
+    return df[positions]
+
+class CrossFilterIndex:
+    """Selections of the tracks of one DataSnapshot under cross filters, and their aggregates.
+
+    With the lazy data backend the tracks are not in memory, so the predicates are pushed
+    into the scans and only the aggregates are cached.
+    """
+    def __init__(self, all_data_df, genre_names, max_selections=MAX_SELECTIONS, max_aggregates=MAX_AGGREGATES):
+        self.all_data_df = all_data_df
+        self.schema = all_data_df.collect_schema()
+        self.genre_names = genre_names
+        self.is_lazy = isinstance(all_data_df, pl.LazyFrame)
+        self.max_selections = max_selections
+        self.max_aggregates = max_aggregates
+        self._selections = OrderedDict()
+        self._aggregates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._selections.clear()
+            self._aggregates.clear()
+
+    def _get_cached(self, entries, max_entries, key, build):
+        with self._lock:
+            if key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+        value = build()
+        with self._lock:
+            entries[key] = value
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+        return value
+
+    def _get_aggregate(self, key, build):
+        return self._get_cached(self._aggregates, self.max_aggregates, key, build)
+
+    def get_predicate(self, dimension, value):
+        if dimension == POPULARITY:
+            start, end = value
+            return (pl.col('popularity') >= start) & (pl.col('popularity') < end)
+        dtype = self.schema[dimension]
+        # Genres are tested on their bitmasks, which is much cheaper than searching the lists
+        if dimension == 'genres' and get_genre_mask_columns(self.genre_names)[0] in self.schema:
+            return build_genre_filter([value], self.genre_names)
+        if isinstance(dtype, pl.List):
+            # Three times faster than list.contains on string lists
+            return pl.col(dimension).list.eval(pl.element() == pl.lit(value).cast(dtype.inner)).list.any()
+        return pl.col(dimension) == pl.lit(value).cast(dtype)
+
+    def get_predicates(self, filters):
+        return [self.get_predicate(dimension, value) for dimension, value in filters]
+
+    def get_selection(self, filters):
+        """Return the sorted row positions of the tracks passing ``filters``, or None for every track."""
+        if not filters or self.is_lazy:
+            return None
+        return self._get_cached(self._selections, self.max_selections, filters, lambda: self._select(filters))
+
+    def _select(self, filters):
+        parent = self.get_selection(filters[:-1])
+        dimension, value = filters[-1]
+        if parent is None and dimension == POPULARITY:
+            # The tracks are sorted by popularity, so a popularity range is a range of rows
+            start, end = value
+            offset, length = get_bin_bounds(self.all_data_df, start, end - 1)
+            return np.arange(offset, offset + length, dtype=np.uint32)
+        predicate = self.get_predicate(dimension, value)
+        rows_df = self.all_data_df.select(list(dict.fromkeys(predicate.meta.root_names())))
+        if parent is not None:
+            rows_df = slice_rows(rows_df, parent)
+        passed = rows_df.select(predicate.fill_null(False)).to_series().to_numpy()
+        return np.flatnonzero(passed).astype(np.uint32) if parent is None else parent[passed]
+
+    def get_positions(self, filters, start, end):
+        """Return the sorted positions of the tracks passing ``filters`` within rows ``start`` to ``end``."""
+        selection = self.get_selection(filters)
+        if selection is None:
+            return np.arange(start, end, dtype=np.uint32)
+        return selection[np.searchsorted(selection, start):np.searchsorted(selection, end)]
+
+    def get_frame(self, filters, columns):
+        """Return ``columns`` of the tracks passing ``filters``, still sorted by popularity."""
+        if self.is_lazy:
+            lf = self.all_data_df.filter(*self.get_predicates(filters)) if filters else self.all_data_df
+            return lf.select(columns)
+        df = self.all_data_df.select(columns)
+        selection = self.get_selection(filters)
+        return df if selection is None else slice_rows(df, selection)
+
+    def get_popularity_sums(self, filters):
+        """Return ``build_popularity_sums`` of the tracks passing ``filters``."""
+        return self._get_aggregate(('popularity_sums', filters), lambda: build_popularity_sums(
+            self.get_frame(filters, ['popularity'] + [metric for metric in CUBE_METRICS if metric != 'popularity'])
+        ))
+
+    def get_category_shares(self, filters, category, popularity_bin, alias='share'):
+        """Return the shares of the values of ``category`` among the tracks passing ``filters`` in one bin."""
+        def build():
+            df = self.get_frame(filters, ['track_id', 'popularity', category])
+            if popularity_bin != ALL:
+                df = filter_by_bin(df, popularity_bin)
+            return count_by_category(df, category, alias=alias)
+        return self._get_aggregate(('category_shares', filters, category, popularity_bin, alias), build)
+
+    def get_popularity_quantiles(self, filters, metric, bins, quantiles=QUANTILES):
+        """Return the track count and exact quantiles of ``metric`` in each bin from ``get_popularity_bins``."""
+        def build():
+            labels = [label for label, _, _ in bins]
+            bin_labels = pl.col('popularity').cut([end - 0.5 for _, _, end in bins[:-1]], labels=labels)
+            quantiles_df = (
+                self.get_frame(filters, ['popularity', metric]).lazy()
+                .filter((pl.col('popularity') >= bins[0][1]) & (pl.col('popularity') < bins[-1][2]))
+                .group_by(popularity_bin=bin_labels.cast(pl.Utf8))
+                .agg(self._get_quantile_columns(metric, quantiles))
+                .collect()
+            )
+            return (
+                pl.DataFrame({'popularity_bin': labels})
+                .join(quantiles_df, on='popularity_bin', how='left')
+                .with_columns(pl.col('count').fill_null(0))
+            )
+        return self._get_aggregate(('popularity_quantiles', filters, metric, tuple(bins)), build)
+
+    def get_category_quantiles(self, filters, category, popularity_bin, metric, quantiles=QUANTILES):
+        """Return the track count and exact quantiles of ``metric`` for each value of ``category`` in one bin."""
+        def build():
+            lf = self.get_frame(filters, ['popularity', category, metric]).lazy()
+            if popularity_bin != ALL:
+                lf = filter_by_bin(lf, popularity_bin)
+            if is_multi_valued(lf, category):
+                lf = lf.explode(category)
+            return (
+                lf.drop_nulls(category)
+                .group_by(pl.col(category).cast(pl.Utf8))
+                .agg(self._get_quantile_columns(metric, quantiles))
+                .collect()
+            )
+        return self._get_aggregate(('category_quantiles', filters, category, popularity_bin, metric), build)
+
+    @staticmethod
+    def _get_quantile_columns(metric, quantiles):
+        return [pl.len().cast(pl.Int64).alias('count')] + [
+            pl.col(metric).cast(pl.Float64).quantile(quantile, 'linear').alias(get_quantile_name(quantile))
+            for quantile in quantiles
+        ]
@@ -0,0 +1,355 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+import polars as pl
+from operations import (
+    ALL, CATEGORY_COLUMNS, POPULARITY_BINS, build_category_cube, build_popularity_sums, filter_by_bin,
+    get_bin_slice, get_cube_cells, parse_bin
+)
+from crossfilter import CrossFilterIndex
+from rollups import ENTITIES, Leaderboards, build_leaderboards
+from search import SearchIndex, build_search_table
+from sketches import MetricSketches, build_category_sketches, build_popularity_sketches
+from similarity import DISPLAY_COLUMNS, SimilarityIndex
+from storage import (
+    ALBUM_LEADERBOARDS, ARTIST_LEADERBOARDS, CATEGORY_CUBE, CATEGORY_SKETCHES, DATA_DIR, GENRE_MAP, POPULARITY_SKETCHES,
+    POPULARITY_SUMS, PREPARED_DATA, SEARCH_INDEX, get_genre_names, get_snapshot_dir, get_table_path, list_snapshots,
+    load_prepared_data, read_data_version, read_table, scan_prepared_data
+)
+
+# DATA_BACKEND=lazy keeps the tracks on disk and scans only the row groups and columns a
+# request needs, for catalogs that do not fit in each worker's memory. It turns similar
+# tracks off, as their index holds the features of every track
+DATA_BACKEND = os.environ.get('DATA_BACKEND', 'eager')
+# Seconds between checks of the data directory for a new dataset, 0 turns reloading off
+RELOAD_INTERVAL = float(os.environ.get('DATA_RELOAD_INTERVAL', '10'))
+LEADERBOARD_TABLES = {'artist': ARTIST_LEADERBOARDS, 'album': ALBUM_LEADERBOARDS}
+VERSIONED_TABLES = [
+    PREPARED_DATA, CATEGORY_CUBE, POPULARITY_SUMS, POPULARITY_SKETCHES, CATEGORY_SKETCHES, SEARCH_INDEX,
+    *LEADERBOARD_TABLES.values()
+]
+# Name of the only snapshot of a data directory written without --snapshot
+CURRENT = 'current'
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class SnapshotPartition:
+    """The aggregates of one catalog snapshot, all its charts and deltas are read off them."""
+    name: str
+    version: str
+    popularity_sums_df: pl.DataFrame
+    category_cube_df: pl.DataFrame
+    metric_sketches: MetricSketches
+
+    def get_category_shares(self, category, popularity_bin):
+        alias = 'total_count' if popularity_bin == ALL else 'bin_count'
+        return get_cube_cells(self.category_cube_df, category, popularity_bin, alias=alias)
+
+@dataclass(frozen=True)
+class DataSnapshot:
+    """The tracks of one data version and every aggregate the callbacks read from them.
+
+    The tracks, the bins and the similarity index are those of the latest catalog
+    snapshot. ``partitions`` holds the aggregates of every snapshot, oldest first.
+    """
+    version: str
+    all_data_df: pl.DataFrame | pl.LazyFrame
+    data_schema: pl.Schema
+    popularity_sums_df: pl.DataFrame
+    category_cube_df: pl.DataFrame
+    category_shares: dict
+    bin_dfs: dict
+    similarity_index: SimilarityIndex | None
+    search_index: SearchIndex
+    cross_filter_index: CrossFilterIndex
+    leaderboards: dict
+    genre_names: list
+    partitions: dict
+
+    @property
+    def latest(self):
+        return next(reversed(self.partitions))
+
+    def get_partition(self, name):
+        """Return the partition called ``name``, or the latest one when there is no such partition."""
+        return self.partitions.get(name) or self.partitions[self.latest]
+
+    def get_previous_partition(self, name):
+        names = list(self.partitions)
+        position = names.index(self.get_partition(name).name)
+        return self.partitions[names[position - 1]] if position > 0 else None
+
+def read_store_version(data_dir=DATA_DIR):
+    """Return the data version of a data directory, covering every snapshot partition in it."""
+    snapshots = list_snapshots(data_dir)
+    if not snapshots:
+        return read_data_version(VERSIONED_TABLES, data_dir)
+    versions = [f'{snapshot}:{read_data_version(VERSIONED_TABLES, get_snapshot_dir(snapshot, data_dir))}' for snapshot in snapshots]
+    return hashlib.sha1('\n'.join(versions).encode()).hexdigest()[:12]
+
+def read_aggregate(name, data_dir, build, tracks_df):
+    # Aggregates written by prepare.py, rebuilt in memory when the file is not there yet
+    path = get_table_path(name, 'parquet', data_dir)
+    if os.path.exists(path):
+        return pl.read_parquet(path)
+    return build(scan_prepared_data(data_dir) if tracks_df is None else tracks_df)
+
+def load_partition(name, data_dir, version, tracks_df=None):
+    return SnapshotPartition(
+        name=name,
+        version=version,
+        popularity_sums_df=read_aggregate(POPULARITY_SUMS, data_dir, build_popularity_sums, tracks_df),
+        category_cube_df=read_aggregate(CATEGORY_CUBE, data_dir, build_category_cube, tracks_df),
+        metric_sketches=MetricSketches(
+            read_aggregate(POPULARITY_SKETCHES, data_dir, build_popularity_sketches, tracks_df),
+            read_aggregate(CATEGORY_SKETCHES, data_dir, build_category_sketches, tracks_df)
+        ),
+    )
+
+def check_lazy_tables(data_dir):
+    # The lazy backend never holds the tracks, so it cannot build at load the tables that
+    # data prepared by an older prepare.py lacks
+    paths = [get_table_path(PREPARED_DATA, 'arrow', data_dir), get_table_path(SEARCH_INDEX, 'arrow', data_dir)] + [
+        get_table_path(name, 'parquet', data_dir) for name in LEADERBOARD_TABLES.values()
+    ]
+    missing_paths = [path for path in paths if not os.path.exists(path)]
+    if missing_paths:
+        raise ValueError(f'DATA_BACKEND=lazy needs {", ".join(missing_paths)}. Run prepare.py again to write them.')
+
+def load_search_index(data_dir, tracks_df):
+    # Written by prepare.py next to the tracks, built at load for data prepared without it
+    if os.path.exists(get_table_path(SEARCH_INDEX, 'arrow', data_dir)):
+        search_df = read_table(SEARCH_INDEX, data_dir)
+    else:
+        search_df = build_search_table(tracks_df)
+    if isinstance(tracks_df, pl.LazyFrame):
+        # Memory-mapped from the Arrow file, which holds the tracks in the same order
+        keys = pl.read_ipc(get_table_path(PREPARED_DATA, 'arrow', data_dir), columns=['index'], memory_map=True)['index']
+    else:
+        keys = tracks_df['index']
+    return SearchIndex(search_df, keys.to_numpy())
+
+def load_snapshot(version, data_dir=DATA_DIR, previous=None, data_backend=DATA_BACKEND):
+    """Load the latest snapshot in full and the aggregates of the others.
+
+    Partitions whose files did not change since ``previous`` was loaded are reused, so a
+    new weekly snapshot costs one partition load however many snapshots there are.
+    """
+    snapshots = list_snapshots(data_dir) or [CURRENT]
+    partitions = {}
+    for name in snapshots[:-1]:
+        partition_dir = get_snapshot_dir(name, data_dir)
+        partition_version = read_data_version(VERSIONED_TABLES, partition_dir)
+        reused = previous.partitions.get(name) if previous is not None else None
+        if reused is not None and reused.version == partition_version:
+            partitions[name] = reused
+        else:
+            partitions[name] = load_partition(name, partition_dir, partition_version)
+
+    latest = snapshots[-1]
+    latest_dir = data_dir if latest == CURRENT else get_snapshot_dir(latest, data_dir)
+    if data_backend == 'lazy':
+        check_lazy_tables(latest_dir)
+        all_data_df = scan_prepared_data(latest_dir)
+    else:
+        all_data_df = load_prepared_data(latest_dir)
+    data_schema = all_data_df.collect_schema()
+    partitions[latest] = load_partition(latest, latest_dir, read_data_version(VERSIONED_TABLES, latest_dir), all_data_df)
+
+    category_cube_df = partitions[latest].category_cube_df
+    # Cells of list columns hold one of their values
+    category_dtypes = {
+        category: data_schema[category].inner if isinstance(data_schema[category], pl.List) else data_schema[category]
+        for category in CATEGORY_COLUMNS
+    }
+    category_shares = {
+        (category, popularity_bin): partitions[latest].get_category_shares(category, popularity_bin).cast(
+            {category: category_dtypes[category]}
+        )
+        for category in CATEGORY_COLUMNS
+        for popularity_bin in [ALL] + POPULARITY_BINS
+    }
+
+    # all_data_df is sorted by popularity, so every bin is a contiguous zero-copy slice, or
+    # a lazy filter that skips the row groups outside the bin
+    bin_dfs = {
+        popularity_bin: (
+            filter_by_bin(all_data_df, popularity_bin) if data_backend == 'lazy'
+            else get_bin_slice(all_data_df, *parse_bin(popularity_bin))
+        )
+        for popularity_bin in POPULARITY_BINS
+    }
+
+    genre_names = get_genre_names(read_table(GENRE_MAP, latest_dir))
+    return DataSnapshot(
+        version=version,
+        all_data_df=all_data_df,
+        data_schema=data_schema,
+        # Cumulative counts and metric sums per popularity value, any bin layout is read off them
+        popularity_sums_df=partitions[latest].popularity_sums_df,
+        category_cube_df=category_cube_df,
+        category_shares=category_shares,
+        bin_dfs=bin_dfs,
+        # Standardized audio features of every track, keyed by the prepared row index that
+        # the track table sends back as the row id of the selected cell
+        similarity_index=None if data_backend == 'lazy' else SimilarityIndex(all_data_df, display_columns=DISPLAY_COLUMNS),
+        # Words of the track names, artists and albums, mapped to row positions of all_data_df
+        search_index=load_search_index(latest_dir, all_data_df),
+        # Tracks and aggregates selected by the bars clicked on the charts, filled on demand
+        cross_filter_index=CrossFilterIndex(all_data_df, genre_names),
+        # Top artists and albums of every genre and popularity bin, keyed by entity
+        leaderboards={
+            entity: Leaderboards(read_aggregate(
+                LEADERBOARD_TABLES[entity], latest_dir, lambda df, entity=entity: build_leaderboards(df, entity), all_data_df
+            ))
+            for entity in ENTITIES
+        },
+        # Bit order of the genre_mask columns
+        genre_names=genre_names,
+        partitions=partitions,
+    )
+
+class DataStore:
+    """Holds the current DataSnapshot and swaps in a new one when the dataset changes.
+
+    A new snapshot is built completely, off the request path, before a single assignment
+    replaces the old one. Callbacks read ``store.snapshot`` once and use only that object,
+    so a request that started before a swap finishes on the data it started with. The
+    old snapshot is freed once the last such request is done. Listeners registered with
+    ``on_swap`` are called after every swap, to drop results memoized on the old version.
+
+    Nothing is loaded when the store is created. ``warm_up`` loads the first snapshot in
+    the background, otherwise the first caller of ``snapshot`` loads it.
+    """
+    def __init__(self, data_dir=DATA_DIR, loader=load_snapshot, reload_interval=RELOAD_INTERVAL):
+        self.data_dir = data_dir
+        self.reload_interval = reload_interval
+        self._loader = loader
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._warmer = None
+        self._ready = threading.Event()
+        self._snapshot = None
+        self.load_seconds = None
+        self.warm_up_seconds = None
+        self.warm_up_error = None
+
+    @property
+    def snapshot(self):
+        """The current DataSnapshot, loaded by the first caller when no warm-up did it yet."""
+        if self._snapshot is None:
+            self.load()
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    @property
+    def ready(self):
+        """Whether the data is loaded, and every warm-up step has run when there is a warm-up."""
+        return self._ready.is_set()
+
+    def load(self):
+        """Load the first snapshot, unless another thread did already, and return it."""
+        with self._lock:
+            if self._snapshot is None:
+                start = time.perf_counter()
+                self._snapshot = self._loader(read_store_version(self.data_dir), self.data_dir)
+                self.load_seconds = time.perf_counter() - start
+                logger.info('Loaded data version %s in %.2f s', self._snapshot.version, self.load_seconds)
+                if self._warmer is None:
+                    self._ready.set()
+        return self._snapshot
+
+    def warm_up(self, *steps):
+        """Load the data in a daemon thread, then call every ``step(snapshot)``, and mark the store ready.
+
+        Requests arriving meanwhile wait for the load, not for the steps. When the load
+        fails, the next request tries it again and gets the error.
+        """
+        if self._warmer is not None:
+            return
+
+        def run():
+            start = time.perf_counter()
+            try:
+                snapshot = self.load()
+                for step in steps:
+                    step(snapshot)
+            except Exception as error:
+                self.warm_up_error = repr(error)
+                logger.exception('Warming up the data failed')
+                return
+            self.warm_up_seconds = time.perf_counter() - start
+            self._ready.set()
+
+        self._warmer = threading.Thread(target=run, name='data-store-warm-up', daemon=True)
+        self._warmer.start()
+
+    def wait_ready(self, timeout=None):
+        """Block until the store is ready and return whether it was within ``timeout`` seconds.
+
+        Without a warm-up running, the data is loaded in the calling thread.
+        """
+        if self._warmer is None:
+            self.load()
+        return self._ready.wait(timeout)
+
+    def get_status(self):
+        """Readiness of the store and how long its warm-up took, in the shape /ready returns."""
+        status = {'ready': self.ready}
+        if self._snapshot is not None:
+            status['version'] = self._snapshot.version
+        if self.load_seconds is not None:
+            status['load_s'] = round(self.load_seconds, 3)
+        if self.warm_up_seconds is not None:
+            status['warm_up_s'] = round(self.warm_up_seconds, 3)
+        if self.warm_up_error is not None:
+            status['error'] = self.warm_up_error
+        return status
+
+    def on_swap(self, listener):
+        """Call ``listener(snapshot, previous_snapshot)`` after every swap."""
+        self._listeners.append(listener)
+        return listener
+
+    def refresh(self):
+        """Load the dataset again if its version changed and return whether it was swapped."""
+        self.load()
+        with self._lock:
+            previous = self._snapshot
+            version = read_store_version(self.data_dir)
+            while version != self._snapshot.version:
+                snapshot = self._loader(version, self.data_dir, previous=self._snapshot)
+                # Files replaced while loading would leave the snapshot mixed, load them again
+                version = read_store_version(self.data_dir)
+                if version == snapshot.version:
+                    self._snapshot = snapshot
+        if self._snapshot is previous:
+            return False
+        logger.info('Swapped data version %s for %s', previous.version, self._snapshot.version)
+        for listener in self._listeners:
+            listener(self._snapshot, previous)
+        return True
+
+    def watch(self):
+        """Check for a new dataset every ``reload_interval`` seconds in a daemon thread."""
+        if self.reload_interval <= 0 or self._watcher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.reload_interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception('Reloading the data failed, keeping version %s', self.snapshot.version)
+
+        self._watcher = threading.Thread(target=run, name='data-store-watcher', daemon=True)
+        self._watcher.start()
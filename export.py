@@ -0,0 +1,192 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import dash_bootstrap_components as dbc
+from dash import ClientsideFunction, Dash, Input, Output
+from dash.fingerprint import check_fingerprint
+from plotly.io.json import to_json_plotly
+import app as dashboard
+from operations import POPULARITY_RANGE
+
+OUTPUT_DIR = 'dist'
+STATIC_ASSETS_DIR = 'static_assets'
+CHART_VIEWS = ['mean', 'distribution']
+TABLE_PAGE_SIZE = 10
+# Every bin lists its most popular tracks only, the later pages are rarely opened
+TABLE_PAGES = 50
+# Pages the Dash renderer requests from the server, written as files under these names
+SERVER_PAGES = {'/': 'index.html', '/_dash-layout': '_dash-layout.json', '/_dash-dependencies': '_dash-dependencies.json'}
+
+def get_output_key(*inputs):
+    # Joined the same way as in static_export.js, where booleans print in lower case
+    return '/'.join(str(value).lower() if isinstance(value, bool) else str(value) for value in inputs)
+
+def write_file(output_dir, path, content):
+    path = os.path.join(output_dir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(content)
+
+def export_callbacks(output_dir, table_pages=TABLE_PAGES):
+    """Run the dashboard callbacks for every value of their inputs and write the outputs.
+
+    Each distinct output is written once to ``data/<hash>.json``, and ``data/index.json``
+    maps the inputs, joined by ``get_output_key``, to the hash. The category chart does
+    not depend on the metric in the averages view, so its outputs are shared between
+    metrics. The track table lists the first ``table_pages`` pages of every popularity bin.
+    """
+    snapshot = dashboard.data_store.snapshot
+    index = {}
+    written = set()
+
+    def add_outputs(key, outputs):
+        content = to_json_plotly(outputs).encode()
+        content_hash = hashlib.sha256(content).hexdigest()[:16]
+        if content_hash not in written:
+            write_file(output_dir, f'data/{content_hash}.json', content)
+            written.add(content_hash)
+        index[key] = content_hash
+
+    for snapshot_name in snapshot.partitions:
+        add_outputs(get_output_key('delta-switch', snapshot_name), dashboard.update_delta_switch(snapshot_name))
+        for delta in [False, True]:
+            for chart_view in CHART_VIEWS:
+                for metric in dashboard.metric_columns:
+                    for bin_width in dashboard.bin_widths:
+                        add_outputs(
+                            get_output_key('distribution', metric, bin_width, snapshot_name, delta, chart_view),
+                            dashboard.update_distribution_charts(
+                                metric, bin_width, list(POPULARITY_RANGE), snapshot_name, delta, chart_view
+                            )
+                        )
+                    for category in dashboard.category_columns:
+                        for popularity_bin in dashboard.popularity_bins:
+                            add_outputs(
+                                get_output_key('category', category, popularity_bin, snapshot_name, delta, metric, chart_view),
+                                dashboard.update_category_chart(
+                                    category, popularity_bin, snapshot_name, delta, metric, chart_view
+                                )
+                            )
+
+    for popularity_bin in dashboard.popularity_bins:
+        page_count = table_pages
+        page_current = 0
+        while page_current < page_count:
+            table_data, page_count = dashboard.query_table(
+                lambda *_: None, snapshot, popularity_bin, page_current, TABLE_PAGE_SIZE
+            )
+            page_count = min(page_count, table_pages)
+            add_outputs(get_output_key('table', popularity_bin, page_current), [table_data, page_count])
+            page_current += 1
+
+    write_file(output_dir, 'data/index.json', json.dumps(index, separators=(',', ':')).encode())
+    return index
+
+def create_static_app():
+    """Return a Dash app with the static layout, whose callbacks read the exported outputs in the browser."""
+    static_app = Dash(__name__, assets_folder=STATIC_ASSETS_DIR, external_stylesheets=[dbc.themes.BOOTSTRAP])
+    static_app.layout = dashboard.serve_layout(static=True)
+    static_app.clientside_callback(
+        ClientsideFunction('static_export', 'update_distribution_charts'),
+        Output('histogram-chart', 'figure'),
+        Output('avg-card-title', 'children'),
+        Output('avg-card-text', 'children'),
+        Output('popular-tracks-text', 'children'),
+        Output('unpopular-tracks-text', 'children'),
+        [Input('metric-tabs', 'active_tab'),
+        Input('bin-width-tabs', 'active_tab'),
+        Input('snapshot-dropdown', 'value'),
+        Input('delta-switch', 'value'),
+        Input('chart-view', 'value')]
+    )
+    static_app.clientside_callback(
+        ClientsideFunction('static_export', 'update_category_chart'),
+        Output('butterfly-chart', 'figure'),
+        [Input('category-tabs', 'active_tab'),
+        Input('popularity-tabs', 'active_tab'),
+        Input('snapshot-dropdown', 'value'),
+        Input('delta-switch', 'value'),
+        Input('metric-tabs', 'active_tab'),
+        Input('chart-view', 'value')]
+    )
+    static_app.clientside_callback(
+        ClientsideFunction('static_export', 'update_delta_switch'),
+        Output('delta-switch', 'disabled'),
+        Input('snapshot-dropdown', 'value')
+    )
+    static_app.clientside_callback(
+        ClientsideFunction('static_export', 'update_table'),
+        Output('track-table', 'data'),
+        Output('track-table', 'page_count'),
+        Output('track-table', 'page_current'),
+        [Input('popularity-tabs', 'active_tab'),
+        Input('track-table', 'page_current')]
+    )
+    return static_app
+
+def export_site(static_app, output_dir):
+    """Write the page of the static app and every script, stylesheet and asset it loads."""
+    client = static_app.server.test_client()
+    for url, path in SERVER_PAGES.items():
+        write_file(output_dir, path, client.get(url).get_data())
+    index_html = client.get('/').get_data(as_text=True)
+    # The page links its scripts under fingerprinted names. The components load their other
+    # chunks and plotly.js on demand under their plain names. Source maps are registered too
+    # but not shipped with the packages
+    urls = set(re.findall(r'(?:src|href)="(/[^"?]+)', index_html))
+    linked_urls = {check_fingerprint(url)[0] for url in urls}
+    for namespace, paths in static_app.registered_paths.items():
+        urls.update(
+            url for url in (f'/_dash-component-suites/{namespace}/{path}' for path in paths)
+            if url not in linked_urls and not url.endswith('.map')
+        )
+    for url in sorted(urls):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} returned {response.status_code}')
+        write_file(output_dir, url.lstrip('/'), response.get_data())
+    # Assets of the dashboard itself, such as the logo
+    shutil.copytree(dashboard.app.config.assets_folder, os.path.join(output_dir, 'assets'), dirs_exist_ok=True)
+
+def get_size_group(path):
+    top_dir = path.split(os.sep)[0]
+    return {
+        'data': 'callback outputs',
+        '_dash-component-suites': 'renderer and components',
+        'assets': 'assets',
+    }.get(top_dir, 'page')
+
+def report_sizes(output_dir):
+    """Return the file count, size and gzipped size of the export, in total and by group."""
+    groups = {}
+    for root, _, file_names in os.walk(output_dir):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            with open(path, 'rb') as file:
+                content = file.read()
+            group = get_size_group(os.path.relpath(path, output_dir))
+            for name in [group, 'total']:
+                sizes = groups.setdefault(name, {'files': 0, 'bytes': 0, 'gzip_bytes': 0})
+                sizes['files'] += 1
+                sizes['bytes'] += len(content)
+                sizes['gzip_bytes'] += len(gzip.compress(content))
+    return groups
+
+def export(output_dir=OUTPUT_DIR, table_pages=TABLE_PAGES):
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    export_callbacks(output_dir, table_pages)
+    export_site(create_static_app(), output_dir)
+    return report_sizes(output_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the dashboard as static files, with every callback output precomputed.')
+    parser.add_argument('--output', default=OUTPUT_DIR, help='directory the export is written to, replacing its contents')
+    parser.add_argument('--table-pages', type=int, default=TABLE_PAGES,
+                        help='number of track table pages exported for each popularity bin')
+    args = parser.parse_args()
+    print(json.dumps(export(output_dir=args.output, table_pages=args.table_pages), indent=2))
@@ -0,0 +1,149 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PAYLOAD_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+CALLBACK_PATH = '/_dash-update-component'
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_prometheus(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.stage_latency = {}
+        self.payload_size = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, buckets, key, value):
+        with self._lock:
+            histogram = metric.get(key)
+            if histogram is None:
+                histogram = metric[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_latency(self, callback, inputs, stage, seconds):
+        self.observe(self.stage_latency, LATENCY_BUCKETS, (callback, inputs, stage), seconds)
+
+    def observe_payload(self, callback, inputs, size):
+        self.observe(self.payload_size, PAYLOAD_BUCKETS, (callback, inputs), size)
+
+    def to_prometheus(self):
+        lines = [
+            '# HELP dashboard_callback_stage_seconds Latency of each callback stage.',
+            '# TYPE dashboard_callback_stage_seconds histogram',
+        ]
+        with self._lock:
+            for (callback, inputs, stage), histogram in sorted(self.stage_latency.items()):
+                labels = f'callback="{callback}",inputs="{escape_label(inputs)}",stage="{stage}"'
+                lines.extend(histogram.to_prometheus('dashboard_callback_stage_seconds', labels))
+            lines.extend([
+                '# HELP dashboard_callback_payload_bytes Size of the callback response body.',
+                '# TYPE dashboard_callback_payload_bytes histogram',
+            ])
+            for (callback, inputs), histogram in sorted(self.payload_size.items()):
+                labels = f'callback="{callback}",inputs="{escape_label(inputs)}"'
+                lines.extend(histogram.to_prometheus('dashboard_callback_payload_bytes', labels))
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class CallbackTimer:
+    def __init__(self, callback, inputs, metrics_registry):
+        self.callback = callback
+        self.inputs = inputs
+        self.registry = metrics_registry
+        self.timings = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.registry.observe_latency(self.callback, self.inputs, name, seconds)
+        self.timings.append((name, seconds))
+
+@contextmanager
+def track(callback, inputs='', metrics_registry=registry):
+    """Time a callback as a whole and expose ``timer.stage(name)`` for its parts.
+
+    ``inputs`` labels the input combination, so keep it to low-cardinality values.
+    """
+    timer = CallbackTimer(callback, inputs, metrics_registry)
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.record('total', time.perf_counter() - start)
+        if has_request_context():
+            g.callback_timers = getattr(g, 'callback_timers', []) + [timer]
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+def record_payload(response):
+    # 'request' spans the whole HTTP round trip in the worker, so the difference to 'total'
+    # is Dash's own dispatch and JSON serialization of the callback output
+    if request.path == CALLBACK_PATH and not response.direct_passthrough:
+        size = len(response.get_data())
+        for timer in getattr(g, 'callback_timers', []):
+            timer.record('request', time.perf_counter() - g.request_start)
+            timer.registry.observe_payload(timer.callback, timer.inputs, size)
+    return response
+
+def add_server_timing(response):
+    timings = [
+        f'{timer.callback}-{name};dur={seconds * 1000:.3f}'
+        for timer in getattr(g, 'callback_timers', [])
+        for name, seconds in timer.timings
+    ]
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+def install(server, metrics_registry=registry, server_timing=None):
+    """Expose ``/metrics`` on the Flask server and record the callback payload sizes.
+
+    The ``Server-Timing`` header is added when ``server_timing`` is true, which defaults
+    to the SERVER_TIMING environment variable being set to 1.
+    """
+    if server_timing is None:
+        server_timing = os.environ.get('SERVER_TIMING') == '1'
+    server.before_request(start_request_timer)
+    if server_timing:
+        server.after_request(add_server_timing)
+    server.after_request(record_payload)
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(metrics_registry.to_prometheus(), mimetype='text/plain; version=0.0.4')
@@ -1,20 +1,387 @@
+import numpy as np
 import polars as pl
 
+# general_genres and genres hold every genre of a track, which counts once under each
+CATEGORY_COLUMNS = ['general_genres', 'genres', 'explicit', 'time_signature']
+POPULARITY_BIN_EDGES = [0, 25, 50, 75, 100]
+POPULARITY_BINS = [f'{i}-{j}' for i, j in zip(POPULARITY_BIN_EDGES[:-1], POPULARITY_BIN_EDGES[1:])]
+POPULARITY_RANGE = (0, 100)
+CUBE_METRICS = [
+    'popularity', 'duration_min', 'danceability', 'energy', 'key', 'loudness', 'mode',
+    'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence'
+]
+ALL = 'all'
+
 def calculate_difference(bin_df, metric, overall_avg):
     bin_avg = bin_df[0, metric]
+    # The rounded average of a range or selection can be 0 while a bin's is not, and then
+    # there is no relative difference
+    if overall_avg == 0:
+        return None
     if bin_avg == 0:
         difference = -100
     else:
         difference = ((bin_avg - overall_avg) / overall_avg) * 100
     return round(difference, 2)
 
+def is_multi_valued(df, category):
+    return isinstance(df.collect_schema()[category], pl.List)
+
 def count_by_category(df, category, alias='count'):
-    total_count = df.height
+    # The total is counted before a list column is exploded, so shares are of tracks and
+    # a LazyFrame is scanned once, reading only the category and track_id columns of
+    # the rows that pass its predicates
+    lf = df.lazy().with_columns(pl.len().alias('rows'))
+    if is_multi_valued(df, category):
+        lf = lf.explode(category)
     count_by_category_df = (
+        lf.group_by(category)
+        .agg([pl.count("track_id").alias(alias), pl.col('rows').first()])
+        .with_columns(pl.col(alias) / pl.col('rows') * 100)
+        .drop('rows')
+        .sort(alias)
+        .collect()
+    )
+    return count_by_category_df
+
+def parse_bin(popularity_bin):
+    min_popularity, max_popularity = map(int, popularity_bin.split('-'))
+    return min_popularity, max_popularity
+
+def filter_by_bin(df, popularity_bin):
+    min_popularity, max_popularity = parse_bin(popularity_bin)
+    return df.filter((pl.col('popularity') >= min_popularity) & (pl.col('popularity') <= max_popularity))
+
+def build_category_cube(df, category_columns=CATEGORY_COLUMNS, popularity_bins=POPULARITY_BINS, metrics=CUBE_METRICS):
+    """Aggregate ``df`` into a (category, value, popularity_bin) cube.
+
+    Every cell holds the track count, its share of the bin's tracks in percent and the
+    sum and mean of each metric. ``'all'`` is used as the value of the overall category
+    and as the bin label for the whole dataset. A track counts in every value of a list
+    column, so the shares of such a category add up to more than 100.
+    """
+    frames = []
+    for popularity_bin in [ALL] + popularity_bins:
+        bin_lf = df.lazy() if popularity_bin == ALL else filter_by_bin(df.lazy(), popularity_bin)
+        bin_lf = bin_lf.with_columns(pl.len().alias('rows'))
+        for category in [ALL] + category_columns:
+            category_lf = bin_lf.explode(category) if category != ALL and is_multi_valued(df, category) else bin_lf
+            # Grouping on the column itself keeps Enum columns on their integer codes,
+            # the labels are only materialized for the few resulting cells
+            value = pl.lit(ALL) if category == ALL else pl.col(category)
+            frames.append(
+                category_lf
+                .group_by(value.alias('value'))
+                .agg(
+                    [pl.len().cast(pl.Int64).alias('count'), pl.col('rows').first()]
+                    + [pl.col(metric).cast(pl.Float64).sum().alias(f'{metric}_sum') for metric in metrics]
+                )
+                .with_columns(
+                    pl.col('value').cast(pl.Utf8),
+                    category=pl.lit(category),
+                    popularity_bin=pl.lit(popularity_bin),
+                    share=pl.col('count') / pl.col('rows') * 100,
+                    **{f'{metric}_mean': pl.col(f'{metric}_sum') / pl.col('count') for metric in metrics}
+                )
+                .drop('rows')
+            )
+    cube_df = pl.concat(pl.collect_all(frames))
+    leading_columns = ['category', 'value', 'popularity_bin', 'count', 'share']
+    return (
+        cube_df.select(leading_columns + [col for col in cube_df.columns if col not in leading_columns])
+        .sort(['category', 'popularity_bin', 'value'])
+    )
+
+def check_category_cube(cube_df, df, category_columns=CATEGORY_COLUMNS, popularity_bins=POPULARITY_BINS, metrics=CUBE_METRICS, tolerance=1e-6):
+    """Recompute the cube cells from the track-level frame and raise ValueError on any mismatch."""
+    errors = []
+    for popularity_bin in [ALL] + popularity_bins:
+        bin_df = df if popularity_bin == ALL else filter_by_bin(df, popularity_bin)
+        for category in category_columns:
+            expected_df = count_by_category(bin_df, category, alias='expected_share').with_columns(pl.col(category).cast(pl.Utf8))
+            cube_cells = cube_df.filter((pl.col('category') == category) & (pl.col('popularity_bin') == popularity_bin))
+            compared_df = expected_df.join(cube_cells, left_on=category, right_on='value', how='full')
+            mismatches = compared_df.filter(
+                ~((pl.col('expected_share') - pl.col('share')).abs() <= tolerance).fill_null(False)
+            )
+            if mismatches.height:
+                errors.append(f'{category} / {popularity_bin}: {mismatches.height} shares differ')
+            expected_count = bin_df[category].list.len().sum() if is_multi_valued(bin_df, category) else bin_df.height
+            if cube_cells['count'].sum() != expected_count:
+                errors.append(f'{category} / {popularity_bin}: counts add up to {cube_cells["count"].sum()}, expected {expected_count}')
+        overall = cube_df.filter((pl.col('category') == ALL) & (pl.col('popularity_bin') == popularity_bin))
+        for metric in metrics:
+            expected_sum = bin_df[metric].cast(pl.Float64).sum()
+            if overall.height and abs(overall[0, f'{metric}_sum'] - expected_sum) > tolerance * max(1, abs(expected_sum)):
+                errors.append(f'{metric} / {popularity_bin}: sum {overall[0, f"{metric}_sum"]}, expected {expected_sum}')
+    if errors:
+        raise ValueError('Category cube is inconsistent with the track data:\n' + '\n'.join(errors))
+
+def get_cube_cells(cube_df, category, popularity_bin, alias='share'):
+    """Return the shares of one category in one bin, shaped like ``count_by_category``."""
+    cells_df = cube_df.filter((pl.col('category') == category) & (pl.col('popularity_bin') == popularity_bin))
+    return cells_df.select(pl.col('value').alias(category), pl.col('share').alias(alias)).sort(alias)
+
+def build_popularity_sums(df, metrics=CUBE_METRICS, popularity_range=POPULARITY_RANGE):
+    """Return the cumulative track count and metric sums over every popularity value.
+
+    The row for popularity ``p`` holds the totals of the tracks with a popularity below
+    ``p``, and the table runs up to one past the top of the range. The totals of any
+    popularity range are then the difference of two rows, so bins of any layout are
+    answered without touching the tracks again.
+    """
+    min_popularity, max_popularity = popularity_range
+    sum_columns = ['count'] + [f'{metric}_sum' for metric in metrics]
+    sums_df = (
         df.lazy()
-        .group_by(category)
-        .agg([(pl.count("track_id") / total_count * 100).alias(alias)])
+        .group_by(pl.col('popularity').cast(pl.Int64))
+        .agg(
+            [pl.len().cast(pl.Int64).alias('count')]
+            + [pl.col(metric).cast(pl.Float64).sum().alias(f'{metric}_sum') for metric in metrics]
+        )
+        .collect()
+    )
+    values_df = pl.DataFrame({'popularity': pl.int_range(min_popularity, max_popularity + 2, eager=True)})
+    return (
+        values_df.join(sums_df, on='popularity', how='left')
+        .with_columns(pl.col(sum_columns).fill_null(0))
+        .with_columns(pl.col(sum_columns).cum_sum().shift(1, fill_value=0))
+    )
+
+def get_popularity_bins(popularity_range=POPULARITY_RANGE, bin_width=25):
+    """Split an inclusive popularity range into bins of ``bin_width``.
+
+    Returns ``(label, start, end)`` tuples where ``end`` is exclusive. Bins are closed on
+    the left like the histogram of prepare.py, and the last bin also holds the top of
+    the range, so a width of 25 over 0-100 gives the usual four bins.
+    """
+    min_popularity, max_popularity = popularity_range
+    starts = list(range(min_popularity, max(max_popularity, min_popularity + 1), bin_width))
+    ends = [min(start + bin_width, max_popularity) for start in starts]
+    bins = [(f'{start}-{end}', start, end) for start, end in zip(starts, ends)]
+    label, start, _ = bins[-1]
+    bins[-1] = (label, start, max_popularity + 1)
+    return bins
+
+def aggregate_popularity_bins(popularity_sums_df, bins, metrics=CUBE_METRICS, decimals=2):
+    """Return the track count and metric means of each bin, shaped like the histogram data.
+
+    Each bin costs two row lookups in ``popularity_sums_df``; empty bins have null means.
+    """
+    sum_columns = ['count'] + [f'{metric}_sum' for metric in metrics]
+    offset = popularity_sums_df[0, 'popularity']
+    upper_df = popularity_sums_df[[end - offset for _, _, end in bins]].select(sum_columns)
+    lower_df = popularity_sums_df[[start - offset for _, start, _ in bins]].select(sum_columns)
+    return (
+        (upper_df - lower_df)
+        .select(
+            pl.Series('popularity_bin', [label for label, _, _ in bins]),
+            pl.col('count'),
+            *[
+                pl.when(pl.col('count') > 0).then(pl.col(f'{metric}_sum') / pl.col('count')).round(decimals).alias(metric)
+                for metric in metrics
+            ]
+        )
+    )
+
+def diff_popularity_bins(bins_df, previous_bins_df, metrics=CUBE_METRICS, decimals=2):
+    """Return the change in track count and metric means of each bin since ``previous_bins_df``.
+
+    Both frames come from ``aggregate_popularity_bins`` over the same bins. A mean is null
+    when the bin is empty in either snapshot.
+    """
+    return bins_df.select(
+        pl.col('popularity_bin'),
+        pl.col('count') - previous_bins_df['count'],
+        *[(pl.col(metric) - previous_bins_df[metric]).round(decimals) for metric in metrics]
+    )
+
+def diff_category_shares(shares_df, previous_shares_df, category, alias='share'):
+    """Return the change in share of each category value, in percentage points.
+
+    Values missing from one of the snapshots count as a share of zero there.
+    """
+    labels = pl.col(category).cast(pl.Utf8)
+    return (
+        shares_df.with_columns(labels)
+        .join(previous_shares_df.with_columns(labels), on=category, how='full', coalesce=True, suffix='_previous')
+        .select(pl.col(category), (pl.col(alias).fill_null(0) - pl.col(f'{alias}_previous').fill_null(0)).alias(alias))
         .sort(alias)
+    )
+
+def add_popularity_change(df, previous_df=None):
+    """Add the change in popularity of each track since ``previous_df``, null for new tracks."""
+    if previous_df is None:
+        return df.with_columns(popularity_change=pl.lit(None, dtype=pl.Int16))
+    previous_lf = previous_df.lazy().select(
+        pl.col('track_id'), pl.col('popularity').cast(pl.Int16).alias('previous_popularity')
+    )
+    return (
+        df.lazy()
+        .join(previous_lf, on='track_id', how='left')
+        .with_columns(popularity_change=pl.col('popularity').cast(pl.Int16) - pl.col('previous_popularity'))
+        .drop('previous_popularity')
         .collect()
     )
-    return count_by_category_df
\ No newline at end of file
+
+def get_genre_mask_columns(genre_names):
+    return [f'genre_mask_{word}' for word in range(-(-len(genre_names) // 64))]
+
+def build_genre_masks(genres, genre_names):
+    """Return the genre bitmask of every track in ``genres``, a list column.
+
+    Bit ``i`` of the mask stands for ``genre_names[i]``, and the bits are split over one
+    64-bit column per 64 genres. The columns are Int64 so CSV files read them back
+    without overflowing, the bit operations do not depend on the sign. Genres missing
+    from ``genre_names`` get no bit.
+    """
+    mask_columns = get_genre_mask_columns(genre_names)
+    bits_df = (
+        genres.rename('genre').to_frame()
+        .with_row_index('row')
+        .explode('genre')
+        .select('row', bit=pl.col('genre').replace_strict(genre_names, list(range(len(genre_names))), default=None, return_dtype=pl.Int64))
+        .drop_nulls()
+    )
+    bits = bits_df['bit'].to_numpy()
+    masks = np.zeros((len(genres), len(mask_columns)), dtype=np.uint64)
+    np.bitwise_or.at(masks, (bits_df['row'].to_numpy(), bits // 64), np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+    return pl.DataFrame({col: masks[:, word].view(np.int64) for word, col in enumerate(mask_columns)})
+
+def build_genre_filter(genres, genre_names, match='any'):
+    """Return an expression keeping the tracks in any, or all, of ``genres``, tested on their genre masks."""
+    mask_columns = get_genre_mask_columns(genre_names)
+    words = [0] * len(mask_columns)
+    for genre in genres:
+        if genre in genre_names:
+            bit = genre_names.index(genre)
+            words[bit // 64] |= 1 << (bit % 64)
+    # Masks are stored as signed 64-bit integers, so the query words are too
+    words = [np.uint64(word).view(np.int64).item() for word in words]
+    masked = [(pl.col(col) & pl.lit(word, dtype=pl.Int64), word) for col, word in zip(mask_columns, words) if word]
+    if not masked:
+        return pl.lit(True)
+    if match == 'all':
+        return pl.all_horizontal([bits == word for bits, word in masked])
+    return pl.any_horizontal([bits != 0 for bits, _ in masked])
+
+def get_bin_bounds(df, min_popularity, max_popularity):
+    """Return the offset and length of the rows of a popularity-descending frame that fall in the bin."""
+    popularity = df['popularity']
+    offset = (popularity > max_popularity).sum()
+    length = (popularity >= min_popularity).sum() - offset
+    return offset, length
+
+def get_bin_slice(df, min_popularity, max_popularity):
+    """Return the contiguous rows of a popularity-descending frame that fall in the bin."""
+    return df.slice(*get_bin_bounds(df, min_popularity, max_popularity))
+
+FILTER_OPERATORS = [
+    ['icontains '],
+    ['contains '],
+    ['ge ', '>='],
+    ['le ', '<='],
+    ['lt ', '<'],
+    ['gt ', '>'],
+    ['ne ', '!='],
+    ['eq ', '='],
+]
+
+def split_filter_part(filter_part):
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`') and len(value_part) > 1:
+                    value = value_part[1:-1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+def format_filter_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def build_filter_expression(filter_query, schema):
+    if not filter_query:
+        return None
+    expressions = []
+    for filter_part in filter_query.split(' && '):
+        column, operator, value = split_filter_part(filter_part)
+        if column not in schema:
+            continue
+        col = pl.col(column)
+        if isinstance(schema[column], pl.List):
+            col = col.list.join(', ')
+        if operator in ('contains', 'icontains') or not schema[column].is_numeric():
+            col, value = col.cast(pl.Utf8), format_filter_value(value)
+        elif not isinstance(value, float):
+            continue
+        if operator == 'icontains':
+            col, value = col.str.to_lowercase(), value.lower()
+        if operator in ('contains', 'icontains'):
+            expressions.append(col.str.contains(value, literal=True))
+        elif operator == 'eq':
+            expressions.append(col == value)
+        elif operator == 'ne':
+            expressions.append(col != value)
+        elif operator == 'lt':
+            expressions.append(col < value)
+        elif operator == 'le':
+            expressions.append(col <= value)
+        elif operator == 'gt':
+            expressions.append(col > value)
+        elif operator == 'ge':
+            expressions.append(col >= value)
+    if not expressions:
+        return None
+    return pl.all_horizontal(expressions)
+
+def query_page(df, page_current, page_size, sort_by=None, filter_query=None):
+    """Return one page of ``df`` and the total page count.
+
+    Filtering and sorting run inside polars; when neither is requested the page is a
+    zero-copy slice, so the cost depends on ``page_size`` and not on the size of ``df``.
+    ``df`` may also be a LazyFrame, in which case the filter, sort and slice are pushed
+    down into its scan.
+    """
+    offset = page_current * page_size
+    is_lazy = isinstance(df, pl.LazyFrame)
+    schema = df.collect_schema()
+    filter_expr = build_filter_expression(filter_query, schema)
+    if filter_expr is None and not sort_by and not is_lazy:
+        return df.slice(offset, page_size), -(-df.height // page_size)
+
+    lf = df.lazy()
+    if filter_expr is not None:
+        lf = lf.filter(filter_expr)
+    if filter_expr is None and not is_lazy:
+        row_count = df.height
+    else:
+        row_count = lf.select(pl.len()).collect().item()
+    if sort_by:
+        # Lists cannot be sorted on, they are sorted as their joined text
+        columns = [
+            pl.col(col).list.join(', ') if isinstance(schema[col], pl.List) else pl.col(col)
+            for col in [sort['column_id'] for sort in sort_by]
+        ]
+        descending = [sort['direction'] == 'desc' for sort in sort_by]
+        # Rows tied on the sorted columns are ordered by the unique row index, so pages
+        # neither repeat nor skip any of them
+        if 'index' in schema:
+            columns.append(pl.col('index'))
+            descending.append(False)
+        lf = (
+            lf.bottom_k(offset + page_size, by=columns, reverse=descending)
+            .sort(columns, descending=descending)
+        )
+    page_df = lf.slice(offset, page_size).collect()
+    return page_df, -(-row_count // page_size)
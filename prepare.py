@@ -1,4 +1,38 @@
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
 import pandas as pd
+import polars as pl
+from operations import (
+    POPULARITY_BIN_EDGES, add_popularity_change, build_category_cube, build_genre_masks, build_popularity_sums,
+    check_category_cube
+)
+from rollups import build_leaderboards, build_rollup, check_leaderboards
+from search import build_search_table
+from sketches import MetricSketches, build_category_sketches, build_popularity_sketches, check_metric_sketches
+from storage import (
+    ALBUM_LEADERBOARDS, ALBUM_ROLLUP, ARTIST_LEADERBOARDS, ARTIST_ROLLUP, CATEGORY_CUBE, CATEGORY_SKETCHES, DATA_DIR,
+    GENRE_MAP, HISTOGRAM_DATA, POPULARITY_SKETCHES, POPULARITY_SUMS, PREPARED_DATA, SEARCH_INDEX, apply_prepared_schema,
+    encode_list_columns, get_genre_names, get_prepared_schema, get_snapshot_dir, get_table_path, hash_file, list_snapshots,
+    replace_atomically, scan_prepared_data, write_manifest, write_scan_table, write_table
+)
+
+INPUT_FILE_PATH = "https://raw.githubusercontent.com/plotly/Figure-Friday/main/2024/week-34/dataset.csv"
+HISTOGRAM_METRICS = [
+    'popularity', 'duration_min', 'danceability', 'energy', 'key', 'loudness', 'mode',
+    'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence'
+]
+# Rollup and leaderboards tables of each entity of rollups.py
+ROLLUP_TABLES = {'artist': (ARTIST_ROLLUP, ARTIST_LEADERBOARDS), 'album': (ALBUM_ROLLUP, ALBUM_LEADERBOARDS)}
+# Checkpoints of the sharded engine, kept in the output directory between runs
+STAGES_DIR = 'stages'
+# Changing what a stage writes must bump this, so checkpoints of older code are redone
+STAGE_VERSION = 1
 
 def drop_duplicates(df):
     df = df.drop_duplicates(subset=['track_name', 'artists', 'genre'], keep='first')
@@ -6,7 +40,7 @@ def drop_duplicates(df):
 
 def combine_duplicates(df):
     combined_genres = df.groupby('track_id').agg(
-        genres=('genre', lambda x: '-'.join(pd.unique(x)))
+        genres=('genre', lambda x: list(pd.unique(x)))
     ).reset_index()
     df_unique = df.drop_duplicates(subset='track_id', keep='first')
     combined_df = df_unique.merge(combined_genres, on='track_id')
@@ -32,7 +66,7 @@ def map_genre(df, genre_map_df):
     return df
 
 def create_histogram_data(df, column):
-    bins = [0, 25, 50, 75, 100]
+    bins = POPULARITY_BIN_EDGES
     labels = [f'{i}-{j}' for i, j in zip(bins[:-1], bins[1:])]
     df[f'{column}_bin'] = pd.cut(df[column], bins=bins, labels=labels, right=False)
     histogram_data = df.groupby('popularity_bin', observed=True).agg(
@@ -53,12 +87,97 @@ def create_histogram_data(df, column):
     histogram_data = histogram_data.round(decimals=2)
     return histogram_data
 
-def prepare():
-    input_file_path = "https://raw.githubusercontent.com/plotly/Figure-Friday/main/2024/week-34/dataset.csv"
-    map_file_path = "data/genre_map.csv"
-    prepared_file_path = "data/spotify_data_prepared.csv"
-    histogram_data_path = "data/histogram_data.csv"
-    df = pd.read_csv(input_file_path)
+def true_divide(expr, divisor):
+    # polars divides floats by a scalar through its reciprocal, which can be one ulp off
+    # numpy's true division; dividing by a broadcast column gives the exact quotient
+    return expr / pl.repeat(float(divisor), pl.len())
+
+def round_half_even(expr, decimals):
+    """Round the way numpy, and so pandas, does: scale, round half to even, scale back."""
+    scaled = expr * 10.0 ** decimals
+    rounded = (
+        pl.when(scaled - scaled.floor() == 0.5)
+        .then((scaled / 2).round(0) * 2)
+        .otherwise(scaled.round(0))
+    )
+    return true_divide(rounded, 10 ** decimals)
+
+def add_genre_columns(df, genre_map_df):
+    """Add the general genres of all the genres of each track and the bitmask of its genres."""
+    general_genres = (
+        pl.col('genres')
+        .list.eval(pl.element().replace_strict(genre_map_df['genre'], genre_map_df['general_genre'], default=None))
+        .list.drop_nulls()
+        .list.unique(maintain_order=True)
+    )
+    return df.with_columns(general_genres=general_genres).hstack(
+        build_genre_masks(df['genres'], get_genre_names(genre_map_df))
+    )
+
+def scan_input(input_file_path):
+    if input_file_path.startswith(('http://', 'https://')):
+        return pl.read_csv(input_file_path, infer_schema_length=10000).lazy()
+    return pl.scan_csv(input_file_path, infer_schema_length=10000)
+
+def build_row_plan(lf, genre_map_df):
+    """Steps of the preparation that transform each row on its own, so they can run on any shard of the rows."""
+    return lf.rename({'track_genre': 'genre'}).with_columns(
+        duration_min=round_half_even(true_divide(pl.col('duration_ms'), 60000), 2),
+        explicit=pl.col('explicit').cast(pl.Utf8).replace({'true': 'Yes', 'false': 'No'}),
+        general_genre=pl.col('genre').replace_strict(genre_map_df['genre'], genre_map_df['general_genre'], default=None),
+    )
+
+def build_merge_plan(lf):
+    """Steps of the preparation across rows: dropping duplicates, combining genres and numbering the tracks.
+
+    Artist names are formatted here, after the duplicates are found on the raw names.
+    """
+    lf = lf.unique(subset=['track_name', 'artists', 'genre'], keep='first', maintain_order=True)
+    combined_genres = lf.group_by('track_id').agg(
+        pl.col('genre').unique(maintain_order=True).alias('genres')
+    )
+    lf = (
+        lf.unique(subset='track_id', keep='first', maintain_order=True)
+        .join(combined_genres, on='track_id', how='left')
+        .with_columns(artists=pl.col('artists').str.replace_all(';', ' ft. ', literal=True))
+        .with_row_index('index')
+        .with_columns(pl.col('index').cast(pl.Int64))
+        .drop(['', 'Unnamed: 0', 'duration_ms'], strict=False)
+    )
+    # Same column order as the pandas steps, which add the genres before the converted columns
+    columns = lf.collect_schema().names()
+    derived_columns = ['duration_min', 'general_genre']
+    return lf.select([col for col in columns if col not in derived_columns] + derived_columns)
+
+def build_prepared_plan(lf, genre_map_df):
+    """Polars counterpart of the pandas steps in ``prepare``, expressed as a single lazy query."""
+    return build_merge_plan(build_row_plan(lf, genre_map_df))
+
+def build_histogram_plan(lf, column):
+    bins = POPULARITY_BIN_EDGES
+    labels = [f'{i}-{j}' for i, j in zip(bins[:-1], bins[1:])]
+    bin_dtype = pl.Enum(labels)
+    histogram_lf = (
+        lf.with_columns(
+            pl.col(column).cut(bins, labels=['below', *labels, 'above'], left_closed=True)
+            .cast(pl.Utf8).alias(f'{column}_bin')
+        )
+        .filter(pl.col(f'{column}_bin').is_in(labels))
+        .group_by(pl.col(f'{column}_bin').cast(bin_dtype))
+        .agg(
+            [pl.col('track_id').count().cast(pl.Int64).alias('count')]
+            + [pl.col(metric).mean() for metric in HISTOGRAM_METRICS]
+        )
+        .sort(f'{column}_bin')
+        .with_columns(
+            pl.col(f'{column}_bin').cast(pl.Utf8),
+            *[round_half_even(pl.col(metric), 2) for metric in HISTOGRAM_METRICS]
+        )
+    )
+    return histogram_lf
+
+def prepare_with_pandas(input_file_path, map_file_path):
+    df = pd.read_csv(input_file_path, float_precision='round_trip')
     genre_map_df = pd.read_csv(map_file_path)
     
     df = df.rename(columns={'track_genre': 'genre'})
@@ -69,10 +188,214 @@ def prepare():
     prepared_df = map_genre(prepared_df, genre_map_df)
     prepared_df = prepared_df.reset_index()
     prepared_df = prepared_df.drop(columns=['Unnamed: 0', 'duration_ms'])
-    prepared_df = format_artist_name(df, 'artists')
-    prepared_df.to_csv(prepared_file_path, index=False)
+    prepared_df = format_artist_name(prepared_df, 'artists')
+    prepared_pl_df = pl.from_pandas(prepared_df)
     histogram_df = create_histogram_data(prepared_df, 'popularity')
-    histogram_df.to_csv(histogram_data_path, index=False)
+    histogram_pl_df = pl.from_pandas(histogram_df.astype({'popularity_bin': str}))
+    return prepared_pl_df, histogram_pl_df, pl.from_pandas(genre_map_df)
+
+def prepare_with_polars(input_file_path, map_file_path):
+    genre_map_df = pl.read_csv(map_file_path)
+    prepared_lf = build_prepared_plan(scan_input(input_file_path), genre_map_df)
+    histogram_lf = build_histogram_plan(prepared_lf, 'popularity')
+    prepared_pl_df, histogram_pl_df = pl.collect_all([prepared_lf, histogram_lf], streaming=True)
+    return prepared_pl_df, histogram_pl_df, genre_map_df
+
+def get_input_paths(input_file_paths):
+    """Expand the globs among ``input_file_paths``, in order. URLs and paths without a match are kept as they are."""
+    input_paths = []
+    for input_file_path in input_file_paths:
+        input_paths.extend(sorted(glob.glob(input_file_path)) or [input_file_path])
+    return input_paths
+
+def get_stage_key(*inputs):
+    return hashlib.sha1(json.dumps([STAGE_VERSION, *inputs]).encode()).hexdigest()[:12]
+
+def read_stage_keys(stages_dir):
+    path = os.path.join(stages_dir, 'stages.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as stages_file:
+        return json.load(stages_file)
+
+def write_stage_key(stages_dir, stage, key):
+    stage_keys = {**read_stage_keys(stages_dir), stage: key}
+    with replace_atomically(os.path.join(stages_dir, 'stages.json')) as path:
+        with open(path, 'w') as stages_file:
+            json.dump(stage_keys, stages_file, indent=2)
+
+def prepare_shard(input_file_path, map_file_path, schema, output_path):
+    """Run the per-row steps on one input file and write the result to ``output_path``.
+
+    Duplicates within the shard are dropped already, which keeps the first of them like
+    the merge does, so the merge has fewer rows to go through.
+    """
+    genre_map_df = pl.read_csv(map_file_path)
+    shard_df = (
+        build_row_plan(pl.scan_csv(input_file_path, schema=schema), genre_map_df)
+        .unique(subset=['track_name', 'artists', 'genre'], keep='first', maintain_order=True)
+        .collect(streaming=True)
+    )
+    with replace_atomically(output_path) as path:
+        shard_df.write_parquet(path)
+
+def prepare_with_shards(input_file_paths, map_file_path, stages_dir, jobs=None):
+    """Prepare the export split over ``input_file_paths`` with a process per shard, resuming earlier runs.
+
+    The files are shards of one export, in order. Each goes through the per-row steps in
+    its own process, then a merge drops the duplicates across shards, combines the genres
+    and aggregates the histogram data, the same way as the polars engine on the
+    concatenated export. Every stage writes its result under ``stages_dir`` and records a
+    key of its inputs: the size and mtime of its input file, the genre map and the code
+    version for a shard, the keys of the shards for the merge. A rerun skips the stages
+    whose key is unchanged, so it resumes after a failure and redoes only changed shards.
+    """
+    os.makedirs(stages_dir, exist_ok=True)
+    stage_keys = read_stage_keys(stages_dir)
+    genre_map_df = pl.read_csv(map_file_path)
+    # Shards read with one schema, inferred like the polars engine does from the first rows
+    schema = pl.scan_csv(input_file_paths[0], infer_schema_length=10000).collect_schema()
+    schema_key = {col: str(dtype) for col, dtype in schema.items()}
+    map_key = hash_file(map_file_path)
+
+    shards = []
+    for shard, input_file_path in enumerate(input_file_paths):
+        stat = os.stat(input_file_path)
+        key = get_stage_key(os.path.abspath(input_file_path), stat.st_size, stat.st_mtime_ns, map_key, schema_key)
+        shards.append((f'shard-{shard}', key, input_file_path, os.path.join(stages_dir, f'shard-{shard}.parquet')))
+    pending_shards = [
+        (stage, key, input_file_path, output_path) for stage, key, input_file_path, output_path in shards
+        if stage_keys.get(stage) != key or not os.path.exists(output_path)
+    ]
+    if pending_shards:
+        jobs = min(jobs or os.cpu_count(), len(pending_shards))
+        # polars sizes its thread pool once per process, so the workers split the cores
+        # instead of each starting a thread per core
+        polars_threads = os.environ.get('POLARS_MAX_THREADS')
+        os.environ['POLARS_MAX_THREADS'] = str(max(1, os.cpu_count() // jobs))
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=mp.get_context('spawn')) as executor:
+                futures = {
+                    executor.submit(prepare_shard, input_file_path, map_file_path, schema, output_path): (stage, key)
+                    for stage, key, input_file_path, output_path in pending_shards
+                }
+                for future in as_completed(futures):
+                    future.result()
+                    write_stage_key(stages_dir, *futures[future])
+        finally:
+            if polars_threads is None:
+                del os.environ['POLARS_MAX_THREADS']
+            else:
+                os.environ['POLARS_MAX_THREADS'] = polars_threads
+
+    merged_key = get_stage_key([key for _, key, _, _ in shards])
+    prepared_path = os.path.join(stages_dir, f'{PREPARED_DATA}.parquet')
+    histogram_path = os.path.join(stages_dir, f'{HISTOGRAM_DATA}.parquet')
+    if stage_keys.get('merge') != merged_key or not os.path.exists(prepared_path) or not os.path.exists(histogram_path):
+        prepared_lf = build_merge_plan(pl.scan_parquet([output_path for _, _, _, output_path in shards]))
+        histogram_lf = build_histogram_plan(prepared_lf, 'popularity')
+        prepared_pl_df, histogram_pl_df = pl.collect_all([prepared_lf, histogram_lf], streaming=True)
+        for path, df in [(prepared_path, prepared_pl_df), (histogram_path, histogram_pl_df)]:
+            with replace_atomically(path) as temporary_path:
+                df.write_parquet(temporary_path)
+        write_stage_key(stages_dir, 'merge', merged_key)
+    else:
+        prepared_pl_df, histogram_pl_df = pl.read_parquet(prepared_path), pl.read_parquet(histogram_path)
+    return prepared_pl_df, histogram_pl_df, genre_map_df
+
+def get_previous_snapshot(snapshot, data_dir=DATA_DIR):
+    earlier_snapshots = [name for name in list_snapshots(data_dir) if name < snapshot]
+    return earlier_snapshots[-1] if earlier_snapshots else None
+
+def prepare(engine='pandas', input_file_path=INPUT_FILE_PATH, data_dir=DATA_DIR, snapshot=None, jobs=None):
+    """Prepare one catalog export into ``data_dir``.
+
+    The sharded engine takes a list of files or globs as ``input_file_path``, the shards
+    of the export, and runs ``jobs`` processes.
+
+    With ``snapshot``, an ISO date, the export becomes a new partition under
+    ``data_dir/snapshots`` and the partitions already there are left as they are. Only the
+    new partition's aggregates are computed, along with the popularity change of each
+    track since the snapshot before it. Partitions added later than the new one keep the
+    change they recorded when they were prepared.
+    """
+    map_file_path = get_table_path(GENRE_MAP, 'csv', data_dir)
+    output_dir = data_dir if snapshot is None else get_snapshot_dir(snapshot, data_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    prepared_file_path = get_table_path(PREPARED_DATA, 'csv', output_dir)
+    histogram_data_path = get_table_path(HISTOGRAM_DATA, 'csv', output_dir)
+    if engine == 'sharded':
+        input_file_paths = get_input_paths([input_file_path] if isinstance(input_file_path, str) else input_file_path)
+        prepared_pl_df, histogram_pl_df, genre_map_df = prepare_with_shards(
+            input_file_paths, map_file_path, os.path.join(output_dir, STAGES_DIR), jobs
+        )
+    elif engine == 'polars':
+        prepared_pl_df, histogram_pl_df, genre_map_df = prepare_with_polars(input_file_path, map_file_path)
+    else:
+        prepared_pl_df, histogram_pl_df, genre_map_df = prepare_with_pandas(input_file_path, map_file_path)
+    prepared_pl_df = apply_prepared_schema(add_genre_columns(prepared_pl_df, genre_map_df), get_prepared_schema(genre_map_df))
+    if snapshot is not None:
+        previous_snapshot = get_previous_snapshot(snapshot, data_dir)
+        previous_df = None if previous_snapshot is None else scan_prepared_data(
+            get_snapshot_dir(previous_snapshot, data_dir), check_format=False
+        )
+        prepared_pl_df = add_popularity_change(prepared_pl_df, previous_df)
+
+    # Every file is replaced atomically and the manifest goes last, so a running app
+    # reloads only once the whole new dataset is in place. Partitions skip the tracks
+    # CSV, they are read from the Arrow and Parquet files
+    if snapshot is None:
+        with replace_atomically(prepared_file_path) as path:
+            encode_list_columns(prepared_pl_df).write_csv(path)
+    category_cube_df = build_category_cube(prepared_pl_df)
+    check_category_cube(category_cube_df, prepared_pl_df)
+    with replace_atomically(get_table_path(CATEGORY_CUBE, 'parquet', output_dir)) as path:
+        category_cube_df.write_parquet(path)
+    with replace_atomically(get_table_path(POPULARITY_SUMS, 'parquet', output_dir)) as path:
+        build_popularity_sums(prepared_pl_df).write_parquet(path)
+    popularity_sketches_df = build_popularity_sketches(prepared_pl_df)
+    category_sketches_df = build_category_sketches(prepared_pl_df)
+    check_metric_sketches(MetricSketches(popularity_sketches_df, category_sketches_df), prepared_pl_df)
+    for name, sketches_df in [(POPULARITY_SKETCHES, popularity_sketches_df), (CATEGORY_SKETCHES, category_sketches_df)]:
+        with replace_atomically(get_table_path(name, 'parquet', output_dir)) as path:
+            sketches_df.write_parquet(path)
+    for entity, (rollup_name, leaderboards_name) in ROLLUP_TABLES.items():
+        rollup_df = build_rollup(prepared_pl_df, entity)
+        leaderboards_df = build_leaderboards(prepared_pl_df, entity)
+        check_leaderboards(leaderboards_df, rollup_df, entity)
+        for name, df in [(rollup_name, rollup_df), (leaderboards_name, leaderboards_df)]:
+            with replace_atomically(get_table_path(name, 'parquet', output_dir)) as path:
+                df.write_parquet(path)
+    sorted_prepared_pl_df = prepared_pl_df.sort('popularity', descending=True)
+    write_table(sorted_prepared_pl_df, PREPARED_DATA, output_dir)
+    write_scan_table(sorted_prepared_pl_df, PREPARED_DATA, output_dir)
+    # Search postings are row positions, so they are built on the same sorted order
+    write_table(build_search_table(sorted_prepared_pl_df), SEARCH_INDEX, output_dir)
+    with replace_atomically(histogram_data_path) as path:
+        histogram_pl_df.write_csv(path)
+    write_table(histogram_pl_df, HISTOGRAM_DATA, output_dir)
+    write_table(genre_map_df, GENRE_MAP, output_dir)
+    write_manifest(
+        [
+            PREPARED_DATA, CATEGORY_CUBE, POPULARITY_SUMS, POPULARITY_SKETCHES, CATEGORY_SKETCHES, SEARCH_INDEX, HISTOGRAM_DATA,
+            GENRE_MAP, *[name for names in ROLLUP_TABLES.values() for name in names]
+        ],
+        output_dir
+    )
 
 if __name__ == "__main__":
-    prepare()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Prepare the Spotify tracks dataset for the dashboard.')
+    parser.add_argument('--engine', choices=['pandas', 'polars', 'sharded'], default='pandas',
+                        help='dataframe library used for the preparation steps, or polars over shards in parallel')
+    parser.add_argument('--input', nargs='+', default=[INPUT_FILE_PATH],
+                        help='path or URL of the raw tracks CSV; the sharded engine takes several files or globs')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='directory holding the genre map and the outputs')
+    parser.add_argument('--snapshot', type=date.fromisoformat,
+                        help='date of the export, which is added to the data directory as a new snapshot partition')
+    parser.add_argument('--jobs', type=int, help='processes of the sharded engine, one per core by default')
+    args = parser.parse_args()
+    if args.engine != 'sharded' and len(args.input) > 1:
+        parser.error(f'the {args.engine} engine reads a single --input file')
+    snapshot = args.snapshot.isoformat() if args.snapshot else None
+    input_file_path = args.input if args.engine == 'sharded' else args.input[0]
+    prepare(engine=args.engine, input_file_path=input_file_path, data_dir=args.data_dir, snapshot=snapshot, jobs=args.jobs)
@@ -0,0 +1,38 @@
+"""Liveness and readiness probes for load balancers and orchestrators.
+
+``/health`` answers as soon as the process does. ``/ready`` answers 503 until the data
+store has loaded the data and run its warm-up, and 200 after, with the data version and
+the load times. Dash prepares itself on the first request to any path, building the
+layout, which waits for the data. So the probes are answered by WSGI middleware in front
+of Flask, and neither waits for the data.
+"""
+import json
+
+HEALTH_PATH = '/health'
+READY_PATH = '/ready'
+
+class ProbeMiddleware:
+    def __init__(self, wsgi_app, data_store):
+        self.wsgi_app = wsgi_app
+        self.data_store = data_store
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO')
+        if path == HEALTH_PATH:
+            status, body = '200 OK', {'status': 'ok'}
+        elif path == READY_PATH:
+            body = self.data_store.get_status()
+            status = '200 OK' if body['ready'] else '503 Service Unavailable'
+        else:
+            return self.wsgi_app(environ, start_response)
+        data = json.dumps(body).encode()
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(data))),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [data]
+
+def install(server, data_store):
+    """Answer /health and /ready ahead of the Flask server's own routes."""
+    server.wsgi_app = ProbeMiddleware(server.wsgi_app, data_store)
@@ -0,0 +1,175 @@
+"""Artist and album rollups of the tracks, and their leaderboards.
+
+Artists are a dimension of their own: prepare.format_artist_name joins the artists of a
+track with ' ft. ', which is split apart again so a track counts for each of its artists.
+An album is keyed on its name and the first artist of its tracks, so albums sharing a
+name stay apart.
+
+A rollup holds one row per artist or album with its track count, mean and maximum
+popularity and mean audio features. The leaderboards are the top rows of the rollups of
+the tracks in every popularity bin and of every genre and general genre, ranked every
+way the dashboard offers. They are computed by prepare.py, so the dashboard serves a
+leaderboard as a slice of one table instead of grouping the tracks on every request.
+"""
+import polars as pl
+from operations import ALL, POPULARITY_BINS, filter_by_bin
+from search import ARTIST_SEPARATOR
+from similarity import FEATURE_COLUMNS
+
+ENTITIES = ['artist', 'album']
+ENTITY_KEYS = {'artist': ['artist'], 'album': ['album_name', 'artist']}
+ROLLUP_METRICS = ['duration_min'] + FEATURE_COLUMNS
+LEADERBOARD_CATEGORIES = ['general_genres', 'genres']
+RANKINGS = ['mean_popularity', 'max_popularity', 'tracks']
+LEADERBOARD_SIZE = 50
+SCOPE_COLUMNS = ['category', 'value', 'popularity_bin', 'ranking']
+
+def get_entity_frame(df, entity):
+    """Return ``df`` as a LazyFrame with the key columns of ``entity``, one row per track and artist for artists."""
+    artists = pl.col('artists').str.split(ARTIST_SEPARATOR)
+    lf = df.lazy().drop_nulls('artists')
+    if entity == 'artist':
+        return lf.with_columns(artist=artists).explode('artist')
+    return lf.drop_nulls('album_name').with_columns(artist=artists.list.first())
+
+def get_ranking_aggregates():
+    return [
+        pl.len().cast(pl.Int64).alias('tracks'),
+        pl.col('popularity').cast(pl.Float64).mean().cast(pl.Float32).alias('mean_popularity'),
+        pl.col('popularity').max().alias('max_popularity'),
+    ]
+
+def get_metric_aggregates(metrics=ROLLUP_METRICS):
+    return [pl.col(metric).cast(pl.Float64).mean().cast(pl.Float32) for metric in metrics]
+
+def get_ranking_columns(ranking):
+    # Ties are broken on the track count and the mean popularity, then on the keys
+    return [ranking] + [col for col in ['tracks', 'mean_popularity'] if col != ranking]
+
+def rank_by(lf, ranking, keys):
+    """Sort ``lf`` best first on ``ranking``."""
+    ranking_columns = get_ranking_columns(ranking)
+    return lf.sort(ranking_columns + keys, descending=[True] * len(ranking_columns) + [False] * len(keys))
+
+def get_top(lf, ranking, keys, size, group_by):
+    """Return the best ``size`` rows of every ``group_by`` group of ``lf``, with their rank."""
+    # Rows below the size-th value of the ranking in their group cannot make it, and
+    # ranking the numeric columns of the others leaves only the top rows and their ties
+    # to sort, which is much cheaper than sorting a million groups on their names
+    ranking_columns = get_ranking_columns(ranking)
+    threshold = pl.col(ranking).top_k(size).min().over(group_by)
+    numeric_rank = pl.struct(ranking_columns).rank('min', descending=True).over(group_by)
+    return (
+        rank_by(lf.filter(pl.col(ranking) >= threshold).filter(numeric_rank <= size), ranking, keys)
+        .with_columns(rank=(pl.int_range(pl.len()).over(group_by) + 1).cast(pl.Int32))
+        .filter(pl.col('rank') <= size)
+    )
+
+def build_rollup(df, entity, metrics=ROLLUP_METRICS):
+    """Return one row per artist or album of ``df``, the most popular on average first."""
+    keys = ENTITY_KEYS[entity]
+    lf = get_entity_frame(df, entity).group_by(keys).agg(get_ranking_aggregates() + get_metric_aggregates(metrics))
+    return rank_by(lf, 'mean_popularity', keys).collect()
+
+def build_leaderboards(df, entity, categories=LEADERBOARD_CATEGORIES, popularity_bins=POPULARITY_BINS,
+                       rankings=RANKINGS, size=LEADERBOARD_SIZE, metrics=ROLLUP_METRICS):
+    """Return the top ``size`` artists or albums of every scope of ``df``, under every ranking.
+
+    A scope is the tracks of one popularity bin, or ``'all'``, holding one value of a
+    category, or ``'all'``. Artists and albums are ranked on the rollup of the tracks in
+    the scope. Rows are sorted by scope, ranking and rank, so each leaderboard is a
+    contiguous run of rows.
+    """
+    keys = ENTITY_KEYS[entity]
+    # Every scope reads the same rows, which are split into artists once, with their
+    # genres as Categoricals, so the scopes group on integer codes
+    entity_lf = (
+        get_entity_frame(df, entity)
+        .select([*keys, 'popularity', *metrics, *categories])
+        .with_columns([pl.col(category).cast(pl.List(pl.Categorical)) for category in categories])
+        .collect()
+        .lazy()
+    )
+    scopes = []
+    for popularity_bin in [ALL] + popularity_bins:
+        bin_lf = entity_lf if popularity_bin == ALL else filter_by_bin(entity_lf, popularity_bin)
+        for category in [ALL] + categories:
+            # A track counts under each of its genres
+            if category == ALL:
+                scope_lf = bin_lf.with_columns(value=pl.lit(ALL, dtype=pl.Categorical))
+            else:
+                scope_lf = bin_lf.explode(category).drop_nulls(category).with_columns(value=pl.col(category))
+            scopes.append((category, popularity_bin, scope_lf))
+    # The artists or albums are ranked first, then only those making a leaderboard get
+    # their audio features averaged, which halves the time spent grouping
+    ranked_dfs = pl.collect_all([
+        scope_lf.group_by(['value', *keys]).agg(get_ranking_aggregates()) for _, _, scope_lf in scopes
+    ])
+    top_dfs = pl.collect_all([
+        pl.concat([
+            get_top(ranked_df.lazy(), ranking, keys, size, 'value').with_columns(ranking=pl.lit(ranking))
+            for ranking in rankings
+        ])
+        for ranked_df in ranked_dfs
+    ])
+    leaderboards_df = pl.concat(pl.collect_all([
+        top_df.lazy().join(
+            scope_lf.join(top_df.lazy().select(['value', *keys]).unique(), on=['value', *keys], how='semi')
+            .group_by(['value', *keys])
+            .agg(get_metric_aggregates(metrics)),
+            on=['value', *keys], how='left'
+        )
+        .with_columns(pl.col('value').cast(pl.Utf8), category=pl.lit(category), popularity_bin=pl.lit(popularity_bin))
+        for (category, popularity_bin, scope_lf), top_df in zip(scopes, top_dfs)
+    ]))
+    leading_columns = SCOPE_COLUMNS + ['rank']
+    return (
+        leaderboards_df.select(leading_columns + [col for col in leaderboards_df.columns if col not in leading_columns])
+        .sort(leading_columns)
+    )
+
+def check_leaderboards(leaderboards_df, rollup_df, entity, rankings=RANKINGS, size=LEADERBOARD_SIZE, tolerance=1e-4):
+    """Compare the leaderboards of all the tracks with the top of the rollup and raise ValueError on any mismatch."""
+    keys = ENTITY_KEYS[entity]
+    errors = []
+    for ranking in rankings:
+        expected_df = rank_by(rollup_df.lazy(), ranking, keys).head(size).collect()
+        leaderboard_df = leaderboards_df.filter(
+            (pl.col('category') == ALL) & (pl.col('value') == ALL) & (pl.col('popularity_bin') == ALL)
+            & (pl.col('ranking') == ranking)
+        )
+        if leaderboard_df.select(keys).rows() != expected_df.select(keys).rows():
+            errors.append(f'{ranking}: the top {size} differ from the rollup')
+            continue
+        for col in expected_df.columns:
+            if col in keys:
+                continue
+            difference = (leaderboard_df[col].cast(pl.Float64) - expected_df[col].cast(pl.Float64)).abs().max()
+            if difference is not None and difference > tolerance * max(1, expected_df[col].cast(pl.Float64).abs().max()):
+                errors.append(f'{ranking}: {col} differs by {difference}')
+    if errors:
+        raise ValueError(f'{entity.title()} leaderboards are inconsistent with the rollup:\n' + '\n'.join(errors))
+
+class Leaderboards:
+    """The leaderboards of one entity, each served as a zero-copy slice of their table."""
+    def __init__(self, leaderboards_df):
+        self.leaderboards_df = leaderboards_df.rechunk()
+        scopes_df = leaderboards_df.group_by(SCOPE_COLUMNS, maintain_order=True).agg(pl.len().alias('length'))
+        offsets = scopes_df['length'].cum_sum() - scopes_df['length']
+        self.scopes = {
+            scope[:len(SCOPE_COLUMNS)]: (offset, scope[-1])
+            for scope, offset in zip(scopes_df.iter_rows(), offsets)
+        }
+        self.values = {
+            category: sorted({value for scope_category, value, _, _ in self.scopes if scope_category == category})
+            for category in {category for category, _, _, _ in self.scopes}
+        }
+
+    def get_values(self, category):
+        """Return the values of ``category`` that have leaderboards, in alphabetical order."""
+        return self.values.get(category, [])
+
+    def get(self, category=ALL, value=ALL, popularity_bin=ALL, ranking=RANKINGS[0]):
+        """Return the leaderboard of one scope and ranking, empty when the scope holds no track."""
+        offset, length = self.scopes.get((category, value, popularity_bin, ranking), (0, 0))
+        return self.leaderboards_df.slice(offset, length).drop(SCOPE_COLUMNS)
@@ -0,0 +1,176 @@
+import re
+import numpy as np
+import polars as pl
+
+SEARCH_COLUMNS = ['track_name', 'artists', 'album_name']
+# Words are runs of letters and digits, the same pattern in polars and in Python
+WORD_PATTERN = r'[^\W_]+'
+# prepare.format_artist_name joins artists with ' ft. ', which is not part of any name
+ARTIST_SEPARATOR = ' ft. '
+MIN_FUZZY_LENGTH = 4
+
+def tokenize(text):
+    return re.findall(WORD_PATTERN, text.replace(ARTIST_SEPARATOR, ' ').lower())
+
+def get_grams(word, size=3):
+    padded = f'^{word}$'
+    return {padded[i:i + size] for i in range(len(padded) - size + 1)}
+
+def build_gram_index(vocabulary, size):
+    """Return the sorted grams of ``size`` letters of the padded words of ``vocabulary``, and their word ids."""
+    gram_df = (
+        pl.DataFrame({'token': vocabulary})
+        .with_row_index('token_id')
+        .with_columns(padded=pl.concat_str(pl.lit('^'), pl.col('token'), pl.lit('$')))
+        .with_columns(offset=pl.int_ranges(0, pl.col('padded').str.len_chars() - size + 1))
+        .explode('offset')
+        .select('token_id', gram=pl.col('padded').str.slice(pl.col('offset'), size))
+        .unique(maintain_order=True)
+        .group_by('gram')
+        .agg(pl.col('token_id').sort())
+        .sort('gram')
+    )
+    offsets = np.concatenate([[0], np.cumsum(gram_df['token_id'].list.len().to_numpy(), dtype=np.int64)])
+    return gram_df['gram'], gram_df['token_id'].explode().to_numpy(), offsets
+
+def edit_distance(a, b, max_distance):
+    """Return the optimal string alignment distance of ``a`` and ``b``, or ``max_distance + 1`` past it."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_row = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        previous_row, row = row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before_previous_row[j - 2] + 1)
+        before_previous_row = previous_row
+        if min(row) > max_distance:
+            return max_distance + 1
+    return row[-1]
+
+def intersect_sorted(a, b):
+    """Return the values in both sorted, duplicate-free arrays.
+
+    A much shorter array is binary searched in the longer one, arrays of similar length
+    are merged.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) * 16 > len(b):
+        return np.intersect1d(a, b, assume_unique=True)
+    found = np.searchsorted(b, a)
+    found[found == len(b)] = 0
+    return a[b[found] == a] if len(b) else b
+
+def build_search_table(df, columns=SEARCH_COLUMNS):
+    """Return the inverted index of ``df``: one row per word with the sorted row positions holding it.
+
+    Positions are row numbers of ``df``, so the table only fits frames in the same order.
+    """
+    text = pl.concat_str(
+        [
+            (pl.col(col).str.replace_all(ARTIST_SEPARATOR, ' ', literal=True) if col == 'artists' else pl.col(col))
+            .cast(pl.Utf8).fill_null('')
+            for col in columns
+        ],
+        separator=' '
+    )
+    return (
+        df.lazy()
+        .select(token=text.str.to_lowercase().str.extract_all(WORD_PATTERN).list.unique())
+        .with_row_index('position')
+        .explode('token')
+        .drop_nulls('token')
+        .group_by('token')
+        .agg(pl.col('position').sort().alias('positions'))
+        .sort('token')
+        .collect()
+    )
+
+class SearchIndex:
+    """Word search over the names, artists and albums of the tracks.
+
+    Postings of every word are kept in one array, in vocabulary order, with the track
+    positions of each word sorted. Words sharing a prefix are neighbours in the sorted
+    vocabulary, so a prefix query reads a single contiguous slice of postings. A word
+    missing from the vocabulary falls back to the words within one typo of it, two for
+    long words, found through trigram and bigram indexes of the vocabulary. The tracks
+    are sorted by popularity, so results come out most popular first.
+    """
+    def __init__(self, search_df, keys):
+        self.vocabulary = search_df['token']
+        self.postings = search_df['positions'].explode().to_numpy().astype(np.uint32)
+        self.offsets = np.concatenate([[0], np.cumsum(search_df['positions'].list.len().to_numpy(), dtype=np.int64)])
+        # Row position -> prepared row index, the key the track table reports back
+        self.keys = keys
+
+        # Gram size -> sorted grams, the word ids holding each gram and their offsets
+        self.gram_indexes = {size: build_gram_index(self.vocabulary, size) for size in (2, 3)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_token_range(self, word, prefix=False):
+        start = self.vocabulary.search_sorted(word, side='left')
+        end = self.vocabulary.search_sorted(word + '\U0010ffff' if prefix else word, side='left' if prefix else 'right')
+        return int(start), int(end)
+
+    def get_similar_tokens(self, word):
+        max_distance = 1 if len(word) < 8 else 2
+        # An edit changes at most n grams of n letters of a word, a transposition n + 1, so a
+        # word within d edits still shares all but (n + 1) * d of them. That can leave no
+        # trigram in common, as for lvoe and love, and those words are found by bigrams
+        size = 3 if len(word) - 4 * max_distance >= 1 else 2
+        grams = get_grams(word, size)
+        gram_values, gram_tokens, gram_offsets = self.gram_indexes[size]
+        token_ids = []
+        for gram in grams:
+            position = int(gram_values.search_sorted(gram))
+            if position < len(gram_values) and gram_values[position] == gram:
+                token_ids.append(gram_tokens[gram_offsets[position]:gram_offsets[position + 1]])
+        if not token_ids:
+            return []
+        candidates, shared = np.unique(np.concatenate(token_ids), return_counts=True)
+        candidates = candidates[shared >= max(1, len(grams) - (size + 1) * max_distance)]
+        tokens = self.vocabulary.gather(candidates).to_list()
+        return [
+            token_id for token_id, token in zip(candidates, tokens)
+            if edit_distance(word, token, max_distance) <= max_distance
+        ]
+
+    def match_word(self, word, prefix=False):
+        """Return the sorted positions of the tracks holding ``word``, or a word it starts, with ``prefix``."""
+        start, end = self.get_token_range(word, prefix)
+        if end - start == 1:
+            return self.postings[self.offsets[start]:self.offsets[end]]
+        if end > start:
+            return np.unique(self.postings[self.offsets[start]:self.offsets[end]])
+        if len(word) < MIN_FUZZY_LENGTH:
+            return self.postings[:0]
+        postings = [
+            self.postings[self.offsets[token_id]:self.offsets[token_id + 1]] for token_id in self.get_similar_tokens(word)
+        ]
+        if len(postings) < 2:
+            return postings[0] if postings else self.postings[:0]
+        return np.unique(np.concatenate(postings))
+
+    def search(self, query, start=0, end=None):
+        """Return the sorted positions of the tracks matching every word of ``query``.
+
+        The last word also matches as a prefix, so results follow the query as it is typed.
+        Only positions from ``start`` up to ``end`` are returned, such as the rows of one
+        popularity bin. Returns None when the query holds no word.
+        """
+        words = list(dict.fromkeys(tokenize(query or '')))
+        if not words:
+            return None
+        positions = None
+        for i, word in enumerate(words):
+            word_positions = self.match_word(word, prefix=i == len(words) - 1)
+            positions = word_positions if positions is None else intersect_sorted(positions, word_positions)
+            if not len(positions):
+                break
+        start, end = np.searchsorted(positions, [start, len(self) if end is None else end])
+        return positions[start:end]
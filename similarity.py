@@ -0,0 +1,109 @@
+import numpy as np
+import polars as pl
+
+FEATURE_COLUMNS = [
+    'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+    'instrumentalness', 'liveness', 'valence', 'tempo'
+]
+FILTER_COLUMNS = ['general_genre', 'explicit']
+DISPLAY_COLUMNS = ['track_name', 'artists', 'general_genre', 'explicit', 'popularity']
+
+class SimilarityIndex:
+    """Exact nearest-neighbour search over the standardized audio features of every track.
+
+    The float32 feature matrix is built once and ordered by the filter columns, so every
+    filter value, and every combination of values, is a contiguous range of rows. A
+    filtered query only scans the rows inside the filter instead of discarding
+    neighbours afterwards. Rows are scanned in blocks with one matrix-vector product
+    and one ``argpartition`` each, so no Python loop runs per track.
+    """
+    def __init__(self, df, key_column='index', feature_columns=FEATURE_COLUMNS,
+                 filter_columns=FILTER_COLUMNS, display_columns=None, block_size=262_144):
+        self.feature_columns = feature_columns
+        self.filter_columns = filter_columns
+        self.block_size = block_size
+        columns = [key_column] + feature_columns + filter_columns + (display_columns or [])
+        df = (
+            df.lazy()
+            .select(list(dict.fromkeys(columns)))
+            .with_columns([pl.col(col).cast(pl.Utf8).fill_null('') for col in filter_columns])
+            .sort(filter_columns, maintain_order=True)
+            .collect()
+        )
+        self.rows = df.select(list(dict.fromkeys([key_column] + filter_columns + (display_columns or []))))
+
+        features = df.select(feature_columns).to_numpy().astype(np.float32)
+        mean = np.nanmean(features, axis=0)
+        std = np.nanstd(features, axis=0)
+        std[std == 0] = 1
+        self.features = np.nan_to_num((features - mean) / std)
+        self.squared_norms = np.einsum('ij,ij->i', self.features, self.features)
+
+        keys = df[key_column].to_numpy()
+        self.positions = np.full(keys.max() + 1, -1, dtype=np.int64)
+        self.positions[keys] = np.arange(len(keys))
+
+        # Row ranges of each filter value combination, e.g. ('Rock', 'Yes') -> (start, end)
+        group_df = (
+            df.select(filter_columns)
+            .with_row_index('start')
+            .group_by(filter_columns, maintain_order=True)
+            .agg(pl.col('start').first(), pl.len().alias('length'))
+        )
+        self.ranges = {
+            tuple(row[col] for col in filter_columns): (row['start'], row['start'] + row['length'])
+            for row in group_df.iter_rows(named=True)
+        }
+
+    def __len__(self):
+        return len(self.features)
+
+    def get_position(self, key):
+        if key is None or key < 0 or key >= len(self.positions) or self.positions[key] < 0:
+            return None
+        return int(self.positions[key])
+
+    def get_ranges(self, filters):
+        filters = {col: str(value) for col, value in (filters or {}).items() if col in self.filter_columns}
+        if not filters:
+            return [(0, len(self))]
+        return sorted(
+            row_range for values, row_range in self.ranges.items()
+            if all(values[self.filter_columns.index(col)] == value for col, value in filters.items())
+        )
+
+    def query(self, key, k=10, filters=None):
+        """Return the ``k`` tracks nearest to the track with ``key``, closest first.
+
+        ``filters`` maps filter columns to the value every neighbour must have. The
+        result holds the display columns of the neighbours and their ``distance``.
+        """
+        position = self.get_position(key)
+        if position is None:
+            return self.rows.clear().with_columns(distance=pl.lit(None, dtype=pl.Float32))
+        query_vector = self.features[position]
+        candidate_rows = []
+        candidate_distances = []
+        for start, end in self.get_ranges(filters):
+            for block_start in range(start, end, self.block_size):
+                block_end = min(block_start + self.block_size, end)
+                # ||x - q||^2 without the constant ||q||^2, which does not change the ranking
+                distances = self.squared_norms[block_start:block_end] - 2 * (self.features[block_start:block_end] @ query_vector)
+                if block_start <= position < block_end:
+                    distances[position - block_start] = np.inf
+                if len(distances) > k:
+                    nearest = np.argpartition(distances, k)[:k]
+                else:
+                    nearest = np.arange(len(distances))
+                candidate_rows.append(nearest + block_start)
+                candidate_distances.append(distances[nearest])
+        if not candidate_rows:
+            return self.rows.clear().with_columns(distance=pl.lit(None, dtype=pl.Float32))
+
+        rows = np.concatenate(candidate_rows)
+        distances = np.concatenate(candidate_distances) + self.squared_norms[position]
+        order = np.argsort(distances, kind='stable')[:k]
+        order = order[np.isfinite(distances[order])]
+        return self.rows[rows[order]].with_columns(
+            distance=pl.Series(np.sqrt(np.maximum(distances[order], 0)), dtype=pl.Float32)
+        )
@@ -0,0 +1,238 @@
+import numpy as np
+import polars as pl
+from operations import (
+    ALL, CUBE_METRICS, POPULARITY_BINS, POPULARITY_RANGE, filter_by_bin, get_popularity_bins, is_multi_valued, parse_bin
+)
+
+SKETCH_METRICS = [metric for metric in CUBE_METRICS if metric != 'popularity']
+# genres has over a hundred values, whose sketches would outweigh all the others together
+SKETCH_CATEGORIES = ['general_genres', 'explicit', 'time_signature']
+SKETCH_BUCKETS = 256
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+def get_quantile_name(quantile):
+    return f'p{round(quantile * 100)}'
+
+def add_sketch_buckets(df, metrics=SKETCH_METRICS, buckets=SKETCH_BUCKETS):
+    """Add the sketch bucket of each metric to ``df`` and return it with the value range of every bucket.
+
+    Bucket edges are values of the tracks at evenly spaced quantiles, so each bucket holds
+    about ``1 / buckets`` of the tracks and buckets are narrow where values are dense. A
+    metric with fewer distinct values than buckets, such as key, gets a bucket per value.
+    Missing values get bucket -1.
+    """
+    bucket_columns = []
+    range_frames = []
+    for metric in metrics:
+        values = df[metric].cast(pl.Float64).to_numpy()
+        edges = np.unique(np.nanquantile(values, np.linspace(0, 1, buckets + 1)[1:-1], method='lower'))
+        bucket = pl.Series(
+            f'{metric}_bucket', np.where(np.isnan(values), -1, np.searchsorted(edges, values, side='right')), dtype=pl.Int16
+        )
+        bucket_columns.append(bucket)
+        range_frames.append(
+            pl.LazyFrame({'bucket': bucket, 'value': values})
+            .filter(pl.col('bucket') >= 0)
+            .group_by('bucket')
+            .agg(pl.col('value').min().alias('min'), pl.col('value').max().alias('max'))
+            .with_columns(metric=pl.lit(metric))
+        )
+    ranges_df = pl.concat(pl.collect_all(range_frames)).select('metric', 'bucket', 'min', 'max')
+    return df.with_columns(bucket_columns), ranges_df
+
+def count_sketch_cells(groups, group_count, tracks_df, ranges_df, metrics=SKETCH_METRICS):
+    """Count the tracks of each group in each bucket of every metric.
+
+    ``groups`` holds the group of every row of ``tracks_df`` as an integer below
+    ``group_count``. One ``bincount`` over a combined group and bucket key per metric
+    replaces a group-by over the tracks. Cells carry the value range of their bucket.
+    """
+    frames = []
+    for metric in metrics:
+        buckets = tracks_df[f'{metric}_bucket'].to_numpy().astype(np.int64)
+        bucket_count = int(buckets.max()) + 1 if len(buckets) else 1
+        valid = buckets >= 0
+        counts = np.bincount(groups[valid] * bucket_count + buckets[valid], minlength=group_count * bucket_count)
+        keys = np.flatnonzero(counts)
+        frames.append(pl.DataFrame({
+            'metric': pl.Series([metric] * len(keys), dtype=pl.Utf8),
+            'group': pl.Series(keys // bucket_count, dtype=pl.Int64),
+            'bucket': pl.Series(keys % bucket_count, dtype=pl.Int16),
+            'count': pl.Series(counts[keys], dtype=pl.Int64),
+        }))
+    return pl.concat(frames).join(ranges_df, on=['metric', 'bucket'])
+
+def build_popularity_sketches(df, metrics=SKETCH_METRICS, buckets=SKETCH_BUCKETS):
+    """Return a quantile sketch of every metric at every popularity value.
+
+    A sketch counts the tracks in each bucket of a metric, along with the lowest and
+    highest value of the bucket. Sketches merge by adding their counts, so the
+    quantiles of any popularity range are read off them without the tracks.
+    """
+    tracks_df, ranges_df = add_sketch_buckets(df.lazy().select(['popularity'] + metrics).collect(), metrics, buckets)
+    min_popularity, max_popularity = POPULARITY_RANGE
+    groups = tracks_df['popularity'].to_numpy().astype(np.int64) - min_popularity
+    return (
+        count_sketch_cells(groups, max_popularity - min_popularity + 1, tracks_df, ranges_df, metrics)
+        .select('metric', (pl.col('group') + min_popularity).alias('popularity'), 'bucket', 'count', 'min', 'max')
+        .sort('metric', 'popularity', 'bucket')
+    )
+
+def build_category_sketches(df, category_columns=SKETCH_CATEGORIES, popularity_bins=POPULARITY_BINS,
+                            metrics=SKETCH_METRICS, buckets=SKETCH_BUCKETS):
+    """Return a quantile sketch of every metric per (category, value, popularity_bin) cell of the cube.
+
+    The buckets are those of ``build_popularity_sketches`` on the same tracks, and a track
+    counts in every value of a list column.
+    """
+    tracks_df, ranges_df = add_sketch_buckets(
+        df.lazy().select(['popularity'] + category_columns + metrics).collect(), metrics, buckets
+    )
+    frames = []
+    for category in category_columns:
+        category_df = tracks_df.explode(category) if is_multi_valued(tracks_df, category) else tracks_df
+        values = category_df[category].cast(pl.Utf8)
+        labels = values.drop_nulls().unique().sort()
+        codes = values.replace_strict(labels, list(range(len(labels))), default=-1, return_dtype=pl.Int64).to_numpy()
+        popularity = category_df['popularity'].to_numpy()
+        for popularity_bin in [ALL] + popularity_bins:
+            # Bins include both their edges, like filter_by_bin
+            min_popularity, max_popularity = POPULARITY_RANGE if popularity_bin == ALL else parse_bin(popularity_bin)
+            rows = (codes >= 0) & (popularity >= min_popularity) & (popularity <= max_popularity)
+            cells_df = count_sketch_cells(codes[rows], len(labels), category_df.filter(pl.Series(rows)), ranges_df, metrics)
+            frames.append(cells_df.select(
+                category=pl.lit(category),
+                value=labels.gather(cells_df['group']),
+                popularity_bin=pl.lit(popularity_bin),
+                metric='metric', bucket='bucket', count='count', min='min', max='max'
+            ))
+    return pl.concat(frames).sort('category', 'popularity_bin', 'metric', 'value', 'bucket')
+
+def estimate_quantiles(counts, lower, upper, quantiles=QUANTILES):
+    """Return the quantiles of each row of bucket ``counts``, and their error bounds.
+
+    The quantile ``q`` of ``n`` values is the value of rank ``floor(q * (n - 1))``,
+    interpolated within the bucket holding that rank. The true value lies between the
+    lowest and highest value of that bucket, so their difference bounds the error of the
+    estimate. It is zero for buckets holding a single distinct value.
+    """
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1] if counts.shape[1] else np.zeros(len(counts), dtype=np.int64)
+    rows = np.arange(len(counts))
+    estimates = {}
+    for quantile in quantiles:
+        rank = np.floor(quantile * np.maximum(totals - 1, 0))
+        bucket = np.minimum((cumulative <= rank[:, None]).sum(axis=1), counts.shape[1] - 1)
+        count = counts[rows, bucket]
+        fraction = (rank - cumulative[rows, bucket] + count) / np.maximum(count - 1, 1)
+        value = lower[bucket] + (upper[bucket] - lower[bucket]) * fraction
+        error = upper[bucket] - lower[bucket]
+        name = get_quantile_name(quantile)
+        estimates[name] = np.where(totals > 0, value, np.nan)
+        estimates[f'{name}_error'] = np.where(totals > 0, error, np.nan)
+    return totals, estimates
+
+class MetricSketches:
+    """Quantiles of every metric by popularity and by category, read off quantile sketches.
+
+    The popularity sketches are kept as cumulative counts over the popularity values,
+    like ``build_popularity_sums``, so the sketch of any popularity range is the
+    difference of two rows. A query costs a few operations on arrays of at most
+    ``SKETCH_BUCKETS`` counts per group, however many tracks there are.
+    """
+    def __init__(self, popularity_sketches_df, category_sketches_df):
+        self.metrics = popularity_sketches_df['metric'].unique(maintain_order=True).to_list()
+        ranges_df = popularity_sketches_df.group_by('metric', 'bucket').agg(pl.col('min').min(), pl.col('max').max())
+        self.bucket_counts = {}
+        self.ranges = {}
+        for (metric,), metric_ranges_df in ranges_df.group_by('metric'):
+            bucket_count = metric_ranges_df['bucket'].max() + 1
+            lower = np.full(bucket_count, np.nan)
+            upper = np.full(bucket_count, np.nan)
+            lower[metric_ranges_df['bucket'].to_numpy()] = metric_ranges_df['min'].to_numpy()
+            upper[metric_ranges_df['bucket'].to_numpy()] = metric_ranges_df['max'].to_numpy()
+            self.bucket_counts[metric] = bucket_count
+            self.ranges[metric] = (lower, upper)
+
+        # Row p holds the bucket counts of the tracks with a popularity below p
+        min_popularity, max_popularity = POPULARITY_RANGE
+        self.popularity_offset = min_popularity
+        self.popularity_counts = {}
+        for (metric,), cells_df in popularity_sketches_df.group_by('metric'):
+            counts = np.zeros((max_popularity - min_popularity + 2, self.bucket_counts[metric]), dtype=np.int64)
+            np.add.at(
+                counts, (cells_df['popularity'].to_numpy() - min_popularity + 1, cells_df['bucket'].to_numpy()),
+                cells_df['count'].to_numpy()
+            )
+            self.popularity_counts[metric] = np.cumsum(counts, axis=0)
+
+        # (category, popularity_bin, metric) -> (values, counts of each value per bucket)
+        self.category_counts = {}
+        for (category, popularity_bin, metric), cells_df in category_sketches_df.group_by('category', 'popularity_bin', 'metric'):
+            values = cells_df['value'].unique().sort()
+            counts = np.zeros((len(values), self.bucket_counts[metric]), dtype=np.int64)
+            rows = values.search_sorted(cells_df['value']).to_numpy()
+            np.add.at(counts, (rows, cells_df['bucket'].to_numpy()), cells_df['count'].to_numpy())
+            self.category_counts[(category, popularity_bin, metric)] = (values, counts)
+
+    def get_popularity_quantiles(self, metric, bins, quantiles=QUANTILES):
+        """Return the track count and quantiles of ``metric`` in each bin from ``get_popularity_bins``."""
+        cumulative = self.popularity_counts[metric]
+        counts = (
+            cumulative[[end - self.popularity_offset for _, _, end in bins]]
+            - cumulative[[start - self.popularity_offset for _, start, _ in bins]]
+        )
+        totals, estimates = estimate_quantiles(counts, *self.ranges[metric], quantiles)
+        return pl.DataFrame({'popularity_bin': [label for label, _, _ in bins], 'count': totals, **estimates})
+
+    def get_category_quantiles(self, category, popularity_bin, metric, quantiles=QUANTILES):
+        """Return the track count and quantiles of ``metric`` for each value of ``category`` in one bin."""
+        values, counts = self.category_counts.get(
+            (category, popularity_bin, metric), (pl.Series(dtype=pl.Utf8), np.zeros((0, self.bucket_counts[metric])))
+        )
+        totals, estimates = estimate_quantiles(counts, *self.ranges[metric], quantiles)
+        return pl.DataFrame({category: values, 'count': totals, **estimates})
+
+def check_metric_sketches(sketches, df, category_columns=SKETCH_CATEGORIES, popularity_bins=POPULARITY_BINS,
+                          metrics=SKETCH_METRICS, quantiles=QUANTILES, tolerance=1e-6):
+    """Compute the quantiles of the sketched groups from ``df`` and raise ValueError when an
+    estimate is further from them than its error bound."""
+    names = [get_quantile_name(quantile) for quantile in quantiles]
+    bins = get_popularity_bins(POPULARITY_RANGE, 25)
+    bin_labels = pl.col('popularity').cut([end - 0.5 for _, _, end in bins[:-1]], labels=[label for label, _, _ in bins])
+    groupings = [(df.lazy().with_columns(popularity_bin=bin_labels.cast(pl.Utf8)), 'popularity_bin', None)]
+    for popularity_bin in [ALL] + popularity_bins:
+        bin_lf = df.lazy() if popularity_bin == ALL else filter_by_bin(df.lazy(), popularity_bin)
+        for category in category_columns:
+            category_lf = bin_lf.explode(category) if is_multi_valued(df, category) else bin_lf
+            groupings.append((category_lf.with_columns(pl.col(category).cast(pl.Utf8)), category, popularity_bin))
+    exact_dfs = pl.collect_all([
+        lf.drop_nulls(group_column).group_by(group_column).agg([
+            pl.col(metric).cast(pl.Float64).quantile(quantile, 'lower').alias(f'{metric}_{name}')
+            for metric in metrics for quantile, name in zip(quantiles, names)
+        ])
+        for lf, group_column, _ in groupings
+    ])
+
+    errors = []
+    for (_, group_column, popularity_bin), exact_df in zip(groupings, exact_dfs):
+        for metric in metrics:
+            if popularity_bin is None:
+                estimated_df = sketches.get_popularity_quantiles(metric, bins, quantiles)
+                label = f'{metric} by popularity'
+            else:
+                estimated_df = sketches.get_category_quantiles(group_column, popularity_bin, metric, quantiles)
+                label = f'{metric} / {group_column} / {popularity_bin}'
+            # Groups without a value of the metric are left out on both sides
+            metric_exact_df = exact_df.select(
+                group_column, *[pl.col(f'{metric}_{name}').alias(f'{name}_exact') for name in names]
+            ).drop_nulls()
+            compared_df = estimated_df.filter(pl.col('count') > 0).join(metric_exact_df, on=group_column, how='full', coalesce=True)
+            mismatches = compared_df.filter(pl.any_horizontal([
+                ~((pl.col(name) - pl.col(f'{name}_exact')).abs() <= pl.col(f'{name}_error') + tolerance).fill_null(False)
+                for name in names
+            ]))
+            if mismatches.height:
+                errors.append(f'{label}: {mismatches.height} groups have quantiles out of bounds')
+    if errors:
+        raise ValueError('Metric sketches are inconsistent with the track data:\n' + '\n'.join(errors))
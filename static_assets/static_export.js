@@ -0,0 +1,67 @@
+// Callbacks of the static export written by export.py, answered from its JSON files without a server
+(function () {
+    const serverFetch = window.fetch.bind(window);
+    // Static file servers send application/json, which the renderer requires, for .json files only
+    window.fetch = function (url, options) {
+        if (typeof url === 'string' && /_dash-(layout|dependencies)$/.test(url)) {
+            url += '.json';
+        }
+        return serverFetch(url, options);
+    };
+
+    function fetchJson(path) {
+        return serverFetch(path).then(function (response) {
+            if (!response.ok) {
+                throw new Error(path + ' returned ' + response.status);
+            }
+            return response.json();
+        });
+    }
+
+    // Outputs are stored once per distinct content, the index maps the callback inputs to them
+    let index = null;
+    function loadOutputs(parts) {
+        index = index || fetchJson('data/index.json');
+        return index.then(function (outputFiles) {
+            const key = parts.map(String).join('/');
+            if (!(key in outputFiles)) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return fetchJson('data/' + outputFiles[key] + '.json');
+        });
+    }
+
+    // Table pages are stored as columns, DataTable displays rows
+    function toRows(page) {
+        const columns = Object.keys(page);
+        const rowCount = columns.length ? page[columns[0]].length : 0;
+        return Array.from({length: rowCount}, function (_, row) {
+            return Object.fromEntries(columns.map(function (col) {
+                return [col, page[col][row]];
+            }));
+        });
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        static_export: {
+            update_distribution_charts: function (metric, binWidth, snapshotName, delta, chartView) {
+                return loadOutputs(['distribution', metric, binWidth, snapshotName, Boolean(delta), chartView]);
+            },
+            update_category_chart: function (category, popularityBin, snapshotName, delta, metric, chartView) {
+                return loadOutputs(['category', category, popularityBin, snapshotName, Boolean(delta), metric, chartView]);
+            },
+            update_delta_switch: function (snapshotName) {
+                return loadOutputs(['delta-switch', snapshotName]);
+            },
+            update_table: function (popularityBin, pageCurrent) {
+                const triggered = window.dash_clientside.callback_context.triggered.map(function (t) {
+                    return t.prop_id;
+                });
+                const page = triggered.includes('track-table.page_current') ? pageCurrent : 0;
+                return loadOutputs(['table', popularityBin, page]).then(function (outputs) {
+                    return [toRows(outputs[0]), outputs[1], page];
+                });
+            }
+        }
+    });
+})();
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+import polars as pl
+from operations import get_genre_mask_columns
+
+DATA_DIR = os.environ.get('DATA_DIR', 'data')
+PREPARED_DATA = 'spotify_data_prepared'
+HISTOGRAM_DATA = 'histogram_data'
+GENRE_MAP = 'genre_map'
+CATEGORY_CUBE = 'category_cube'
+POPULARITY_SUMS = 'popularity_sums'
+SEARCH_INDEX = 'search_index'
+POPULARITY_SKETCHES = 'popularity_sketches'
+CATEGORY_SKETCHES = 'category_sketches'
+ARTIST_ROLLUP = 'artist_rollup'
+ALBUM_ROLLUP = 'album_rollup'
+ARTIST_LEADERBOARDS = 'artist_leaderboards'
+ALBUM_LEADERBOARDS = 'album_leaderboards'
+MANIFEST = 'manifest'
+SNAPSHOTS = 'snapshots'
+SMALL_INT_COLUMNS = ['popularity', 'key', 'mode', 'time_signature']
+LIST_COLUMNS = ['genres', 'general_genres']
+# Joins list values in CSV files, which cannot hold lists; no genre name contains it
+LIST_SEPARATOR = '|'
+FLOAT32_COLUMNS = [
+    'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+    'instrumentalness', 'liveness', 'valence', 'tempo'
+]
+
+def get_table_path(name, extension, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f'{name}.{extension}')
+
+def get_snapshot_dir(snapshot, data_dir=DATA_DIR):
+    return os.path.join(data_dir, SNAPSHOTS, snapshot)
+
+def list_snapshots(data_dir=DATA_DIR):
+    """Return the names of the complete snapshot partitions under ``data_dir``, oldest first.
+
+    Partitions are named by their ISO snapshot date, so they sort chronologically. A
+    partition counts once its manifest is written, which prepare.py does last.
+    """
+    snapshots_dir = os.path.join(data_dir, SNAPSHOTS)
+    if not os.path.isdir(snapshots_dir):
+        return []
+    return sorted(
+        snapshot for snapshot in os.listdir(snapshots_dir)
+        if os.path.exists(get_table_path(MANIFEST, 'json', get_snapshot_dir(snapshot, data_dir)))
+    )
+
+@contextmanager
+def replace_atomically(path):
+    """Yield a temporary path next to ``path`` and move the file written there over ``path``.
+
+    Processes that have the old file open or memory-mapped keep reading its old contents,
+    and new readers only ever see a complete file.
+    """
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def write_table(df, name, data_dir=DATA_DIR):
+    """Write ``df`` as an uncompressed, single-chunk Arrow IPC file so it can be memory-mapped."""
+    # polars 1.5 writes IPC files it cannot read back when a dictionary-encoded column
+    # (Categorical or Enum) comes before string columns, so those columns go last
+    dictionary_columns = [col for col, dtype in df.schema.items() if isinstance(dtype, (pl.Categorical, pl.Enum))]
+    df = df.select([col for col in df.columns if col not in dictionary_columns] + dictionary_columns)
+    with replace_atomically(get_table_path(name, 'arrow', data_dir)) as path:
+        df.rechunk().write_ipc(path, compression='uncompressed')
+
+def write_scan_table(df, name, data_dir=DATA_DIR, row_group_size=32_768):
+    """Write ``df`` as Parquet with small row groups and column statistics.
+
+    When ``df`` is sorted on a column, the min/max statistics of each row group let a
+    scan skip every row group that a filter on that column cannot match.
+    """
+    with replace_atomically(get_table_path(name, 'parquet', data_dir)) as path:
+        df.write_parquet(path, row_group_size=row_group_size, statistics=True)
+
+def get_genre_names(genre_map_df):
+    """Return the genres of the genre map in the order of their bits in the genre masks."""
+    return sorted(genre_map_df['genre'].unique().to_list())
+
+def get_prepared_schema(genre_map_df):
+    """Return the compact dtypes of the prepared tracks, keyed by column.
+
+    Low-cardinality labels become Enums whose categories are sorted, so sorting and
+    grouping run on their integer codes in label order. The audio features, stored with
+    a handful of significant digits, fit in Float32. The genres of a track are lists.
+    Columns not listed keep their type. IPC files keep these dtypes, Parquet and CSV
+    files are cast back after reading.
+    """
+    return {
+        'popularity': pl.Int8,
+        'explicit': pl.Enum(['No', 'Yes']),
+        'general_genre': pl.Enum(sorted(genre_map_df['general_genre'].unique().to_list())),
+        'genre': pl.Categorical,
+        **{col: pl.Int8 for col in SMALL_INT_COLUMNS if col != 'popularity'},
+        **{col: pl.Float32 for col in FLOAT32_COLUMNS},
+        **{col: pl.List(pl.Utf8) for col in LIST_COLUMNS},
+    }
+
+def apply_prepared_schema(df, schema):
+    columns = df.collect_schema()
+    return df.with_columns([
+        (
+            pl.col(col).str.split(LIST_SEPARATOR) if isinstance(dtype, pl.List) and columns[col] == pl.Utf8
+            else pl.col(col)
+        ).cast(dtype)
+        for col, dtype in schema.items() if col in columns
+    ])
+
+def encode_list_columns(df):
+    """Join the list columns of ``df`` into strings, for writing it as CSV."""
+    return df.with_columns([
+        pl.col(col).list.join(LIST_SEPARATOR) for col, dtype in df.schema.items() if isinstance(dtype, pl.List)
+    ])
+
+def read_prepared_schema(data_dir=DATA_DIR):
+    return get_prepared_schema(read_table(GENRE_MAP, data_dir))
+
+def check_prepared_format(columns, data_dir=DATA_DIR):
+    """Raise ValueError when the prepared tracks were written by a prepare.py older than the genre lists."""
+    # Older prepared data joined the genres with '-', which genre names such as hip-hop
+    # also contain, so it cannot be split back reliably. It lacks the general genres and
+    # the genre masks, one column per 64 genres of the genre map
+    genre_names = get_genre_names(read_table(GENRE_MAP, data_dir))
+    required_columns = ['general_genres'] + get_genre_mask_columns(genre_names)
+    missing_columns = [col for col in required_columns if col not in columns]
+    if missing_columns:
+        raise ValueError(
+            f'The prepared tracks in {data_dir} lack the {", ".join(missing_columns)} columns: they were written '
+            'by an older prepare.py, which joined the genres with "-". Run prepare.py again to prepare them.'
+        )
+
+def use_ipc(name, data_dir=DATA_DIR, file_format=None):
+    if file_format is not None:
+        return file_format == 'ipc'
+    return os.path.exists(get_table_path(name, 'arrow', data_dir))
+
+def read_table(name, data_dir=DATA_DIR, file_format=None):
+    """Read a table from its Arrow IPC file, falling back to the CSV when there is none.
+
+    The IPC file is memory-mapped, so every worker reading it shares the same pages of
+    the OS page cache instead of holding a private copy of the parsed data.
+    """
+    if use_ipc(name, data_dir, file_format):
+        return pl.read_ipc(get_table_path(name, 'arrow', data_dir), memory_map=True, rechunk=False)
+    return pl.read_csv(get_table_path(name, 'csv', data_dir))
+
+def load_prepared_data(data_dir=DATA_DIR, file_format=None):
+    """Load the prepared tracks sorted by descending popularity.
+
+    prepare.py writes the IPC file already sorted and typed, so only the CSV fallback pays
+    for the sort and the casts.
+    """
+    df = read_table(PREPARED_DATA, data_dir, file_format)
+    check_prepared_format(df.columns, data_dir)
+    if use_ipc(PREPARED_DATA, data_dir, file_format):
+        return df.set_sorted('popularity', descending=True)
+    return apply_prepared_schema(df, read_prepared_schema(data_dir)).sort('popularity', descending=True)
+
+def scan_prepared_data(data_dir=DATA_DIR, check_format=True):
+    """Lazily scan the prepared tracks without loading them into memory.
+
+    Prefers the popularity-sorted Parquet file, whose row-group statistics make popularity
+    filters skip unrelated row groups, then the IPC file and finally the CSV. Readers of
+    the popularity alone pass ``check_format=False`` to accept data from an older prepare.py.
+    """
+    parquet_path = get_table_path(PREPARED_DATA, 'parquet', data_dir)
+    ipc_path = get_table_path(PREPARED_DATA, 'arrow', data_dir)
+    if os.path.exists(ipc_path) and not os.path.exists(parquet_path):
+        lf = pl.scan_ipc(ipc_path, memory_map=True)
+        if check_format:
+            check_prepared_format(lf.collect_schema().names(), data_dir)
+        return lf
+    if os.path.exists(parquet_path):
+        lf = pl.scan_parquet(parquet_path)
+    else:
+        lf = pl.scan_csv(get_table_path(PREPARED_DATA, 'csv', data_dir))
+    if check_format:
+        check_prepared_format(lf.collect_schema().names(), data_dir)
+    return apply_prepared_schema(lf, read_prepared_schema(data_dir))
+
+def get_data_version(names, data_dir=DATA_DIR):
+    """Return a short fingerprint of the data files behind ``names``, based on their size and mtime."""
+    fingerprint = hashlib.sha1()
+    for name in names:
+        for extension in ('arrow', 'csv', 'parquet'):
+            path = get_table_path(name, extension, data_dir)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                fingerprint.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return fingerprint.hexdigest()[:12]
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_manifest(names, data_dir=DATA_DIR):
+    """Record the content hash of the data files behind ``names`` and return the data version.
+
+    prepare.py writes the manifest after every data file is in place, so a new manifest
+    always describes a complete dataset.
+    """
+    files = {}
+    for name in names:
+        for extension in ('arrow', 'csv', 'parquet'):
+            path = get_table_path(name, extension, data_dir)
+            if os.path.exists(path):
+                files[os.path.basename(path)] = hash_file(path)
+    version = hashlib.sha1(json.dumps(files, sort_keys=True).encode()).hexdigest()[:12]
+    manifest = {'version': version, 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'files': files}
+    with replace_atomically(get_table_path(MANIFEST, 'json', data_dir)) as path:
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+    return version
+
+def read_data_version(names, data_dir=DATA_DIR):
+    """Return the data version from the manifest, or from the files' size and mtime without one."""
+    manifest_path = get_table_path(MANIFEST, 'json', data_dir)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)['version']
+    return get_data_version(names, data_dir)
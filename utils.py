@@ -10,11 +10,11 @@ def convert_hex_to_rgba(hex_color, alpha=1.0):
     rgb_tuple = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
     return f"rgba({rgb_tuple[0]}, {rgb_tuple[1]}, {rgb_tuple[2]}, {alpha})"
 
-def get_avg_metrics(metric_columns, all_data_df, histogram_df):
+def get_avg_metrics(metric_columns, overall_metrics, histogram_df):
     avg_metrics = {}
     for col in metric_columns:
         if col != 'count':
-            avg_metrics[col] = all_data_df[col].mean()
+            avg_metrics[col] = overall_metrics[col]
         else:
             avg_metrics[col] = histogram_df[col].mean()
         avg_metrics[col] = round(avg_metrics[col], 2)